@@ -19,8 +19,10 @@
 
 import numpy as np
 import cv2 as cv
-import glob
 import os
+import FrameFiles
+import FrameEncoders
+import StripSidecar
 import serial
 import math
 from serial.serialwin32 import Serial
@@ -29,6 +31,9 @@ from datetime import datetime, timedelta
 from time import sleep
 import subprocess
 
+# File format of the captured frames, see FrameEncoders.py
+OUTPUT_FORMAT = "png:2"
+
 
 def pointInRect(point, rect):
     x1, y1, w, h = rect
@@ -456,13 +461,8 @@ def timecode(n: int) -> str:
 
 
 def determineStartingFrameNumber(path: str, ext: str) -> int:
-    existing_files = sorted(glob.glob(os.path.join(
-        path, "frame_????????."+ext)), reverse=True)
-
-    if len(existing_files) > 0:
-        return 1+int(os.path.basename(existing_files[0]).split('.')[0][6:])
-
-    return 0
+    # One past the highest frame already captured (0 for an empty folder)
+    return 1+FrameFiles.lastFrameNumber(path, ext)
 
 def calculateAngleForSpoolTakeUp(inner_diameter_spool: float, frame_height: float, film_thickness: float, frames_on_spool: int, new_frames_to_spool: int) -> float:
     '''Calculate the angle to wind the take up spool forward based on
@@ -504,7 +504,9 @@ def main():
     YUV_FORMAT = True
 
     path = OutputFolder(CAMERA_EXPOSURE)
-    starting_frame_number = determineStartingFrameNumber(path, "png")
+    starting_frame_number = determineStartingFrameNumber(path, FrameEncoders.extension(OUTPUT_FORMAT))
+    for my_exposure in CAMERA_EXPOSURE:
+        FrameFiles.clearEndOfReel(path+"{0}".format(my_exposure))
     print("Starting at frame number ", starting_frame_number)
 
     # Calculate the radius of the tape on the take up spool
@@ -730,16 +732,20 @@ def main():
                         print("Found frame {0} at position {1} with Y of sproket hole {2}, exposure {3}".format(frame_number, marlin_y, sproket_y[1], my_exposure))
 
                         output_image=PrepareImageForOutput(freeze_frame, frame_number, output_video_frame_size, sproket_y[1], VERTICAL_OUTPUT_OFFSET, my_exposure)
-                        filename = os.path.join(path+"{0}".format(my_exposure), "frame_{:08d}.png".format(frame_number))
+                        filename = FrameFiles.framePath(path+"{0}".format(my_exposure), frame_number, ext=FrameEncoders.extension(OUTPUT_FORMAT), create=True)
 
                         # DEBUG MASK FOR OUTPUT IMAGES
                         #output_mask = np.zeros(output_image.shape[:2], dtype="uint8")
                         #cv.rectangle(output_mask, (327,96), (1230,720), 255, -1)
                         #output_image = cv.bitwise_and(output_image, output_image, mask=output_mask)
 
-                        # Save frame to disk, use lower compression to save CPU time (not image quality png = lossless)
-                        if cv.imwrite(filename, output_image, [cv.IMWRITE_PNG_COMPRESSION, 2])==False:
-                            raise IOError("Failed to save image")
+                        # Save frame to disk, use lower compression to save CPU time (not image quality, all formats are lossless)
+                        FrameEncoders.writeFrame(filename, output_image, OUTPUT_FORMAT)
+
+                        # Small grey copy of the sproket strip, so alignment can detect the hole
+                        # without reading the whole frame.  The capture position isn't logged as
+                        # the frame has been moved by PrepareImageForOutput
+                        StripSidecar.saveStrip(filename, output_image)
                         
                         #cv.imshow("output",output_image)
                         #cv.waitKey(50)
@@ -803,6 +809,9 @@ def main():
             cv.waitKey()
 
     # Finished/Quit....
+    # Let ImageRegistrationCropping.py (in watch mode) know there are no more frames
+    for my_exposure in CAMERA_EXPOSURE:
+        FrameFiles.markEndOfReel(path+"{0}".format(my_exposure))
     DisconnectFromMarlin(marlin)
     videoCaptureObject.release()
     cv.destroyAllWindows()
@@ -0,0 +1,68 @@
+# Archive_Frames.py
+#
+# Packs a folder of frames (any format, see FrameEncoders.py) into a lossless FFV1
+# archive, or unpacks an archive back into frames, see FrameArchive.py.
+#
+#   python Archive_Frames.py export <frames folder> [<archive folder>]
+#   python Archive_Frames.py import <archive folder> <frames folder> [<format>]
+#
+# The archive is written into the frames folder unless another folder is given.
+# Frames are unpacked as PNG unless a format (for example "png:6" or "reel") is given.
+
+import cv2 as cv
+import os
+import sys
+
+import FrameArchive
+import FrameEncoders
+import FrameFiles
+
+
+def readFrames(files):
+    for filename in files:
+        image = FrameEncoders.readFrame(filename, cv.IMREAD_COLOR)
+        if image is None:
+            raise IOError("Error opening file "+filename)
+        yield FrameFiles.frameNumber(filename), image
+
+
+def exportFolder(input_path: str, archive_path: str = None) -> int:
+    files = FrameFiles.frameFiles(input_path, FrameEncoders.findExtension(input_path))
+    if len(files) == 0:
+        raise FileNotFoundError("No frames in "+input_path)
+    print("Archiving", len(files), "frames from", input_path)
+    return FrameArchive.exportArchive(readFrames(files), input_path if archive_path is None else archive_path)
+
+
+def importFolder(archive_path: str, output_path: str, spec: str = FrameEncoders.DEFAULT_FORMAT) -> int:
+    archive = FrameArchive.openArchive(archive_path)
+    if archive is None:
+        raise FileNotFoundError("No archive in "+archive_path)
+
+    os.makedirs(output_path, exist_ok=True)
+    ext = FrameEncoders.extension(spec)
+    for count, number in enumerate(archive.numbers):
+        image = archive.read(number)
+        if image is None:
+            raise IOError("Error reading frame {0} from {1}".format(number, archive.filename))
+        FrameEncoders.writeFrame(FrameFiles.framePath(output_path, number, ext=ext, create=True), image, spec)
+        if (count+1) % 100 == 0:
+            print("Unpacked", count+1, "of", len(archive.numbers))
+    archive.stop()
+
+    print("Unpacked", len(archive.numbers), "frames to", output_path)
+    return len(archive.numbers)
+
+
+def main():
+    if len(sys.argv) >= 3 and sys.argv[1] == "export":
+        exportFolder(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    elif len(sys.argv) >= 4 and sys.argv[1] == "import":
+        importFolder(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else FrameEncoders.DEFAULT_FORMAT)
+    else:
+        print("python Archive_Frames.py export <frames folder> [<archive folder>]")
+        print("python Archive_Frames.py import <archive folder> <frames folder> [<format>]")
+
+
+if __name__ == "__main__":
+    main()
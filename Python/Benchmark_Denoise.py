@@ -0,0 +1,108 @@
+# Benchmark_Denoise.py
+#
+# Speed (frames per second) and how much noise is removed, for each of the denoise
+# engines in Denoise.py, so a cheap engine can be chosen for most reels and non
+# local means kept for the best ones.
+#
+# By default uses Sample_Images/After_DeNoise.png as the clean picture, with film
+# like grain added to each frame and a little sub-pixel weave (as left after
+# alignment), so the error from the clean picture (PSNR, higher is better) is known.
+# Pass a folder of aligned frames to use real frames instead, then only the
+# estimated noise level can be given.
+#
+#   python Benchmark_Denoise.py [folder]
+
+import cv2 as cv
+import numpy as np
+import os
+import sys
+import time
+
+import Denoise
+import FrameEncoders
+import FrameFiles
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Sample_Images", "After_DeNoise.png")
+# Frames in the "reel", each engine denoises NUMBER_OF_FRAMES-2 windows
+NUMBER_OF_FRAMES = 6
+# Standard deviation of the added grain, in levels
+GRAIN = 6
+# Largest weave between frames, in pixels
+WEAVE = 0.5
+
+
+def sampleFrames(count: int):
+    # Clean picture and noisy, slightly moving copies of it
+    clean = cv.imread(SAMPLE_IMAGE, cv.IMREAD_COLOR)
+    if clean is None:
+        raise FileNotFoundError(SAMPLE_IMAGE)
+    rng = np.random.default_rng(8)
+    h, w = clean.shape[:2]
+    frames = []
+    for _ in range(count):
+        dx, dy = rng.uniform(-WEAVE, WEAVE, 2)
+        m = np.float32([[1, 0, dx], [0, 1, dy]])
+        moved = cv.warpAffine(clean, m, (w, h), flags=cv.INTER_LINEAR, borderMode=cv.BORDER_REPLICATE)
+        grain = rng.normal(0, GRAIN, clean.shape)
+        frames.append(np.clip(moved+grain, 0, 255).astype(np.uint8))
+    return clean, frames
+
+
+def loadFrames(folder: str, count: int):
+    files = FrameFiles.frameFiles(folder, FrameEncoders.findExtension(folder))[:count]
+    return [Denoise.loadFrame(f) for f in files]
+
+
+def noiseSigma(image) -> float:
+    # Estimated standard deviation of the noise (Immerkaer's method), from the
+    # response of a filter which removes smooth areas and edges
+    grey = cv.cvtColor(image, cv.COLOR_BGR2GRAY).astype(np.float32)
+    kernel = np.float32([[1, -2, 1], [-2, 4, -2], [1, -2, 1]])
+    response = cv.filter2D(grey, -1, kernel)[1:-1, 1:-1]
+    h, w = response.shape
+    return float(np.sqrt(np.pi/2)*np.abs(response).sum()/(6*w*h))
+
+
+def psnr(image, clean) -> float:
+    error = np.mean((image.astype(np.float32)-clean.astype(np.float32))**2)
+    return float("inf") if error == 0 else float(10*np.log10(255*255/error))
+
+
+def measure(denoiser: str, frames, clean=None):
+    # Frames per second, mean estimated noise and mean PSNR (None without a clean picture)
+    outputs = []
+    start_time = time.perf_counter()
+    for i in range(1, len(frames)-1):
+        outputs.append(Denoise.denoiseWindow(frames[i-1:i+2], denoiser))
+    fps = len(outputs)/(time.perf_counter()-start_time)
+
+    noise = np.mean([noiseSigma(o) for o in outputs])
+    quality = None if clean is None else np.mean([psnr(o, clean) for o in outputs])
+    return fps, noise, quality
+
+
+def main():
+    clean = None
+    if len(sys.argv) > 1:
+        frames = loadFrames(sys.argv[1], NUMBER_OF_FRAMES)
+    else:
+        clean, frames = sampleFrames(NUMBER_OF_FRAMES)
+    if len(frames) < 3:
+        raise Exception("At least 3 frames are needed")
+    h, w = frames[0].shape[:2]
+    print("Frames", len(frames), w, "x", h)
+
+    middle_frames = frames[1:-1]
+    noise_before = np.mean([noiseSigma(f) for f in middle_frames])
+    print("{:<20} {:>8} {:>8} {:>10} {:>8}".format("engine", "fps", "noise", "reduction", "PSNR dB"))
+    quality = "" if clean is None else "{:>8.2f}".format(np.mean([psnr(f, clean) for f in middle_frames]))
+    print("{:<20} {:>8} {:>8.2f} {:>10} {}".format("(none)", "", noise_before, "", quality))
+
+    for denoiser in Denoise.DENOISERS:
+        fps, noise, quality = measure(denoiser, frames, clean)
+        quality = "" if quality is None else "{:>8.2f}".format(quality)
+        print("{:<20} {:>8.2f} {:>8.2f} {:>9.0f}% {}".format(denoiser, fps, noise, 100*(1-noise/noise_before), quality))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# Benchmark_Detectors.py
+#
+# Compares the sproket hole detection engines in ImageRegistrationCropping.py for
+# speed and positional agreement.
+#
+# By default uses Sample_Images/Full_Frame_Sample.png, shifted by known (sub-pixel)
+# amounts to make a short "reel" where the true movement of the hole is known.
+# Pass a folder of captured frames (any format, see FrameEncoders.py) to use real
+# frames instead.
+#
+#   python Benchmark_Detectors.py [folder] [threshold]
+#
+# The template engine needs the hole size from calibration.json (in the folder, or
+# the current folder for the sample image), it is left out if there isn't one.
+
+import cv2 as cv
+import numpy as np
+import os
+import sys
+import time
+
+import FrameEncoders
+import FrameFiles
+import ImageRegistrationCropping as registration
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Sample_Images", "Full_Frame_Sample.png")
+NUMBER_OF_FRAMES = 50
+REPEATS = 3
+
+
+def shiftedFrames(image, count: int):
+    # Shift the image around by up to +/-8 pixels, returns frames and their shifts
+    rng = np.random.default_rng(8)
+    h, w = image.shape[:2]
+    frames = []
+    shifts = []
+    for _ in range(count):
+        dx, dy = rng.uniform(-8, 8, 2)
+        m = np.float32([[1, 0, dx], [0, 1, dy]])
+        frames.append(cv.warpAffine(image, m, (w, h), flags=cv.INTER_LINEAR, borderMode=cv.BORDER_REPLICATE))
+        shifts.append((dx, dy))
+    return frames, np.array(shifts)
+
+
+def loadFrames(folder: str, count: int):
+    files = FrameFiles.frameFiles(folder, FrameEncoders.findExtension(folder))[:count]
+    frames = [FrameEncoders.readFrame(f, cv.IMREAD_UNCHANGED) for f in files]
+    return [f for f in frames if f is not None], None
+
+
+def runEngine(detector, strips, threshold: int):
+    # Returns the top left/bottom right corners found and the best time per frame (seconds)
+    best = None
+    for _ in range(REPEATS):
+        corners = []
+        start_time = time.perf_counter()
+        for strip in strips:
+            tl, br, _, _, _, _, _ = detector(strip, threshold)
+            corners.append((tl[0], tl[1], br[0], br[1]))
+        elapsed = (time.perf_counter() - start_time) / len(strips)
+        best = elapsed if best is None else min(best, elapsed)
+    return np.array(corners, dtype=np.float64), best
+
+
+def main():
+    registration.show_windows = False
+
+    threshold = 210
+    if len(sys.argv) > 2:
+        threshold = int(sys.argv[2])
+
+    if len(sys.argv) > 1:
+        frames, shifts = loadFrames(sys.argv[1], NUMBER_OF_FRAMES)
+    else:
+        image = cv.imread(SAMPLE_IMAGE, cv.IMREAD_UNCHANGED)
+        if image is None:
+            raise FileNotFoundError(SAMPLE_IMAGE)
+        frames, shifts = shiftedFrames(image, NUMBER_OF_FRAMES)
+
+    if len(frames) == 0:
+        raise Exception("No frames to test")
+
+    # Same strip as processImage uses
+    h, w = frames[0].shape[:2]
+    strips = [f[0:h, 0:int(w*0.205)] for f in frames]
+    print("Frames", len(strips), "strip", strips[0].shape[1], "x", strips[0].shape[0], "threshold", threshold)
+
+    # Hole size for the template engine, as ImageRegistrationCropping.main loads it
+    calibration_filename = os.path.join(sys.argv[1] if len(sys.argv) > 1 else os.getcwd(), registration.CALIBRATION_FILENAME)
+    calibrated = os.path.exists(calibration_filename)
+    if calibrated:
+        calibration = registration.loadCalibration(calibration_filename)
+        registration.template_size = (calibration["average_width"], calibration["average_height"])
+        print("Template hole size", registration.template_size, "from", calibration_filename)
+    else:
+        print("No", calibration_filename, "so the template engine is skipped")
+
+    results = {}
+    for name, detector in registration.SPROKET_DETECTORS.items():
+        if name == "template" and not calibrated:
+            continue
+        results[name] = runEngine(detector, strips, threshold)
+
+    reference, reference_time = results["contour"]
+    print("{:<10} {:>10} {:>8} {:>14} {:>14}".format("engine", "ms/frame", "speedup", "vs contour px", "tracking px"))
+    for name, (corners, elapsed) in results.items():
+        # Agreement with the original engine (mean absolute corner difference)
+        agreement = np.abs(corners - reference).mean()
+
+        # How well the hole follows the known shift (relative to the first frame)
+        tracking = float("nan")
+        if shifts is not None:
+            moved = corners[:, 0:2] - corners[0, 0:2]
+            expected = shifts - shifts[0]
+            tracking = np.abs(moved - expected).mean()
+
+        print("{:<10} {:>10.2f} {:>7.1f}x {:>14.2f} {:>14.2f}".format(name, elapsed*1000, reference_time/elapsed, agreement, tracking))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# Benchmark_Encoders.py
+#
+# Time to save and load a frame, and the file size, for each of the formats in
+# FrameEncoders.py on this machine, then recommends one.
+#
+# Files are written to (and read back from) a temporary folder inside the current
+# folder, so run it from the disk the frames will be saved on - disk speed counts as
+# much as CPU time.  Uses Sample_Images/Full_Frame_Sample.png scaled up to the HQ
+# camera resolution (with added noise, like film grain, so it doesn't compress
+# unrealistically well), or the first frames of a folder passed on the command line.
+#
+#   python Benchmark_Encoders.py [folder]
+
+import cv2 as cv
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import FrameEncoders
+import FrameFiles
+import ReelStore
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Sample_Images", "Full_Frame_Sample.png")
+CAPTURE_SIZE = (4056, 3040)
+NUMBER_OF_FRAMES = 4
+FORMATS = ["png:0", "png:1", "png:2", "png:3", "png:6", "png:9", "tiff", "npy", "webp", "reel"]
+# Longest a writer thread can spend saving a frame and keep up with capture
+# (about 1.25 frames per second, and the scanner has 3 writer threads)
+FRAME_BUDGET = 3*0.8
+
+
+def loadFrames(folder: str = None):
+    if folder is not None:
+        files = FrameFiles.frameFiles(folder, FrameEncoders.findExtension(folder))[:NUMBER_OF_FRAMES]
+        frames = [FrameEncoders.readFrame(f) for f in files]
+        return [f for f in frames if f is not None]
+
+    image = cv.imread(SAMPLE_IMAGE, cv.IMREAD_COLOR)
+    if image is None:
+        raise FileNotFoundError(SAMPLE_IMAGE)
+    image = cv.resize(image, CAPTURE_SIZE, interpolation=cv.INTER_CUBIC)
+    rng = np.random.default_rng(8)
+    frames = []
+    for _ in range(NUMBER_OF_FRAMES):
+        grain = rng.normal(0, 4, image.shape).astype(np.int16)
+        frames.append(np.clip(image.astype(np.int16)+grain, 0, 255).astype(np.uint8))
+    return frames
+
+
+def measure(spec: str, frames, folder: str):
+    # Mean save time, load time (seconds) and file size (MB) per frame
+    ext = FrameEncoders.extension(spec)
+    save_time = 0
+    load_time = 0
+    size = 0
+    for i, frame in enumerate(frames):
+        filename = FrameFiles.framePath(folder, i, ext=ext, sharded=False)
+
+        start_time = time.perf_counter()
+        FrameEncoders.writeFrame(filename, frame, spec)
+        if ext == FrameFiles.STORE_EXTENSION:
+            # Only on disk once the mapped pages are written out, like a closed file
+            ReelStore.openStore(folder).flush()
+        save_time += time.perf_counter()-start_time
+        size += FrameFiles.frameStat(filename)[0]
+
+        start_time = time.perf_counter()
+        image = FrameEncoders.readFrame(filename)
+        load_time += time.perf_counter()-start_time
+        if image is None or not np.array_equal(image, frame):
+            raise Exception("Frame changed by "+spec)
+        if ext != FrameFiles.STORE_EXTENSION:
+            os.remove(filename)
+    if ext == FrameFiles.STORE_EXTENSION:
+        # Closing the store is part of saving the reel
+        start_time = time.perf_counter()
+        ReelStore.closeStore(folder)
+        save_time += time.perf_counter()-start_time
+
+    n = len(frames)
+    return save_time/n, load_time/n, size/n/(1024*1024)
+
+
+def main():
+    frames = loadFrames(sys.argv[1] if len(sys.argv) > 1 else None)
+    if len(frames) == 0:
+        raise Exception("No frames to test")
+    h, w = frames[0].shape[:2]
+    print("Frames", len(frames), w, "x", h, "raw {:.1f} MB".format(frames[0].nbytes/(1024*1024)))
+
+    folder = tempfile.mkdtemp(prefix="encoders_", dir=os.getcwd())
+    results = {}
+    try:
+        print("{:<8} {:>10} {:>10} {:>10}".format("format", "save ms", "load ms", "MB"))
+        for spec in FORMATS:
+            results[spec] = measure(spec, frames, folder)
+            save_time, load_time, size = results[spec]
+            print("{:<8} {:>10.0f} {:>10.0f} {:>10.2f}".format(spec, save_time*1000, load_time*1000, size))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    fastest = min(results, key=lambda spec: results[spec][0])
+    print("Fastest to save (capture, alignment):", fastest)
+
+    keeps_up = [spec for spec in results if results[spec][0] <= FRAME_BUDGET]
+    if len(keeps_up) > 0:
+        smallest = min(keeps_up, key=lambda spec: results[spec][2])
+        print("Smallest which keeps up with capture ({:.1f} s per frame per writer thread):".format(FRAME_BUDGET), smallest)
+    else:
+        print("Nothing keeps up with capture on this machine")
+
+    balanced = min(results, key=lambda spec: (results[spec][0]+results[spec][1])*results[spec][2])
+    print("Best balance of time and size (denoise, archive):", balanced)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Benchmark_GroundTruth.py
+#
+# Scores every sproket hole detection engine against the positions confirmed while
+# aligning (ground_truth.csv, see GroundTruth.py), for accuracy and speed.
+#
+# The output frame is placed from the top left corner of the hole, so the error is
+# the distance (pixels) between the top left corner an engine finds and the labelled
+# one.  Results are given separately for the two labels: "operator" frames are the
+# hard ones, "accepted" frames were found by the engine named in the file (usually
+# "contour") so only show agreement with it.  "recorded" is where the engine put the
+# hole at the time, before the operator corrected it.
+#
+# Each frame is detected at the threshold it was labelled with.  Strips come from the
+# capture sidecars when there are any (see StripSidecar.py), and are all loaded before
+# timing starts.  The template engine needs the hole size from calibration.json in the
+# folder, it is left out for a folder without one.
+#
+#   python Benchmark_GroundTruth.py [capture folder ...]
+
+import numpy as np
+import os
+import sys
+import time
+
+import ImageRegistrationCropping as registration
+import GroundTruth
+
+# Frames used per folder (spread across the reel), the strips are kept in memory
+MAX_FRAMES = 300
+# Errors at or below this (pixels) are treated as correct
+TOLERANCE = 2.0
+
+
+def loadFolder(folder: str):
+    # Labelled rows with their strips, and the hole size from the calibration
+    filename = os.path.join(folder, GroundTruth.GROUND_TRUTH_FILENAME)
+    if not os.path.exists(filename):
+        print("No", GroundTruth.GROUND_TRUTH_FILENAME, "in", folder)
+        return [], None
+
+    rows = GroundTruth.loadGroundTruth(filename)
+    if len(rows) > MAX_FRAMES:
+        rows = [rows[i] for i in np.unique(np.linspace(0, len(rows)-1, MAX_FRAMES).astype(int))]
+
+    samples = []
+    for row in rows:
+        strip = registration.loadSproketStrip(row["filename"])
+        if strip is not None:
+            samples.append((row, strip))
+
+    hole_size = None
+    calibration_filename = os.path.join(folder, registration.CALIBRATION_FILENAME)
+    if os.path.exists(calibration_filename):
+        calibration = registration.loadCalibration(calibration_filename)
+        hole_size = (calibration["average_width"], calibration["average_height"])
+    return samples, hole_size
+
+
+def positionErrors(samples, corners) -> np.ndarray:
+    labelled = np.array([(row["tl_x"], row["tl_y"]) for row, _ in samples], dtype=np.float64)
+    return np.hypot(corners[:, 0]-labelled[:, 0], corners[:, 1]-labelled[:, 1])
+
+
+def runEngine(detector, samples):
+    # Top left corners found, whether anything was found and the time per frame (seconds)
+    corners = []
+    found = []
+    start_time = time.perf_counter()
+    for row, strip in samples:
+        threshold = row["threshold"] if row["threshold"] is not None else 210
+        tl, _, _, _, _, _, number_of_contours = detector(strip, threshold)
+        corners.append(tl)
+        found.append(number_of_contours > 0)
+    elapsed = (time.perf_counter()-start_time)/max(1, len(samples))
+    return np.array(corners, dtype=np.float64), np.array(found), elapsed
+
+
+def printScores(name: str, label: str, errors, found, elapsed):
+    if len(errors) == 0:
+        return
+    fps = "{:>8.1f}".format(1/elapsed) if elapsed is not None and elapsed > 0 else "{:>8}".format("-")
+    print("{:<10} {:<9} {:>6} {} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.1f} {:>8.1f}".format(
+        name, label, len(errors), fps, np.mean(errors), np.median(errors), np.percentile(errors, 95), np.max(errors),
+        100*np.count_nonzero((errors <= TOLERANCE) & found)/len(errors)))
+
+
+def main():
+    registration.show_windows = False
+    folders = sys.argv[1:] if len(sys.argv) > 1 else [registration.ImageFolder()]
+
+    for folder in folders:
+        samples, hole_size = loadFolder(folder)
+        if len(samples) == 0:
+            continue
+        if hole_size is not None:
+            registration.template_size = hole_size
+            print(folder, "frames", len(samples), "hole", registration.template_size)
+        else:
+            print(folder, "frames", len(samples), "no", registration.CALIBRATION_FILENAME, "so the template engine is skipped")
+        print("{:<10} {:<9} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+            "engine", "label", "frames", "fps", "mean px", "median", "95%", "max", "ok %"))
+
+        labels = np.array([row["label"] for row, _ in samples])
+
+        # Where the hole was put at the time, before the operator moved it
+        recorded = [i for i, (row, _) in enumerate(samples) if row["detected_tl_x"] is not None]
+        if len(recorded) > 0:
+            corners = np.array([(samples[i][0]["detected_tl_x"], samples[i][0]["detected_tl_y"]) for i in recorded], dtype=np.float64)
+            errors = positionErrors([samples[i] for i in recorded], corners)
+            for label in (GroundTruth.LABEL_OPERATOR, GroundTruth.LABEL_ACCEPTED):
+                subset = labels[recorded] == label
+                printScores("recorded", label, errors[subset], np.ones(np.count_nonzero(subset), bool), None)
+
+        for name, detector in registration.SPROKET_DETECTORS.items():
+            if name == "template" and hole_size is None:
+                continue
+            # One frame first, so the timing doesn't include OpenCV starting up
+            detector(samples[0][1], 210)
+            corners, found, elapsed = runEngine(detector, samples)
+            errors = positionErrors(samples, corners)
+            for label in (GroundTruth.LABEL_OPERATOR, GroundTruth.LABEL_ACCEPTED):
+                subset = labels == label
+                printScores(name, label, errors[subset], found[subset], elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# Benchmark_Workspace.py
+#
+# Time per frame and peak memory of detectSproket, allocating new images for every
+# frame (as it used to) against reusing a DetectionWorkspace.
+#
+# Each version runs in its own process so the peak resident memory (RSS) of one
+# doesn't hide the other.  Uses Sample_Images/Full_Frame_Sample.png scaled up to the
+# HQ camera resolution, or the first frames of a folder passed on the command line.
+#
+#   python Benchmark_Workspace.py [folder]
+
+import cv2 as cv
+import multiprocessing
+import numpy as np
+import os
+import sys
+import time
+
+import FrameEncoders
+import FrameFiles
+import ImageRegistrationCropping as registration
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Sample_Images", "Full_Frame_Sample.png")
+CAPTURE_SIZE = (4056, 3040)
+NUMBER_OF_STRIPS = 8
+NUMBER_OF_FRAMES = 200
+
+
+def legacyDetectSproket(sproket_image, lower_threshold: int = 210, kernel_size: int = 100):
+    # detectSproket before the workspace, new images and kernel every frame
+    sproket_image = cv.GaussianBlur(sproket_image, (3, 7), 0)
+    sproket_image = cv.cvtColor(sproket_image, cv.COLOR_BGR2GRAY)
+    sproket_image = cv.equalizeHist(sproket_image)
+    _, sproket_image = cv.threshold(sproket_image, lower_threshold, 255, cv.THRESH_BINARY)
+    kernel = cv.getStructuringElement(cv.MORPH_RECT, (kernel_size, kernel_size))
+    sproket_image = cv.morphologyEx(sproket_image, cv.MORPH_OPEN, kernel)
+    return registration.sproketFromMask(sproket_image)
+
+
+def loadStrips(folder: str = None):
+    # The left hand strip of each frame, the same as processImage.  Copied so the full
+    # frames are freed and don't dominate the peak memory
+    strips = []
+    if folder is not None:
+        for filename in FrameFiles.frameFiles(folder, FrameEncoders.findExtension(folder))[:NUMBER_OF_STRIPS]:
+            frame = FrameEncoders.readFrame(filename, cv.IMREAD_UNCHANGED)
+            if frame is not None:
+                strips.append(frame[:, 0:int(frame.shape[1]*0.205)].copy())
+        return strips
+
+    image = cv.imread(SAMPLE_IMAGE, cv.IMREAD_UNCHANGED)
+    image = image[:, 0:int(image.shape[1]*0.205)]
+    size = (int(CAPTURE_SIZE[0]*0.205), CAPTURE_SIZE[1])
+    image = cv.resize(image, size)
+    for i in range(NUMBER_OF_STRIPS):
+        m = np.float32([[1, 0, i-NUMBER_OF_STRIPS/2], [0, 1, 3*i]])
+        strips.append(cv.warpAffine(image, m, size, borderMode=cv.BORDER_REPLICATE))
+    return strips
+
+
+def peakMemory() -> float:
+    # Peak resident memory of this process in MB
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return peak/(1024*1024) if sys.platform == "darwin" else peak/1024
+
+
+def run(job):
+    name, folder = job
+    registration.show_windows = False
+    strips = loadStrips(folder)
+    detect = legacyDetectSproket if name == "allocating" else registration.detectSproket
+
+    # Memory used by detection is measured from here
+    baseline = peakMemory()
+    # One frame first, so the timing doesn't include OpenCV starting up
+    detect(strips[0], 210)
+
+    start_time = time.perf_counter()
+    for i in range(NUMBER_OF_FRAMES):
+        result = detect(strips[i % len(strips)], 210)
+    elapsed = (time.perf_counter()-start_time)/NUMBER_OF_FRAMES
+
+    return name, elapsed, baseline, peakMemory(), result[0]
+
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 else None
+
+    # A fresh process for each, so peak memory is measured separately
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in ("allocating", "workspace"):
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run, ((name, folder),)))
+
+    print("Frames", NUMBER_OF_FRAMES, "strips", NUMBER_OF_STRIPS)
+    print("{:<12} {:>10} {:>14} {:>14} {:>14}".format("version", "ms/frame", "peak RSS MB", "growth MB", "hole"))
+    for name, elapsed, baseline, peak, tl in results:
+        print("{:<12} {:>10.2f} {:>14.1f} {:>14.1f} {:>14}".format(name, elapsed*1000, peak, peak-baseline, str(tl)))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,16 @@
 import numpy as np
 import cv2 as cv
 import time
-import glob
 import os
 
+import FrameFiles
+import FrameEncoders
+
+# File format to convert to, see FrameEncoders.py
+OUTPUT_FORMAT = "png:3"
+
 def Filelist(path: str, ext: str) -> int:
-    return sorted(glob.glob(os.path.join(path, "frame_????????."+ext)), reverse=True)
+    return FrameFiles.frameFiles(path, ext, reverse=True)
 
 output_path = os.path.join(os.getcwd(), "Capture")
 if not os.path.exists(output_path):
@@ -31,17 +36,15 @@ while True:
         if img is None:
             print("Error opening file",filename)
         else:
-            output_filename=os.path.join(output_path,os.path.splitext(os.path.basename(filename))[0]+'.png')
+            output_filename=FrameFiles.framePath(output_path, FrameFiles.frameNumber(filename), ext=FrameEncoders.extension(OUTPUT_FORMAT), create=True)
         
             start_time=time.perf_counter()
-            # PNG output, with NO compression - which is quicker (less CPU time) on Rasp PI
-            # at expense of disk I/O. PNG is always lossless
-            if cv.imwrite(output_filename, img, [cv.IMWRITE_PNG_COMPRESSION, 3])==True:
-                print("Save image took {:.2f} seconds".format(time.perf_counter() - start_time))
-                #Delete source file
-                os.remove(filename)
-                print("Deleted",filename)
-            else:
-                raise IOError("Failed to save image")
+            # Low compression is quicker (less CPU time) on Rasp PI
+            # at expense of disk I/O. All the formats are lossless
+            FrameEncoders.writeFrame(output_filename, img, OUTPUT_FORMAT)
+            print("Save image took {:.2f} seconds".format(time.perf_counter() - start_time))
+            #Delete source file
+            os.remove(filename)
+            print("Deleted",filename)
 
     time.sleep(20)
@@ -1,94 +1,224 @@
 # Simple script to copy images from one folder to another
 # converting/compressing PNG along the way
 # to aid in reducing disk space and reducing CPU load on Rasp PI
+#
+# Each output frame is denoised from a window of three input frames (the frame
+# before, the frame and the frame after).  With NUM_PROCESSES above 1 the windows
+# are denoised in parallel: each input frame is decoded once, into a ring of frames
+# in shared memory, and the workers are only told which slots of the ring make up
+# their window.  Frames are still numbered and saved exactly as they are one at a
+# time, and reach the video in order.
+#
+# With TILE_SIZE set each window is cut into tiles which are denoised at the same
+# time by TILE_THREADS threads, this uses every core on a single frame and needs far
+# less memory than denoising the whole frame at once.  Each tile is denoised with
+# TILE_MARGIN pixels of the frame around it, enough for every pixel kept to see the
+# same neighbourhood it would in the whole frame, so the result is identical and
+# has no seams.  Tiles which are black in all three frames (the padding added by
+# alignment) are skipped.
+#
+# DENOISER chooses how each window is denoised, from slowest (and best) to fastest:
+#
+#   "nlm"                 non local means over the three frames (the original)
+#   "temporal_bilateral"  temporal median, then a light bilateral filter
+#   "bilateral"           bilateral filter of the middle frame only
+#   "median"              median of the three frames, pixel by pixel
+#   "mean"                mean of the three frames, pixel by pixel
+#
+# The temporal engines assume the frames are aligned, anything which moves between
+# frames is smeared by "mean" (less so by "median").  Run Benchmark_Denoise.py to
+# compare their speed and how much noise they remove.
 import numpy as np
 import cv2 as cv
+import multiprocessing
 import time
-import glob
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
-def Filelist(path: str, ext: str) -> int:
-    return sorted(glob.glob(os.path.join(path, "frame_????????."+ext)), reverse=False)
-
-input_path = "E:\\source\\Super8FilmScanner\\Python\\Aligned"
-
-if not os.path.exists(input_path):
-    raise FileNotFoundError("Missing input folder")
-
-output_path = os.path.join(os.getcwd(), "Denoise")
-if not os.path.exists(output_path):
-    raise FileNotFoundError("Missing output folder")
+import FrameFiles
+import FrameEncoders
+from VideoSink import VideoSink
 
-files=Filelist(input_path,"png")
-if len(files)==0:
-    print("Nothing to do, so quit...")
-    quit()
+# File format of the denoised frames, see FrameEncoders.py
+OUTPUT_FORMAT = "png:2"
+# Also send the denoised frames straight into ffmpeg to make this video (in the output
+# folder), see VideoSink.py.  None for frames only
+VIDEO_FILENAME = None
+# Save each denoised frame as an image, can be turned off when making a video
+SAVE_FRAMES = True
+# Denoise this many windows at once, set to the number of CPU cores.  1 denoises one
+# frame at a time and shows the preview windows
+NUM_PROCESSES = 1
+# Windows queued per worker process, the shared memory holds this many frames per
+# worker (plus 3)
+WINDOWS_PER_PROCESS = 2
 
+# Non local means settings, see the OpenCV documentation
+NLM_H = 3
+NLM_H_COLOR = 3
+NLM_TEMPLATE_WINDOW = 7
+NLM_SEARCH_WINDOW = 29
 
-frames=[]
-#Use first file name 
-frame_number=int(os.path.basename(files[0]).split('.')[0][6:])
-target_h=None
-target_w=None
+DENOISER = "nlm"
+# Bilateral filter settings, diameter (pixels) and how different colours (sigma
+# colour) and distant pixels (sigma space) can be and still be mixed
+BILATERAL_DIAMETER = 5
+BILATERAL_SIGMA_COLOR = 20
+BILATERAL_SIGMA_SPACE = 5
+# Lighter, after the temporal median has already removed most of the grain
+COMBINED_SIGMA_COLOR = 10
 
-print("Starting frame number",frame_number)
+# Denoise in tiles of this many pixels square (non local means only, the other
+# engines are fast enough on the whole frame), None for the whole frame at once
+TILE_SIZE = None
+# Threads denoising the tiles of a frame (1 in each worker when NUM_PROCESSES is above 1)
+TILE_THREADS = os.cpu_count()
+# Pixels of the frame each side of a tile which affect it
+TILE_MARGIN = NLM_SEARCH_WINDOW//2 + NLM_TEMPLATE_WINDOW//2
 
-# These are automatically calculated if not supplied, based on the first image in the folder
-#target_w=2650
-#target_h=1790
+input_path = "E:\\source\\Super8FilmScanner\\Python\\Aligned"
+output_path = os.path.join(os.getcwd(), "Denoise")
 
 # Size of images on screen (scaled down from 1920x1080)
 PREVIEW_SCALE=0.5
 
-for filename in files:
-    img = cv.imread(filename,cv.IMREAD_UNCHANGED)
+def Filelist(path: str, ext: str) -> int:
+    return FrameFiles.frameFiles(path, ext)
+
+def loadFrame(filename: str, target_shape=None):
+    img = FrameEncoders.readFrame(filename,cv.IMREAD_UNCHANGED)
     if img is None:
         raise Exception("Error opening file",filename)
-    else:
 
-        # The first frame is our default image size, make all other images this size
-        if target_h==None or target_w==None:
-            target_h, target_w =img.shape[:2]
+    h, w =img.shape[:2]
 
+    # The first frame is our default image size, make all other images this size
+    if target_shape is not None and (target_shape[0]!=h or target_shape[1]!=w):
+        print("Resize the image, wrong dimensions")
+        new_image = np.zeros(target_shape, np.uint8)
+        new_image[0:h,0:w]=img
+        img=new_image
+        new_image=None
         h, w =img.shape[:2]
 
-        if target_h!=h or target_w!=w:
-            print("Resize the image, wrong dimensions")
-            new_image = np.zeros((target_h,target_w,3), np.uint8)
-            new_image[0:h,0:w]=img.copy()
-            img=new_image.copy()
-            new_image=None
-            h, w =img.shape[:2]
+    # Resize image Full HD 1920x1080 and put into 16:9 frame?
+    # Comment this out to leave at original resolution (note very slow for high resolutions!!)
+    if True==False:
+        output_w=1920
+        output_h=1080
+
+        # Scale new_image to keep correct aspect ratio
+        scale = output_w/w
+        if h*scale > output_h:
+            scale = output_h/h
+
+        scale_w=int(w*scale)
+        scale_h=int(h*scale)
+
+        print("Scaled image w=",scale_w,"h=",scale_h, "original w=",w,"h=",h)
+        # Horizontal centre frame
+        # scale_x_offset=int(output_w/2 - scale_w/2)
+        img=cv.resize(img.copy(), (scale_w,scale_h), interpolation=cv.INTER_AREA)
+
+        # Now place on a 1920x1080 frame
+        # new_image = np.zeros((output_h,output_w,3), np.uint8)
+        # new_image[0:scale_h,scale_x_offset:scale_x_offset+scale_w]=scaled_image
+        # img=new_image.copy()
+        # new_image=None
+
+    # Debug resize to speed up processing
+    #img = cv.resize(img, (0,0), fx=0.3, fy=0.3)
+
+    return img
+
+def denoiseFrames(frames):
+    # Frames has 0,1,2 image array, returns the middle one denoised
+    return cv.fastNlMeansDenoisingColoredMulti(frames, 1, 1, dst=None, h=NLM_H, hColor=NLM_H_COLOR, templateWindowSize=NLM_TEMPLATE_WINDOW,searchWindowSize=NLM_SEARCH_WINDOW)
+
+def temporalMedian(frames):
+    # Median of three without sorting: max(min(a,b), min(max(a,b),c))
+    a, b, c = frames
+    return np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+
+def temporalMean(frames):
+    total = frames[0].astype(np.uint16)
+    total += frames[1]
+    total += frames[2]
+    # Rounded to the nearest level
+    total += 1
+    total //= 3
+    return total.astype(np.uint8)
+
+def bilateral(frames):
+    return cv.bilateralFilter(frames[1], BILATERAL_DIAMETER, BILATERAL_SIGMA_COLOR, BILATERAL_SIGMA_SPACE)
+
+def temporalBilateral(frames):
+    return cv.bilateralFilter(temporalMedian(frames), BILATERAL_DIAMETER, COMBINED_SIGMA_COLOR, BILATERAL_SIGMA_SPACE)
+
+def frameTiles(h: int, w: int, tile_size: int, margin: int):
+    # (tile, tile plus margin) for every tile, as (top, bottom, left, right)
+    for y in range(0, h, tile_size):
+        for x in range(0, w, tile_size):
+            tile = (y, min(y+tile_size, h), x, min(x+tile_size, w))
+            yield tile, (max(tile[0]-margin, 0), min(tile[1]+margin, h), max(tile[2]-margin, 0), min(tile[3]+margin, w))
 
+def denoiseTile(frames, dst, tile, area):
+    top, bottom, left, right = area
+    pieces = [f[top:bottom, left:right] for f in frames]
+    # Black padding in every frame stays black, dst starts out black
+    if not any(p.any() for p in pieces):
+        return
+    denoised = denoiseFrames(pieces)
+    dst[tile[0]:tile[1], tile[2]:tile[3]] = denoised[tile[0]-top:tile[1]-top, tile[2]-left:tile[3]-left]
 
-        # Resize image Full HD 1920x1080 and put into 16:9 frame?
-        # Comment this out to leave at original resolution (note very slow for high resolutions!!)
-        if True==False:
-            output_w=1920
-            output_h=1080
+def denoiseTiled(frames, tile_size: int=TILE_SIZE, threads: int=TILE_THREADS):
+    h, w = frames[1].shape[:2]
+    dst = np.zeros_like(frames[1])
+    tiles = list(frameTiles(h, w, tile_size, TILE_MARGIN))
+    if threads<=1:
+        for tile, area in tiles:
+            denoiseTile(frames, dst, tile, area)
+        return dst
+    # OpenCV lets go of the GIL, so the tiles really are denoised at the same time
+    with ThreadPoolExecutor(threads) as executor:
+        for result in [executor.submit(denoiseTile, frames, dst, tile, area) for tile, area in tiles]:
+            result.result()
+    return dst
 
-            # Scale new_image to keep correct aspect ratio
-            scale = output_w/w
-            if h*scale > output_h:
-                scale = output_h/h
+# Threads for the tiles of each frame, only 1 in a worker process
+tile_threads = TILE_THREADS
 
-            scale_w=int(w*scale)
-            scale_h=int(h*scale)
+DENOISERS = {
+    "nlm": denoiseFrames,
+    "temporal_bilateral": temporalBilateral,
+    "bilateral": bilateral,
+    "median": temporalMedian,
+    "mean": temporalMean,
+}
 
-            print("Scaled image w=",scale_w,"h=",scale_h, "original w=",w,"h=",h)
-            # Horizontal centre frame
-            # scale_x_offset=int(output_w/2 - scale_w/2)
-            img=cv.resize(img.copy(), (scale_w,scale_h), interpolation=cv.INTER_AREA)
+def denoiseWindow(frames, denoiser: str=None):
+    # Frames has 0,1,2 image array, returns the middle one denoised
+    if denoiser is None:
+        denoiser = DENOISER
+    if denoiser == "nlm" and TILE_SIZE is not None:
+        return denoiseTiled(frames, TILE_SIZE, tile_threads)
+    return DENOISERS[denoiser](frames)
 
-            # Now place on a 1920x1080 frame
-            # new_image = np.zeros((output_h,output_w,3), np.uint8)
-            # new_image[0:scale_h,scale_x_offset:scale_x_offset+scale_w]=scaled_image
-            # img=new_image.copy()
-            # new_image=None
+def outputFilename(frame_number: int) -> str:
+    return FrameFiles.framePath(output_path, frame_number, ext=FrameEncoders.extension(OUTPUT_FORMAT), create=True)
 
-        # Debug resize to speed up processing
-        #img = cv.resize(img, (0,0), fx=0.3, fy=0.3)
+def denoiseReel(files, existing_frames: set, video: VideoSink=None):
+    frames=[]
+    #Use first file name
+    frame_number=FrameFiles.frameNumber(files[0])
+    target_shape=None
 
+    for filename in files:
+        img = loadFrame(filename, target_shape)
+        if target_shape is None:
+            target_shape=img.shape
         # Update the dimensions, as they could have changed by now
         h, w =img.shape[:2]
 
@@ -99,19 +229,27 @@ for filename in files:
         # Our first output frame is number 1 (frame zero is skipped, as is the last one)
         # This will renumber the frames if the input doesn't start at zero
         frame_number+=1
-        output_filename = os.path.join(output_path, "frame_{:08d}.png".format(frame_number))
+        output_filename = outputFilename(frame_number)
 
         print(os.path.basename(filename),output_filename)
-        if os.path.exists(output_filename):
+        if frame_number in existing_frames:
             print("Skip file",filename)
+            if video is not None:
+                # Needed for the video, read it back rather than denoise it again
+                image = FrameEncoders.readFrame(output_filename,cv.IMREAD_COLOR)
+                if image is None:
+                    print("Unable to read",output_filename,"left out of the video")
+                else:
+                    video.write(image)
         else:
             print("Processing...")
-            
-            # Frames has 0,1,2 image array
-            dst = cv.fastNlMeansDenoisingColoredMulti(frames, 1, 1, dst=None, h=3, hColor=3, templateWindowSize=7,searchWindowSize=29)
 
-            if cv.imwrite(output_filename, dst, [cv.IMWRITE_PNG_COMPRESSION, 2])==False:
-                raise IOError("Failed to save image")
+            dst = denoiseWindow(frames)
+
+            if SAVE_FRAMES:
+                FrameEncoders.writeFrame(output_filename, dst, OUTPUT_FORMAT)
+            if video is not None:
+                video.write(dst)
 
             cv.imshow("image_orig",cv.resize(frames[1], (0,0), fx=PREVIEW_SCALE, fy=PREVIEW_SCALE))
             cv.imshow("image_fixed",cv.resize(dst, (0,0), fx=PREVIEW_SCALE, fy=PREVIEW_SCALE))
@@ -127,5 +265,138 @@ for filename in files:
         # Remove oldest image
         frames.pop(0)
 
-# Exit
-cv.destroyAllWindows()
+# The ring of input frames in shared memory, attached by _initDenoiseWorker
+ring_memory=None
+ring=None
+
+def _initDenoiseWorker(name: str, ring_shape):
+    # Runs once inside each worker process
+    global ring_memory, ring, tile_threads
+    # The workers already keep every core busy
+    cv.setNumThreads(1)
+    tile_threads=1
+    ring_memory=shared_memory.SharedMemory(name=name)
+    ring=np.ndarray(ring_shape, np.uint8, buffer=ring_memory.buf)
+
+def denoiseSlots(job):
+    # Denoises the window of frames in these ring slots, the image is only sent back
+    # if it's needed for the video
+    slots, output_filename, return_image = job
+    dst = denoiseWindow([ring[s] for s in slots])
+    if SAVE_FRAMES:
+        FrameEncoders.writeFrame(output_filename, dst, OUTPUT_FORMAT)
+    return dst if return_image else None
+
+def denoiseReelParallel(files, existing_frames: set, video: VideoSink=None, processes: int=NUM_PROCESSES):
+    first_image = loadFrame(files[0])
+    target_shape = first_image.shape
+    windows_in_flight = processes*WINDOWS_PER_PROCESS
+    # A frame's slot is reused once the three windows using it are finished, the
+    # windows in flight plus the newest window's three frames are never reused
+    ring_size = windows_in_flight+3
+    ring_shape = (ring_size,)+target_shape
+
+    if SAVE_FRAMES:
+        # A reel store can only be made and grown by one process, make room for every
+        # output frame before the workers start (they then only write into slots)
+        last_frame_number = FrameFiles.frameNumber(files[0])+len(files)-2
+        FrameEncoders.reserve(output_path, OUTPUT_FORMAT, last_frame_number+1, target_shape)
+
+    memory =shared_memory.SharedMemory(create=True, size=int(np.prod(ring_shape)))
+    frames = np.ndarray(ring_shape, np.uint8, buffer=memory.buf)
+    try:
+        # Output file name and the worker's result (None if it already existed), in frame order
+        pending = deque()
+        finished = 0
+
+        def finishOldest():
+            nonlocal finished
+            output_filename, result = pending.popleft()
+            if result is None:
+                if video is not None:
+                    # Needed for the video, read it back rather than denoise it again
+                    image = FrameEncoders.readFrame(output_filename,cv.IMREAD_COLOR)
+                    if image is None:
+                        print("Unable to read",output_filename,"left out of the video")
+                    else:
+                        video.write(image)
+            else:
+                dst = result.get()
+                if video is not None:
+                    video.write(dst)
+                print("Denoised", output_filename)
+            finished+=1
+
+        frame_number=FrameFiles.frameNumber(files[0])
+        with multiprocessing.Pool(processes, initializer=_initDenoiseWorker, initargs=(memory.name, ring_shape)) as pool:
+            for i, filename in enumerate(files):
+                # The slot's last frame must not be in any unfinished window (the
+                # window centred on frame i-ring_size+1 is the last to use it)
+                while i-ring_size+1 > finished:
+                    finishOldest()
+                # Decoded once, straight into shared memory
+                frames[i % ring_size] = first_image if i == 0 else loadFrame(filename, target_shape)
+                if i < 2:
+                    continue
+
+                # Same numbering as denoiseReel, the window is centred on frame i-1
+                frame_number+=1
+                output_filename = outputFilename(frame_number)
+                if frame_number in existing_frames:
+                    print("Skip file",filename)
+                    pending.append((output_filename, None))
+                else:
+                    slots = ((i-2) % ring_size, (i-1) % ring_size, i % ring_size)
+                    pending.append((output_filename, pool.apply_async(denoiseSlots, ((slots, output_filename, video is not None),))))
+
+                while len(pending) > windows_in_flight:
+                    finishOldest()
+
+            while len(pending) > 0:
+                finishOldest()
+    finally:
+        # The memory can't be closed while an array still uses it
+        del frames
+        memory.close()
+        memory.unlink()
+
+def main():
+    if not os.path.exists(input_path):
+        raise FileNotFoundError("Missing input folder")
+
+    if not os.path.exists(output_path):
+        raise FileNotFoundError("Missing output folder")
+
+    files=Filelist(input_path,FrameEncoders.findExtension(input_path))
+    if len(files)==0:
+        print("Nothing to do, so quit...")
+        quit()
+
+    # Frames already denoised on a previous run
+    existing_frames=FrameFiles.frameNumbers(output_path,FrameEncoders.extension(OUTPUT_FORMAT))
+
+    if DENOISER not in DENOISERS:
+        raise ValueError("Unknown denoiser "+DENOISER)
+    print("Starting frame number",FrameFiles.frameNumber(files[0]),"denoiser",DENOISER)
+
+    video=None
+    if VIDEO_FILENAME is not None:
+        video=VideoSink(os.path.join(output_path, VIDEO_FILENAME))
+
+    try:
+        start_time=time.perf_counter()
+        if NUM_PROCESSES>1:
+            denoiseReelParallel(files, existing_frames, video, NUM_PROCESSES)
+        else:
+            denoiseReel(files, existing_frames, video)
+        print("Denoise took {:.1f} seconds".format(time.perf_counter()-start_time))
+
+    finally:
+        if video is not None:
+            print("Waiting for ffmpeg to finish the video...")
+            video.close()
+        # Exit
+        cv.destroyAllWindows()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# DetectionCache.py
+#
+# Remembers where the sproket hole was found in each captured frame, so the reel
+# can be cropped again (for example after changing FRAME_DIMS) without running
+# detectSproket over every frame.
+#
+# Results are kept in a single compressed numpy file (one array per column) next to
+# the captured frames.  Each row is keyed by file path, file size and modification
+# time, so a frame which has been re-captured is detected again.
+
+import numpy as np
+import os
+
+import FrameFiles
+
+CACHE_FILENAME = "sproket_cache.npz"
+
+# How the hole position was arrived at
+SOURCE_DETECTED = 0
+SOURCE_OPERATOR = 1
+SOURCE_FALLBACK = 2
+
+COLUMNS = {
+    "size": np.int64,
+    "mtime": np.float64,
+    "tl_x": np.int32,
+    "tl_y": np.int32,
+    "br_x": np.int32,
+    "br_y": np.int32,
+    "rotation": np.float32,
+    "area": np.float32,
+    "contours": np.int32,
+    "threshold": np.int16,
+    "source": np.int8,
+}
+
+
+class DetectionCache:
+    def __init__(self, folder: str):
+        self.filename = os.path.join(folder, CACHE_FILENAME)
+        self.rows = {}
+        self.changed = False
+
+        if os.path.exists(self.filename):
+            with np.load(self.filename) as data:
+                paths = data["path"]
+                columns = {c: data[c] for c in COLUMNS}
+
+            for i, path in enumerate(paths):
+                self.rows[str(path)] = {c: columns[c][i].item() for c in COLUMNS}
+
+            print("Loaded", len(self.rows), "cached detections from", self.filename)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def lookup(self, path: str):
+        # Returns the cached row, or None if missing or the file has changed since
+        row = self.rows.get(os.path.abspath(path))
+        if row is None:
+            return None
+
+        size, mtime = FrameFiles.frameStat(path)
+        if row["size"] != size or row["mtime"] != mtime:
+            return None
+
+        return row
+
+    def sproketHole(self, path: str):
+        # Top left and bottom right of the hole, as used by processImage.  A fallback
+        # position is only a guess (and is in the triage file), so isn't returned and
+        # the frame is detected again
+        row = self.lookup(path)
+        if row is None or row["source"] == SOURCE_FALLBACK:
+            return None
+        return (row["tl_x"], row["tl_y"]), (row["br_x"], row["br_y"])
+
+    def store(self, path: str, result: dict):
+        # result is the dictionary filled in by processImage
+        size, mtime = FrameFiles.frameStat(path)
+        row = {c: result.get(c, 0) for c in COLUMNS}
+        row["size"] = size
+        row["mtime"] = mtime
+        self.rows[os.path.abspath(path)] = row
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+
+        paths = sorted(self.rows.keys())
+        columns = {c: np.array([self.rows[p][c] for p in paths], dtype=t) for c, t in COLUMNS.items()}
+
+        # Write to a temporary file first, so a crash never leaves a corrupt cache
+        # (numpy adds the .npz extension)
+        temp_filename = self.filename + ".tmp"
+        np.savez_compressed(temp_filename, path=np.array(paths), **columns)
+        os.replace(temp_filename + ".npz", self.filename)
+        self.changed = False
@@ -0,0 +1,89 @@
+# FineRegistration.py
+#
+# Optional second alignment stage, after the frame has been cropped using the
+# sproket hole.  The hole can move slightly relative to the picture (it is punched
+# separately, and the film base shrinks), which leaves a little jitter.
+#
+# Each cropped frame is reduced to a small grey image (a few pyramid levels down)
+# and compared with a rolling reference, the average of the previous frames, using
+# phase correlation.  The sub-pixel offset found is applied when the output frame is
+# cut from the captured image, so it costs no extra pass over the full image.
+#
+# The reference moves with the picture, so slow pans and zooms are kept, only the
+# frame to frame jitter is removed.  Big jumps (scene changes, splices) aren't
+# corrected, the reference starts again from that frame instead.
+
+import cv2 as cv
+import numpy as np
+
+# Pyramid levels below full resolution (2 is 1/4 scale)
+PYRAMID_LEVELS = 2
+# Weight of each new frame in the rolling reference
+REFERENCE_WEIGHT = 0.3
+# Largest correction in full resolution pixels, anything larger is treated as a scene change
+MAX_SHIFT = 12
+# Phase correlation peak below this means the frames don't match well enough to correct
+MIN_RESPONSE = 0.1
+
+
+class FineRegistration:
+    def __init__(self, levels: int = PYRAMID_LEVELS, weight: float = REFERENCE_WEIGHT, max_shift: float = MAX_SHIFT, min_response: float = MIN_RESPONSE):
+        self.levels = levels
+        self.weight = weight
+        self.max_shift = max_shift
+        self.min_response = min_response
+        self.reference = None
+        self.window = None
+
+    def reset(self):
+        # Next frame isn't a continuation of the previous one
+        self.reference = None
+
+    def lowResolution(self, image):
+        if image.ndim == 3:
+            image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+        for _ in range(self.levels):
+            image = cv.pyrDown(image)
+        return image.astype(np.float32)
+
+    def estimate(self, image):
+        # Offset (x, y) in full resolution pixels to move this frame by so it lines
+        # up with the reference, and the phase correlation response
+        small = self.lowResolution(image)
+
+        if self.reference is None or self.reference.shape != small.shape:
+            self.reference = small
+            self.window = cv.createHanningWindow((small.shape[1], small.shape[0]), cv.CV_32F)
+            return (0.0, 0.0), 1.0
+
+        (dx, dy), response = cv.phaseCorrelate(self.reference, small, self.window)
+        scale = 2**self.levels
+        shift = (dx*scale, dy*scale)
+
+        if response < self.min_response or np.hypot(shift[0], shift[1]) > self.max_shift:
+            self.reference = small
+            return (0.0, 0.0), response
+
+        cv.accumulateWeighted(small, self.reference, self.weight)
+        return shift, response
+
+    def crop(self, image, frame_tl, frame_br):
+        # Output frame cut from the captured image at the hole aligned position plus
+        # the correction, in a single resample
+        (dx, dy), _ = self.estimate(image[frame_tl[1]:frame_br[1], frame_tl[0]:frame_br[0]])
+        if dx == 0 and dy == 0:
+            return image[frame_tl[1]:frame_br[1], frame_tl[0]:frame_br[0]]
+
+        w, h = frame_br[0]-frame_tl[0], frame_br[1]-frame_tl[1]
+        centre = ((frame_tl[0]+frame_br[0]-1)/2+dx, (frame_tl[1]+frame_br[1]-1)/2+dy)
+        return cv.getRectSubPix(image, (w, h), centre)
+
+    def apply(self, frame):
+        # Correct an already cropped frame (for example geometry corrected)
+        (dx, dy), _ = self.estimate(frame)
+        if dx == 0 and dy == 0:
+            return frame
+
+        h, w = frame.shape[:2]
+        m = np.float32([[1, 0, dx], [0, 1, dy]])
+        return cv.warpAffine(frame, m, (w, h), flags=cv.INTER_LINEAR | cv.WARP_INVERSE_MAP, borderMode=cv.BORDER_REPLICATE)
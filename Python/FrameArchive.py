@@ -0,0 +1,230 @@
+# FrameArchive.py
+#
+# A reel of frames packed into a single lossless video file, for keeping as the
+# archive master.  A reel of PNG files is thousands of files and several GB, the
+# archive is one file (FFV1 in Matroska, usually smaller than the PNGs) which is
+# much quicker to copy and back up.
+#
+#   frames.mkv              the frames, FFV1 with every frame a key frame, so any
+#                           frame can be decoded on its own
+#   frames.mkv.index.json   frame number, time stamp in the video and MD5 of the
+#                           pixels of every frame
+#
+# Every frame is checked against the original after packing (VERIFY), and the index
+# is only written once that has passed, so an archive with an index is complete.
+#
+# Alignment and Denoise can read frames straight from an archive.  They are listed
+# as frame_????????.mkv (see FrameFiles.py) and read like any other format (see
+# FrameEncoders.py), one ffmpeg process decodes them in order and is only restarted
+# (seeking straight to the frame, using the index) when frames are read out of order.
+# Use Archive_Frames.py to pack and unpack a folder of frames.
+#
+# ffmpeg has to be installed and on the PATH (see VideoSink.py).
+
+import atexit
+import hashlib
+import json
+import numpy as np
+import os
+import subprocess
+from threading import Lock
+
+import VideoSink
+
+ARCHIVE_FILENAME = "frames.mkv"
+INDEX_FILENAME = "frames.mkv.index.json"
+
+# Time stamps only, the frame rate doesn't change the archive size
+FRAME_RATE = VideoSink.FRAME_RATE
+# Lossless, every frame a key frame (-g 1), with a CRC per slice to detect damage
+OUTPUT_ARGUMENTS = ["-c:v", "ffv1", "-level", "3", "-g", "1", "-slices", "16", "-slicecrc", "1"]
+# Decode the archive again after packing and compare every frame with the original
+VERIFY = True
+
+
+def frameChecksums(filename: str, copy: bool):
+    # Time base and (time stamp, MD5) of every frame in a video, from ffmpeg's
+    # framemd5 output.  copy reads the packets without decoding them (for the time
+    # stamps), otherwise the MD5 is of the decoded BGR pixels
+    command = [VideoSink.FFMPEG, "-loglevel", "error", "-i", filename, "-map", "0:v:0"]
+    command += ["-c", "copy"] if copy else ["-fps_mode", "passthrough", "-pix_fmt", "bgr24"]
+    command += ["-f", "framemd5", "-"]
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True, text=True).stdout
+
+    time_base = None
+    frames = []
+    for line in output.splitlines():
+        if line.startswith("#tb 0:"):
+            num, den = line.split(":")[1].strip().split("/")
+            time_base = (int(num), int(den))
+        elif not line.startswith("#") and line.strip() != "":
+            # stream, dts, pts, duration, size, hash
+            fields = [f.strip() for f in line.split(",")]
+            frames.append((int(fields[2]), fields[5]))
+    return time_base, frames
+
+
+def exportArchive(frames, archive_path: str, verify: bool = VERIFY) -> int:
+    # Packs (frame number, BGR image) pairs, in frame number order, into an archive
+    # in archive_path.  Returns the number of frames
+    os.makedirs(archive_path, exist_ok=True)
+    filename = os.path.join(archive_path, ARCHIVE_FILENAME)
+    index_filename = os.path.join(archive_path, INDEX_FILENAME)
+    if os.path.exists(index_filename):
+        # The old index doesn't match whilst the archive is being replaced
+        os.remove(index_filename)
+    archive = _archives.pop(os.path.abspath(archive_path), None)
+    if archive is not None:
+        archive.stop()
+
+    numbers = []
+    checksums = []
+    shape = None
+    with VideoSink.VideoSink(filename, FRAME_RATE, OUTPUT_ARGUMENTS) as sink:
+        for number, image in frames:
+            image = np.ascontiguousarray(image)
+            sink.write(image)
+            shape = image.shape
+            numbers.append(number)
+            checksums.append(hashlib.md5(image).hexdigest())
+            if len(numbers) % 100 == 0:
+                print("Packed", len(numbers), "frames")
+    if len(numbers) == 0:
+        raise ValueError("No frames to archive")
+    if sink.return_code != 0:
+        raise IOError("ffmpeg failed to write "+filename)
+
+    time_base, packets = frameChecksums(filename, copy=True)
+    if len(packets) != len(numbers):
+        raise IOError("Archive has {0} frames, expected {1}".format(len(packets), len(numbers)))
+
+    if verify:
+        print("Checking", filename)
+        _, decoded = frameChecksums(filename, copy=False)
+        bad = [numbers[i] for i, (_, checksum) in enumerate(decoded) if i >= len(checksums) or checksum != checksums[i]]
+        if len(decoded) != len(checksums) or len(bad) > 0:
+            raise IOError("Archive doesn't match the frames, first bad frame {0}".format(bad[0] if len(bad) > 0 else len(decoded)))
+
+    index = {
+        "archive": ARCHIVE_FILENAME,
+        "width": shape[1],
+        "height": shape[0],
+        "frame_rate": FRAME_RATE,
+        "time_base": list(time_base),
+        # Frame number, time stamp (in time_base units), MD5 of the BGR pixels
+        "frames": [[number, pts, checksum] for number, (pts, _), checksum in zip(numbers, packets, checksums)],
+    }
+    with open(index_filename, "w") as f:
+        json.dump(index, f)
+
+    print("Archived", len(numbers), "frames to", filename, "{:.1f} MB".format(os.path.getsize(filename)/(1024*1024)))
+    return len(numbers)
+
+
+class ArchiveReader:
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.filename = os.path.join(folder, ARCHIVE_FILENAME)
+        with open(os.path.join(folder, INDEX_FILENAME), "r") as f:
+            index = json.load(f)
+        self.shape = (index["height"], index["width"], 3)
+        self.frame_rate = index["frame_rate"]
+        num, den = index["time_base"]
+        self.times = [pts*num/den for _, pts, _ in index["frames"]]
+        self.numbers = [number for number, _, _ in index["frames"]]
+        # Frame number to position in the video
+        self.positions = {number: i for i, number in enumerate(self.numbers)}
+        self.mtime = os.path.getmtime(self.filename)
+        self.lock = Lock()
+        self.process = None
+        self.pid = None
+        self.next_position = None
+        # Last frame read, it is often read twice in a row (sproket strip then frame)
+        self.last = None
+
+    def start(self, position: int):
+        self.stop()
+        # Stopped by closing the pipe, which isn't an error worth printing
+        command = [VideoSink.FFMPEG, "-loglevel", "fatal"]
+        if position > 0:
+            # Half way between frames, so rounding can't land on the wrong one
+            command += ["-ss", "{:.6f}".format((self.times[position-1]+self.times[position])/2)]
+        command += ["-i", self.filename, "-map", "0:v:0", "-f", "rawvideo", "-pix_fmt", "bgr24", "-"]
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=int(np.prod(self.shape)))
+        # A forked alignment worker inherits this, but mustn't read from it
+        self.pid = os.getpid()
+        self.next_position = position
+
+    def stop(self):
+        if self.process is not None and self.pid == os.getpid():
+            self.process.kill()
+            self.process.stdout.close()
+            self.process.wait()
+        self.process = None
+
+    def read(self, number: int):
+        # The frame (BGR, read only), or None if it isn't in the archive
+        position = self.positions.get(number)
+        if position is None:
+            return None
+        with self.lock:
+            if self.last is not None and self.last[0] == number and self.pid == os.getpid():
+                return self.last[1]
+            if self.process is None or self.pid != os.getpid() or position != self.next_position:
+                self.start(position)
+            image = np.empty(self.shape, np.uint8)
+            if self.process.stdout.readinto(memoryview(image).cast("B")) != image.nbytes:
+                self.stop()
+                return None
+            # Shared with the next caller if it's read again, like a frame in a reel store
+            image.flags.writeable = False
+            self.next_position = position+1
+            self.last = (number, image)
+            return image
+
+
+# Archives already opened by this process, by folder
+_archives = {}
+_archives_lock = Lock()
+
+
+def exists(folder: str) -> bool:
+    return os.path.exists(os.path.join(folder, INDEX_FILENAME))
+
+
+def openArchive(folder: str):
+    # The archive in a folder, or None if there isn't one
+    key = os.path.abspath(folder)
+    with _archives_lock:
+        archive = _archives.get(key)
+        if archive is None and exists(folder):
+            archive = ArchiveReader(folder)
+            _archives[key] = archive
+        return archive
+
+
+@atexit.register
+def closeArchives():
+    for archive in _archives.values():
+        archive.stop()
+
+
+def archivedFrames(folder: str) -> list:
+    archive = openArchive(folder)
+    return [] if archive is None else list(archive.numbers)
+
+
+def archiveFrame(folder: str, number: int):
+    # Frame from the archive in a folder, None if it isn't there
+    archive = openArchive(folder)
+    if archive is None:
+        return None
+    return archive.read(number)
+
+
+def archiveStat(folder: str, number: int):
+    # (size, modified time) of a frame, like os.stat gives for a frame file, None if it isn't there
+    archive = openArchive(folder)
+    if archive is None or number not in archive.positions:
+        return None
+    return int(np.prod(archive.shape)), archive.mtime
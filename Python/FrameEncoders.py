@@ -0,0 +1,133 @@
+# FrameEncoders.py
+#
+# File formats the frames can be saved in.  Every stage (capture, alignment and
+# denoise) has its own format setting, a string of the format name and optionally a
+# level:
+#
+#   "png:2"   PNG at compression level 0 (none, fastest) to 9 (smallest)
+#   "tiff"    uncompressed TIFF, almost no CPU time but large files
+#   "npy"     raw numpy array, the least CPU time of all (no header to parse)
+#   "webp"    lossless WebP, smallest files but slow to write
+#   "reel"    every frame in one memory mapped file (see ReelStore.py), no encoding
+#             and reading a frame doesn't copy it
+#
+# All of them are lossless.  The next stage finds out which format the frames it
+# reads were saved in (see findExtension), so only the writer needs to be told.
+# Frames can also be read (not written) from an FFV1 archive, see FrameArchive.py.
+# Run Benchmark_Encoders.py to measure them on your own machine.
+
+import cv2 as cv
+import numpy as np
+import os
+import shutil
+
+import FrameArchive
+import FrameFiles
+import ReelStore
+
+DEFAULT_FORMAT = "png:1"
+DEFAULT_PNG_LEVEL = 1
+
+# Format name to file extension, in the order findExtension looks for them
+EXTENSIONS = {
+    "png": "png",
+    "tiff": "tiff",
+    "npy": "npy",
+    "webp": "webp",
+    "reel": FrameFiles.STORE_EXTENSION,
+}
+
+
+def parseFormat(spec: str):
+    # ("png", 2) from "png:2", the level is None for formats without one
+    name, _, level = spec.lower().partition(":")
+    if name not in EXTENSIONS:
+        raise ValueError("Unknown frame format "+spec)
+    if name == "png":
+        level = int(level) if level != "" else DEFAULT_PNG_LEVEL
+        if level < 0 or level > 9:
+            raise ValueError("PNG compression level must be 0 to 9 "+spec)
+        return name, level
+    return name, None
+
+
+def extension(spec: str) -> str:
+    return EXTENSIONS[parseFormat(spec)[0]]
+
+
+def writeParameters(spec: str):
+    name, level = parseFormat(spec)
+    if name == "png":
+        return [cv.IMWRITE_PNG_COMPRESSION, level]
+    if name == "tiff":
+        # 1 is no compression
+        return [cv.IMWRITE_TIFF_COMPRESSION, 1]
+    if name == "webp":
+        # Quality above 100 is lossless
+        return [cv.IMWRITE_WEBP_QUALITY, 101]
+    return []
+
+
+def writeFrame(filename: str, image, spec: str = DEFAULT_FORMAT):
+    # filename should have the extension for spec (see FrameFiles.framePath)
+    name = parseFormat(spec)[0]
+    if name == "reel":
+        store = ReelStore.openStore(os.path.dirname(filename), writable=True, frame_shape=image.shape, dtype=image.dtype)
+        store.write(FrameFiles.frameNumber(filename), image)
+        return
+    if name == "npy":
+        with open(filename, "wb") as f:
+            np.save(f, np.ascontiguousarray(image), allow_pickle=False)
+        return
+    if cv.imwrite(filename, image, writeParameters(spec)) == False:
+        raise IOError("Failed to save image")
+
+
+def readFrame(filename: str, flags: int = cv.IMREAD_UNCHANGED):
+    # Same as cv.imread (None if it can't be read) for any of the formats.  Frames
+    # from a reel store are read only views of the store unless flags convert them
+    if filename.endswith("."+FrameFiles.STORE_EXTENSION):
+        store = ReelStore.openStore(os.path.dirname(filename))
+        image = None if store is None else store.read(FrameFiles.frameNumber(filename))
+        if image is None:
+            return None
+    elif filename.endswith("."+FrameFiles.ARCHIVE_EXTENSION):
+        image = FrameArchive.archiveFrame(os.path.dirname(filename), FrameFiles.frameNumber(filename))
+        if image is None:
+            return None
+    elif filename.endswith(".npy"):
+        try:
+            image = np.load(filename, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+    else:
+        return cv.imread(filename, flags)
+    if flags == cv.IMREAD_GRAYSCALE and image.ndim == 3:
+        return cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    if flags == cv.IMREAD_COLOR and image.ndim == 2:
+        return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+    return image
+
+
+def findExtension(path: str, default: str = "png") -> str:
+    # Extension of the frames already in a folder, so a stage reads whichever format
+    # the previous one wrote.  Stops at the first frame found
+    for ext in list(EXTENSIONS.values())+[FrameFiles.ARCHIVE_EXTENSION]:
+        if next(FrameFiles.scanFrames(path, ext), None) is not None:
+            return ext
+    return default
+
+
+def copyFrame(source: str, destination: str, spec: str = DEFAULT_FORMAT):
+    # Same frame under another number, both in the format of spec
+    if parseFormat(spec)[0] == "reel":
+        writeFrame(destination, readFrame(source), spec)
+    else:
+        shutil.copy2(source, destination)
+
+
+def reserve(path: str, spec: str, count: int, frame_shape):
+    # Room for frames 0 to count-1, needed before several processes write frames
+    # of this format into the same folder (only reel stores need it)
+    if parseFormat(spec)[0] == "reel":
+        ReelStore.reserve(path, count, frame_shape)
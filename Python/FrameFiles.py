@@ -0,0 +1,169 @@
+# FrameFiles.py
+#
+# Finding and naming the frame_????????.png files of a reel.
+#
+# Frames can be stored flat (every frame in one folder, the original layout) or
+# sharded into sub folders of SHARD_SIZE frames, for example
+#
+#   Capture-8.0/0001/frame_00001234.png
+#
+# so that no single folder holds hundreds of thousands of files.  Both layouts are
+# always read, SHARDED only controls how new files are written.
+#
+# Folders are read with os.scandir (a single pass, no pattern matching or stat
+# calls), the frame number is parsed from each file name as it goes.
+#
+# Frames kept in a reel store (see ReelStore.py) have the extension STORE_EXTENSION,
+# frames in an archive (see FrameArchive.py) ARCHIVE_EXTENSION.  They aren't real
+# files, but are listed and named the same way, the store's or archive's index is
+# read rather than the folder.
+
+import os
+
+import FrameArchive
+import ReelStore
+
+# Write new frames into numbered sub folders
+SHARDED = False
+# Frames per sub folder
+SHARD_SIZE = 1000
+
+FRAME_PREFIX = "frame_"
+FRAME_DIGITS = 8
+SHARD_DIGITS = 4
+
+STORE_EXTENSION = "reel"
+ARCHIVE_EXTENSION = "mkv"
+
+# Sub folders already created by framePath, saves an os.makedirs call per frame
+_created_shards = set()
+
+
+def frameNumber(filename: str, ext: str = None) -> int:
+    # Frame number from a file name (with or without a folder), -1 if the
+    # name isn't frame_????????.ext
+    name = os.path.basename(filename)
+    stem, dot, extension = name.partition(".")
+    if dot == "" or len(stem) != len(FRAME_PREFIX)+FRAME_DIGITS or not stem.startswith(FRAME_PREFIX):
+        return -1
+    if ext is not None and extension != ext:
+        return -1
+    digits = stem[len(FRAME_PREFIX):]
+    if not digits.isdigit():
+        return -1
+    return int(digits)
+
+
+def isShardFolder(name: str) -> bool:
+    return len(name) == SHARD_DIGITS and name.isdigit()
+
+
+def scanFrames(path: str, ext: str = "png"):
+    # Yields (frame number, filename) for every frame in the folder and its shard
+    # sub folders, in no particular order
+    if ext == STORE_EXTENSION or ext == ARCHIVE_EXTENSION:
+        numbers = ReelStore.storedFrames(path) if ext == STORE_EXTENSION else FrameArchive.archivedFrames(path)
+        for number in numbers:
+            yield number, framePath(path, number, ext)
+        return
+
+    try:
+        entries = os.scandir(path)
+    except FileNotFoundError:
+        return
+
+    with entries:
+        for entry in entries:
+            if isShardFolder(entry.name) and entry.is_dir():
+                with os.scandir(entry.path) as shard:
+                    for shard_entry in shard:
+                        number = frameNumber(shard_entry.name, ext)
+                        if number >= 0:
+                            yield number, shard_entry.path
+                continue
+
+            number = frameNumber(entry.name, ext)
+            if number >= 0:
+                yield number, entry.path
+
+
+def frameFiles(path: str, ext: str = "png", reverse: bool = False) -> list:
+    # All frames in frame number order
+    return [filename for _, filename in sorted(scanFrames(path, ext), reverse=reverse)]
+
+
+def frameNumbers(path: str, ext: str = "png") -> set:
+    # Frame numbers which already exist, for skipping work on resume without an
+    # os.path.exists call per frame
+    return set(number for number, _ in scanFrames(path, ext))
+
+
+def lastFrameNumber(path: str, ext: str = "png") -> int:
+    # Highest frame number in the folder, -1 if there are none
+    return max((number for number, _ in scanFrames(path, ext)), default=-1)
+
+
+def framePath(path: str, number: int, ext: str = "png", sharded: bool = None, create: bool = False) -> str:
+    # File name for a frame, create makes the shard sub folder if it doesn't exist
+    if sharded is None:
+        sharded = SHARDED
+    if ext == STORE_EXTENSION or ext == ARCHIVE_EXTENSION:
+        # All in one file, never sharded
+        sharded = False
+
+    name = "{0}{1:0{2}d}.{3}".format(FRAME_PREFIX, number, FRAME_DIGITS, ext)
+    if not sharded:
+        return os.path.join(path, name)
+
+    folder = os.path.join(path, "{0:0{1}d}".format(number//SHARD_SIZE, SHARD_DIGITS))
+    if create and folder not in _created_shards:
+        os.makedirs(folder, exist_ok=True)
+        _created_shards.add(folder)
+    return os.path.join(folder, name)
+
+
+def frameStat(filename: str):
+    # (size, modified time) of a frame, for frames in a reel store or archive as
+    # well as files.  Raises OSError if the frame doesn't exist
+    if filename.endswith("."+STORE_EXTENSION):
+        store = ReelStore.openStore(os.path.dirname(filename))
+        info = None if store is None else store.info(frameNumber(filename))
+        if info is None:
+            raise FileNotFoundError(filename)
+        return info
+    if filename.endswith("."+ARCHIVE_EXTENSION):
+        info = FrameArchive.archiveStat(os.path.dirname(filename), frameNumber(filename))
+        if info is None:
+            raise FileNotFoundError(filename)
+        return info
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime
+
+
+def frameExists(filename: str) -> bool:
+    try:
+        frameStat(filename)
+    except OSError:
+        return False
+    return True
+
+
+# Written by the scanners when capture finishes, tells a watching stage that no
+# more frames are coming
+END_OF_REEL_FILENAME = "END_OF_REEL"
+
+
+def markEndOfReel(path: str):
+    with open(os.path.join(path, END_OF_REEL_FILENAME), "w"):
+        pass
+
+
+def clearEndOfReel(path: str):
+    # Capture is starting (or resuming) on this reel
+    filename = os.path.join(path, END_OF_REEL_FILENAME)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def isEndOfReel(path: str) -> bool:
+    return os.path.exists(os.path.join(path, END_OF_REEL_FILENAME))
@@ -0,0 +1,143 @@
+# FrameWatcher.py
+#
+# Follows a capture folder whilst the scanner is still writing to it, so frames can
+# be processed as they arrive rather than once the whole reel has been captured.
+#
+# On Linux, if inotify_simple is installed (pip install inotify_simple), a frame is
+# picked up as soon as the scanner closes the file.  Otherwise (Windows, network
+# shares) the folder is polled, and a frame is finished once its size has stopped
+# changing between two polls.
+#
+# Watching stops when the scanner writes the end of reel marker (see FrameFiles.py)
+# or when no new frame has arrived for IDLE_TIMEOUT seconds.
+
+import os
+import time
+
+import FrameFiles
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Seconds between scans of the folder when polling
+POLL_INTERVAL = 2.0
+# Stop if no new frame has arrived for this many seconds
+IDLE_TIMEOUT = 600
+# Use polling even if inotify is available (inotify doesn't see changes made
+# over a network share)
+FORCE_POLLING = False
+
+
+class FrameWatcher:
+    def __init__(self, path: str, ext: str = "png", skip: set = None, idle_timeout: float = IDLE_TIMEOUT, poll_interval: float = POLL_INTERVAL):
+        self.path = path
+        self.ext = ext
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        # Frame numbers already returned (or to be ignored)
+        self.seen = set() if skip is None else set(skip)
+        # Frames found but not yet finished, filename to (frame number, last size)
+        self.pending = {}
+
+        self.inotify = None
+        self.folders = {}
+        # A reel store is one file which changes all the time, its index is polled
+        if INotify is not None and not FORCE_POLLING and ext != FrameFiles.STORE_EXTENSION:
+            self.inotify = INotify()
+            self.watchFolder(path)
+            for entry in os.scandir(path):
+                if FrameFiles.isShardFolder(entry.name) and entry.is_dir():
+                    self.watchFolder(entry.path)
+
+        # Frames already in the folder, the newest could still be being written
+        for number, filename in FrameFiles.scanFrames(path, ext):
+            if number not in self.seen:
+                self.pending[filename] = (number, -1)
+
+    def watchFolder(self, folder: str):
+        wd = self.inotify.add_watch(folder, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+        self.folders[wd] = folder
+
+    def finishedBySize(self) -> list:
+        # Pending frames whose size hasn't changed since the last check
+        finished = []
+        for filename, (number, last_size) in list(self.pending.items()):
+            try:
+                size = FrameFiles.frameStat(filename)[0]
+            except OSError:
+                del self.pending[filename]
+                continue
+            if size > 0 and size == last_size:
+                finished.append((number, filename))
+                del self.pending[filename]
+            else:
+                self.pending[filename] = (number, size)
+        return finished
+
+    def poll(self) -> list:
+        # Scan the folder for new frames, returns those which are finished
+        for number, filename in FrameFiles.scanFrames(self.path, self.ext):
+            if number not in self.seen and filename not in self.pending:
+                self.pending[filename] = (number, -1)
+        if self.ext == FrameFiles.STORE_EXTENSION:
+            # Only listed once they have been completely written
+            finished = [(number, filename) for filename, (number, _) in self.pending.items()]
+            self.pending.clear()
+            return finished
+        return self.finishedBySize()
+
+    def readEvents(self) -> list:
+        # Waits up to the poll interval for the scanner to finish writing frames
+        finished = []
+        for event in self.inotify.read(timeout=int(self.poll_interval*1000)):
+            filename = os.path.join(self.folders.get(event.wd, self.path), event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & flags.CREATE and FrameFiles.isShardFolder(event.name):
+                    self.watchFolder(filename)
+                    # Frames written before the watch was added
+                    for entry in os.scandir(filename):
+                        number = FrameFiles.frameNumber(entry.name, self.ext)
+                        if number >= 0 and number not in self.seen:
+                            self.pending[entry.path] = (number, -1)
+                continue
+            if event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                number = FrameFiles.frameNumber(event.name, self.ext)
+                if number >= 0:
+                    finished.append((number, filename))
+                    self.pending.pop(filename, None)
+
+        # Frames which were already there when watching started
+        return finished+self.finishedBySize()
+
+    def frames(self):
+        # Yields finished frames as they arrive, in frame number order within each batch
+        last_frame_time = time.monotonic()
+        first = True
+
+        while True:
+            if self.inotify is not None and not first:
+                finished = self.readEvents()
+            else:
+                finished = self.poll()
+                if self.inotify is not None:
+                    finished += self.readEvents()
+                else:
+                    time.sleep(self.poll_interval)
+            first = False
+
+            for number, filename in sorted(finished):
+                if number in self.seen:
+                    continue
+                self.seen.add(number)
+                last_frame_time = time.monotonic()
+                yield filename
+
+            if len(finished) == 0 and len(self.pending) == 0 and FrameFiles.isEndOfReel(self.path):
+                print("End of reel")
+                return
+
+            if time.monotonic()-last_frame_time > self.idle_timeout:
+                print("No new frames for", self.idle_timeout, "seconds, stopping")
+                return
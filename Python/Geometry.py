@@ -0,0 +1,152 @@
+# Geometry.py
+#
+# Optional correction of the captured frames for the scanner's geometry: a small
+# rotation of the film path (deskew), barrel distortion from the lens and keystone
+# (the sensor not quite parallel to the film).
+#
+# The settings are the same for every frame of a reel, so the whole correction is
+# turned into a pair of remap tables for the full sensor, built once and saved to
+# disk (next to the settings) for the next run and for the worker processes.  Each
+# frame then needs a single cv.remap, of only the output crop, by slicing the
+# tables to the crop rectangle.  The hole is still detected on the uncorrected
+# image, only its position is moved into corrected coordinates.
+#
+# Settings are kept in geometry.json in the capture folder:
+#   deskew      tilt of the film path to remove (degrees, see estimateDeskew)
+#   k1, k2      radial distortion (negative for barrel)
+#   p1, p2      tangential distortion
+#   keystone_x  perspective change across the width (per 1000 pixels)
+#   keystone_y  perspective change down the height (per 1000 pixels)
+#   focal       lens focal length in pixels, 0 uses the image width
+
+import cv2 as cv
+import json
+import numpy as np
+import os
+
+GEOMETRY_FILENAME = "geometry.json"
+MAPS_FILENAME = "geometry_maps.npz"
+
+DEFAULT_SETTINGS = {
+    "deskew": 0.0,
+    "k1": 0.0,
+    "k2": 0.0,
+    "p1": 0.0,
+    "p2": 0.0,
+    "keystone_x": 0.0,
+    "keystone_y": 0.0,
+    "focal": 0.0,
+}
+
+
+def estimateDeskew(rotations) -> float:
+    # Median tilt of the sproket holes (minAreaRect angles of their outlines), the
+    # holes are all square to the film so this is the film path's tilt
+    rotations = np.asarray(rotations, dtype=np.float64) % 90
+    rotations[rotations > 45] -= 90
+    if len(rotations) == 0:
+        return 0.0
+    return float(np.median(rotations))
+
+
+def loadSettings(filename: str) -> dict:
+    settings = dict(DEFAULT_SETTINGS)
+    with open(filename, "r") as f:
+        settings.update(json.load(f))
+    return settings
+
+
+def saveSettings(filename: str, settings: dict):
+    with open(filename, "w") as f:
+        json.dump(settings, f, indent=2)
+
+
+class GeometricCorrection:
+    def __init__(self, settings: dict, maps_filename: str = None):
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings)
+        self.maps_filename = maps_filename
+        self.size = None
+        self.maps = None
+
+    def __getstate__(self):
+        # Worker processes load the tables from disk rather than having them pickled
+        state = self.__dict__.copy()
+        state["size"] = None
+        state["maps"] = None
+        return state
+
+    def cameraModel(self, size):
+        # Camera matrix, distortion coefficients and the 3x3 transform (in normalised
+        # camera coordinates) which applies deskew and keystone
+        w, h = size
+        s = self.settings
+        focal = s["focal"] if s["focal"] > 0 else w
+        camera_matrix = np.array([[focal, 0, (w-1)/2], [0, focal, (h-1)/2], [0, 0, 1]], dtype=np.float64)
+        distortion = np.array([s["k1"], s["k2"], s["p1"], s["p2"]], dtype=np.float64)
+
+        # Rotation about the centre followed by keystone, in pixels
+        angle = np.deg2rad(-s["deskew"])
+        rotation = np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+        keystone = np.array([[1, 0, 0], [0, 1, 0], [s["keystone_x"]/1000, s["keystone_y"]/1000, 1]])
+        centre = np.array([[1, 0, (w-1)/2], [0, 1, (h-1)/2], [0, 0, 1]])
+        homography = centre @ keystone @ rotation @ np.linalg.inv(centre)
+
+        transform = np.linalg.inv(camera_matrix) @ homography @ camera_matrix
+        return camera_matrix, distortion, transform
+
+    def key(self, size) -> str:
+        # Identifies the tables saved on disk, so changing a setting rebuilds them
+        return json.dumps({"size": list(size), "settings": self.settings}, sort_keys=True)
+
+    def buildMaps(self, size):
+        camera_matrix, distortion, transform = self.cameraModel(size)
+        map1, map2 = cv.initUndistortRectifyMap(camera_matrix, distortion, transform, camera_matrix, size, cv.CV_32FC1)
+        # Fixed point tables are smaller and remap faster
+        return cv.convertMaps(map1, map2, cv.CV_16SC2)
+
+    def loadMaps(self, size):
+        if self.size == size:
+            return self.maps
+
+        key = self.key(size)
+        maps = None
+        if self.maps_filename is not None and os.path.exists(self.maps_filename):
+            with np.load(self.maps_filename) as data:
+                if str(data["key"]) == key:
+                    maps = (data["map1"], data["map2"])
+
+        if maps is None:
+            print("Building geometry correction tables", size[0], "x", size[1])
+            maps = self.buildMaps(size)
+            if self.maps_filename is not None:
+                # One per process, in case several build the tables at once
+                temp_filename = "{0}.{1}.tmp".format(self.maps_filename, os.getpid())
+                np.savez(temp_filename, key=key, map1=maps[0], map2=maps[1])
+                os.replace(temp_filename + ".npz", self.maps_filename)
+
+        self.size = size
+        self.maps = maps
+        return maps
+
+    def correctPoint(self, point, size):
+        # Position of an uncorrected image point in the corrected image
+        camera_matrix, distortion, transform = self.cameraModel(size)
+        corrected = cv.undistortPoints(np.array([[point]], dtype=np.float64), camera_matrix, distortion, R=transform, P=camera_matrix)
+        return float(corrected[0, 0, 0]), float(corrected[0, 0, 1])
+
+    def crop(self, image, tl, br):
+        # Corrected image for the rectangle tl-br (corrected coordinates), areas
+        # outside the sensor are black
+        h, w = image.shape[:2]
+        map1, map2 = self.loadMaps((w, h))
+
+        x1, y1 = max(tl[0], 0), max(tl[1], 0)
+        x2, y2 = min(br[0], w), min(br[1], h)
+        if (x1, y1, x2, y2) == (tl[0], tl[1], br[0], br[1]):
+            return cv.remap(image, map1[y1:y2, x1:x2], map2[y1:y2, x1:x2], cv.INTER_LINEAR)
+
+        output = np.zeros((br[1]-tl[1], br[0]-tl[0])+image.shape[2:], image.dtype)
+        if x2 > x1 and y2 > y1:
+            output[y1-tl[1]:y2-tl[1], x1-tl[0]:x2-tl[0]] = cv.remap(image, map1[y1:y2, x1:x2], map2[y1:y2, x1:x2], cv.INTER_LINEAR)
+        return output
@@ -0,0 +1,72 @@
+# GroundTruth.py
+#
+# Sproket hole positions confirmed while aligning, kept as a labelled set of frames to
+# measure the detection engines against (see Benchmark_GroundTruth.py).
+#
+# Rows are appended to ground_truth.csv in the capture folder, with one of two labels:
+#   operator  the hole was shown in the adjustment window and the operator moved it
+#             (cursor keys, 2/4/6/8, r) and/or accepted it with SPACE
+#   accepted  detected and accepted without asking (the right size, inside the
+#             learned box).  Only as good as the engine which found it
+# Where the engine first put the hole is also kept (when it ran), so the size of each
+# correction is known.  Frames given a headless fallback position aren't recorded,
+# nobody has checked them.
+
+import csv
+import os
+
+import FrameFiles
+from DetectionCache import SOURCE_DETECTED, SOURCE_OPERATOR
+
+GROUND_TRUTH_FILENAME = "ground_truth.csv"
+
+LABEL_OPERATOR = "operator"
+LABEL_ACCEPTED = "accepted"
+
+LABELS = {
+    SOURCE_OPERATOR: LABEL_OPERATOR,
+    SOURCE_DETECTED: LABEL_ACCEPTED,
+}
+
+FIELDS = ["filename", "label", "tl_x", "tl_y", "br_x", "br_y",
+          "detected_tl_x", "detected_tl_y", "detected_br_x", "detected_br_y", "threshold", "detector"]
+INTEGER_FIELDS = ["tl_x", "tl_y", "br_x", "br_y", "detected_tl_x", "detected_tl_y", "detected_br_x", "detected_br_y", "threshold"]
+
+
+class GroundTruth:
+    def __init__(self, folder: str):
+        self.filename = os.path.join(folder, GROUND_TRUTH_FILENAME)
+        self.pending = []
+
+    def add(self, path: str, result: dict):
+        # result is the dictionary filled in by processImage
+        label = LABELS.get(result.get("source"))
+        if label is None:
+            return
+        row = {f: result.get(f, "") for f in FIELDS}
+        row["filename"] = os.path.abspath(path)
+        row["label"] = label
+        self.pending.append(row)
+
+    def save(self):
+        if len(self.pending) == 0:
+            return
+        new_file = not os.path.exists(self.filename)
+        with open(self.filename, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(self.pending)
+        self.pending = []
+
+
+def loadGroundTruth(filename: str) -> list:
+    # One row per frame, the latest wins if a frame was labelled more than once.
+    # Frames which no longer exist are dropped
+    rows = {}
+    with open(filename, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            for field in INTEGER_FIELDS:
+                row[field] = int(row[field]) if row[field] != "" else None
+            rows[row["filename"]] = row
+    return [row for row in rows.values() if FrameFiles.frameExists(row["filename"])]
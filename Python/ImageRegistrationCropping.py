@@ -4,23 +4,129 @@ from typing import TYPE_CHECKING, List
 import cv2 as cv
 import numpy as np
 import os
-import glob
-import shutil
+import time
 import traceback
 
+import csv
+import json
 import queue
-from threading import Thread
+import multiprocessing
+from threading import Lock, Thread
+
+from Preview import PreviewThread, gui_lock
+from DetectionCache import DetectionCache, SOURCE_DETECTED, SOURCE_OPERATOR, SOURCE_FALLBACK
+import Trajectory
+import Geometry
+from FineRegistration import FineRegistration
+import FrameFiles
+from FrameWatcher import FrameWatcher
+import StripSidecar
+from GroundTruth import GroundTruth
+import FrameEncoders
+from VideoSink import VideoSink
 
 NUM_THREADS = 2
 
+# Number of worker processes used to align a reel, 1 keeps the original single loop.
+# Each process takes a range of frames, so set this to the number of CPU cores
+NUM_PROCESSES = 1
+# Frames aligned one at a time (in this process) before the reel is split across
+# the workers, this lets the operator confirm the start of the reel and teaches
+# the learned bounding box what good frames look like
+SEED_FRAMES = 25
+# Never stop and wait for the operator, doubtful frames are given a fallback position
+# and logged to the triage file (in the output folder) for a later review pass
+HEADLESS = False
+# "align" works through the reel, "review" steps through the frames in the triage file,
+# "stabilize" smooths the cached hole positions of the whole reel (see Trajectory.py),
+# "watch" aligns frames as they are captured (see FrameWatcher.py),
+# "detect" fills the detection cache from the scanner's strip sidecars (see StripSidecar.py)
+MODE = "align"
+# How far (pixels) around the hole position logged by the scanner the "detect" pass searches
+CAPTURE_SEED_PADDING = 80
+# Crop using the smoothed positions from the "stabilize" pass, when available
+STABILIZE = True
+# In headless mode, how far (pixels) a hole may be outside the learned bounding box and
+# still be accepted (growing the box), as there is no operator to confirm it
+HEADLESS_BOX_MARGIN = 12
+# Other thresholds to try (relative to lower_t) when a frame is doubtful
+FALLBACK_THRESHOLD_STEPS = [-5, 5, -10, 10, -20, 20]
+TRIAGE_FILENAME = "triage.csv"
+TRIAGE_FIELDS = ["filename","reason","method","confidence","tl_x","tl_y","br_x","br_y","lower_t"]
+# Sproket hole detection engine, "contour" (original), "profile" or "pyramid" (faster)
+# or "template"
+DETECTOR = "contour"
+# Pyramid engine searches at 1/4 (2 levels) or 1/8 (3 levels) scale first
+PYRAMID_LEVELS = 2
+# Template engine, film base (pixels) around the hole in the template, the scale it
+# searches at first and the lowest match score (0 to 1) accepted
+TEMPLATE_MARGIN = 24
+TEMPLATE_SCALE = 4
+TEMPLATE_MIN_SCORE = 0.5
+# Width and height of the hole the template engine looks for, set from the calibration
+template_size = (250, 313)
+# Only search for the hole in a window around its predicted position, falling back
+# to the whole strip if it isn't found there
+TRACKING = False
+# Pixels added around the predicted hole to make the search window
+TRACKING_PADDING = 40
+# Gains for the constant velocity (alpha-beta) filter which predicts the next position
+TRACKING_ALPHA = 0.6
+TRACKING_BETA = 0.1
+# How lower_t is chosen for each frame.  "manual" keeps the value (adjust with , and . in
+# the adjustment window), "otsu" and "percentile" derive it from the strip's histogram and
+# "search" tries a few thresholds and keeps the one which best matches the calibrated hole
+THRESHOLD_MODE = "manual"
+# Thresholds tried (relative to lower_t) by the "search" mode, as well as otsu and percentile
+THRESHOLD_SEARCH_STEPS = [0, -5, 5, -10, 10, -20, 20]
+# The "percentile" mode assumes this much more of the strip is bright than the hole itself
+THRESHOLD_AREA_SCALE = 1.3
+# Measure the sproket hole size automatically (instead of scanImages) the first time a reel
+# is aligned, the results are saved in the input folder and reused on later runs
+AUTO_CALIBRATE = True
+CALIBRATION_FILENAME = "calibration.json"
+# Frames (spread evenly across the reel) measured by the calibration
+CALIBRATION_SAMPLES = 64
+CALIBRATION_THRESHOLD = 205
+# Correct deskew, lens distortion and keystone (settings in geometry.json in the input
+# folder, estimated the first time, see Geometry.py)
+GEOMETRY_CORRECTION = False
+# The GeometricCorrection, when turned on
+geometry = None
+# Remove the remaining jitter by lining up the picture of each frame with the frames
+# before it, after cropping at the sproket hole (see FineRegistration.py)
+FINE_REGISTRATION = False
+# The FineRegistration, when turned on
+fine_registration = None
+# Frame dimensions - this will need to be altered on every scan
+# perhaps enhance the GUI to use mouse coordinates?
+# Negative offset X,Y (from the top left of the sproket hole) and then W,H
+# W and H even!
+FRAME_DIMS = (220, -440, 1650, 1200)
+# File format of the aligned frames, see FrameEncoders.py.  The captured frames are
+# read in whichever format the scanner saved them
+OUTPUT_FORMAT = "png:1"
+# Also send the aligned frames straight into ffmpeg to make this video (in the output
+# folder), see VideoSink.py.  None for frames only
+VIDEO_FILENAME = None
+# Save each aligned frame as an image, can be turned off when making a video
+SAVE_FRAMES = True
+# Show the OpenCV debug windows (turned off inside worker processes)
+show_windows = True
+# Preview windows are updated by a separate thread, at most this many times per second
+PREVIEW_FPS = 4
+# The PreviewThread, when previews are being shown
+preview = None
+# Only one worker process at a time is allowed to ask the operator for help
+prompt_lock = None
+
 q = queue.Queue(maxsize=10)
 
 def ServiceImageWriteQueue(q):
     while True:
         data=q.get(block=True, timeout=None)
 
-        if cv.imwrite(data["filename"], data["image"], [cv.IMWRITE_PNG_COMPRESSION,1])==False:
-            raise IOError("Failed to save image")
+        FrameEncoders.writeFrame(data["filename"], data["image"], OUTPUT_FORMAT)
 
         q.task_done()
 
@@ -49,7 +155,17 @@ def ImageFolder() -> str:
     return path
 
 def Filelist(path: str, ext: str) -> int:
-    return sorted(glob.glob(os.path.join(path, "frame_????????."+ext)), reverse=False)
+    return FrameFiles.frameFiles(path, ext)
+
+def unalignedFiles(files:List, output_path:str) -> List:
+    # Input frames with no output frame yet, from one scan of the output folder
+    # rather than checking for every file
+    done=FrameFiles.frameNumbers(output_path, FrameEncoders.extension(OUTPUT_FORMAT))
+    return [f for f in files if FrameFiles.frameNumber(f) not in done]
+
+def outputFilename(output_path:str, filename:str) -> str:
+    # Aligned frame for a captured frame, in OUTPUT_FORMAT
+    return FrameFiles.framePath(output_path, FrameFiles.frameNumber(filename), ext=FrameEncoders.extension(OUTPUT_FORMAT), create=True)
 
 # For Details Reference Link:
 # http://stackoverflow.com/questions/46036477/drawing-fancy-rectangle-around-face
@@ -78,21 +194,97 @@ def draw_border(img, pt1, pt2, color, thickness, r, d):
     #cv.ellipse(img, (x2 - r, y2 - r), (r, r), 0, 0, 90, color, thickness)
 
 
-def detectSproket(sproket_image, lower_threshold:int=210):
+def grayImage(image):
+    # Strips from the capture sidecar are already gray
+    if image.ndim==2:
+        return image
+    return cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+
+def thresholdSproketStrip(sproket_image, lower_threshold:int=210):
     # Convert to gray and blur
     matrix = (3, 7)
     sproket_image = cv.GaussianBlur(sproket_image, matrix, 0)
-    
-    sproket_image = cv.cvtColor(sproket_image, cv.COLOR_BGR2GRAY)
+
+    sproket_image = grayImage(sproket_image)
 
     sproket_image = cv.equalizeHist(sproket_image)
     # Threshold
-    _, sproket_image = cv.threshold(sproket_image, lower_threshold, 255, cv.THRESH_BINARY)    
-    kernel = cv.getStructuringElement(cv.MORPH_RECT, (100, 100))
-    sproket_image = cv.morphologyEx(sproket_image, cv.MORPH_OPEN, kernel)
+    _, sproket_image = cv.threshold(sproket_image, lower_threshold, 255, cv.THRESH_BINARY)
+    return sproket_image
+
+def showPreview(name:str, image, scale:float=0.4):
+    # Hand the image to the preview thread (which decides if it is time for an update)
+    if preview is not None:
+        preview.show(name, image, scale)
+
+# Structuring elements by size, they never change so are only built once
+_kernels = {}
+
+def structuringElement(kernel_size:int):
+    kernel=_kernels.get(kernel_size)
+    if kernel is None:
+        kernel=cv.getStructuringElement(cv.MORPH_RECT, (kernel_size, kernel_size))
+        _kernels[kernel_size]=kernel
+    return kernel
+
+def openMask(mask, kernel_size:int):
+    # The same as cv.morphologyEx(mask, cv.MORPH_OPEN, structuringElement(kernel_size)) for
+    # a 0/255 mask, but built from running sums (box filters) so it costs the same for
+    # any kernel size, where the erode and dilate cost grows with it.
+    # Eroded where there is no dark pixel in the kernel (outside the image counts as bright)
+    dark=cv.threshold(mask, 0, 1, cv.THRESH_BINARY_INV)[1]
+    dark=cv.boxFilter(dark, cv.CV_16U, (kernel_size, kernel_size), normalize=False, borderType=cv.BORDER_CONSTANT)
+    eroded=(dark==0).view(np.uint8)
+    # Then dilated, set where any eroded pixel is in the kernel
+    lit=cv.boxFilter(eroded, cv.CV_16U, (kernel_size, kernel_size), normalize=False, borderType=cv.BORDER_CONSTANT)
+    return cv.compare(lit, 0, cv.CMP_GT)
+
+class DetectionWorkspace:
+    # Image buffers for detectSproket, kept from frame to frame so the blur, gray,
+    # equalized, threshold and open steps write into the same memory every time
+    # rather than allocating new images.  After the blur everything works in place on
+    # one gray buffer.  Reallocated only if the strip size changes.
+    # Not thread safe, use one per thread
+    def __init__(self):
+        self.shape=None
+
+    def allocate(self, shape):
+        if self.shape==shape:
+            return
+        # Gray strips (from the capture sidecar) are blurred straight into the gray buffer
+        self.blur=np.empty(shape, np.uint8) if len(shape)==3 else None
+        self.gray=np.empty(shape[:2], np.uint8)
+        self.shape=shape
+
+    def threshold(self, sproket_image, lower_threshold:int=210):
+        # Same as thresholdSproketStrip, the result is only valid until the next call
+        self.allocate(sproket_image.shape)
+        if self.blur is None:
+            cv.GaussianBlur(sproket_image, (3, 7), 0, dst=self.gray)
+        else:
+            cv.GaussianBlur(sproket_image, (3, 7), 0, dst=self.blur)
+            cv.cvtColor(self.blur, cv.COLOR_BGR2GRAY, dst=self.gray)
+        cv.equalizeHist(self.gray, dst=self.gray)
+        cv.threshold(self.gray, lower_threshold, 255, cv.THRESH_BINARY, dst=self.gray)
+        return self.gray
+
+    def open(self, mask, kernel_size:int=100):
+        cv.morphologyEx(mask, cv.MORPH_OPEN, structuringElement(kernel_size), dst=mask)
+        return mask
+
+# Used by detectSproket when no workspace is given (each worker process has its own)
+detection_workspace = DetectionWorkspace()
 
-    cv.imshow("sproket_image",cv.resize(sproket_image, (0,0), fx=0.4, fy=0.4))
+def detectSproket(sproket_image, lower_threshold:int=210, kernel_size:int=100, workspace:DetectionWorkspace=None):
+    if workspace is None:
+        workspace=detection_workspace
+    sproket_image = workspace.open(workspace.threshold(sproket_image, lower_threshold), kernel_size)
 
+    showPreview("sproket_image", sproket_image)
+
+    return sproketFromMask(sproket_image)
+
+def sproketFromMask(sproket_image):
     # Detect the sproket shape
     contours, _ = cv.findContours(sproket_image, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
 
@@ -104,7 +296,7 @@ def detectSproket(sproket_image, lower_threshold:int=210):
         return (455, 646), (455, 646),1,1, 0, 1, len(contours)
 
     # Sort by area, largest first (hopefully our sproket - we should only have 1 full sprocket in view at any 1 time)
-    contour = sorted(contours, key=lambda x: cv.contourArea(x), reverse=True)[0]      
+    contour = max(contours, key=cv.contourArea)
 
     #colour = (100, 100, 100)
     #cv.drawContours(sproket_image, [contour], -1,color=colour, thickness=cv.FILLED)
@@ -115,19 +307,13 @@ def detectSproket(sproket_image, lower_threshold:int=210):
     centre = rect[0]
     # Gets center of rotated rectangle
     box = cv.boxPoints(rect)
-    # Convert dimensions to ints
-    box = np.int0(box)
 
     #print("area",area)
     #print("rotation",rotation)
 
-    a=min(box[0][0],box[1][0],box[2][0],box[3][0])
-    b=min(box[0][1],box[1][1],box[2][1],box[3][1])
-    top_left_of_sproket_hole=(a,b)
-
-    a=max(box[0][0],box[1][0],box[2][0],box[3][0])
-    b=max(box[0][1],box[1][1],box[2][1],box[3][1])
-    bottom_right_of_sproket_hole=(a,b)
+    # Convert dimensions to ints (truncating, the same as np.int0 of each corner)
+    top_left_of_sproket_hole=(int(box[:,0].min()),int(box[:,1].min()))
+    bottom_right_of_sproket_hole=(int(box[:,0].max()),int(box[:,1].max()))
     #cv.drawContours(sproket_image, [box], -1,color=(200, 0, 0), thickness=2)
 
     # Check for vertical stretch
@@ -141,8 +327,215 @@ def detectSproket(sproket_image, lower_threshold:int=210):
 
     return top_left_of_sproket_hole, bottom_right_of_sproket_hole,width_of_sproket_hole,height_of_sproket_hole, rotation, area, len(contours)
 
+def equalizeLut(gray_image):
+    # The lookup table cv.equalizeHist would use for this image, so the same mapping
+    # can be applied to part of a larger image
+    hist=cv.calcHist([gray_image],[0],None,[256],[0,256]).ravel()
+    cdf=hist.cumsum()
+    cdf_min=cdf[np.flatnonzero(hist)[0]]
+    if cdf[-1]==cdf_min:
+        return np.arange(256, dtype=np.uint8)
+    return np.clip(np.round((cdf-cdf_min)*255/(cdf[-1]-cdf_min)),0,255).astype(np.uint8)
+
+def detectSproketPyramid(sproket_image, lower_threshold:int=210):
+    # Coarse to fine version of detectSproket.  The hole is found on a 1/4 (or 1/8) scale
+    # copy of the strip, then the corners are refined at full resolution using only a
+    # small window around the coarse estimate.  Returns the same tuple as detectSproket.
+    # About 7x faster than detectSproket on a 12MP capture (6ms vs 42ms a strip), most of
+    # what is left is making the gray copy of the whole strip and scaling it down
+    scale=2**PYRAMID_LEVELS
+
+    gray=grayImage(sproket_image)
+    small=gray
+    for _ in range(PYRAMID_LEVELS):
+        small=cv.pyrDown(small)
+
+    # pyrDown has already smoothed the image, so only equalize and threshold
+    lut=equalizeLut(small)
+    _, mask = cv.threshold(cv.LUT(small, lut), lower_threshold, 255, cv.THRESH_BINARY)
+    mask = cv.morphologyEx(mask, cv.MORPH_OPEN, structuringElement(max(3, 100//scale)))
+
+    showPreview("sproket_image", mask, 0.4*scale)
+
+    coarse=sproketFromMask(mask)
+    number_of_contours=coarse[6]
+    if number_of_contours==0:
+        return coarse
+
+    # Window around the estimate (in full resolution pixels), with enough padding to
+    # cover the error from the coarse level
+    h, w =gray.shape[:2]
+    padding=2*scale+2
+    x1=max(0, coarse[0][0]*scale-padding)
+    y1=max(0, coarse[0][1]*scale-padding)
+    x2=min(w, (coarse[1][0]+1)*scale+padding)
+    y2=min(h, (coarse[1][1]+1)*scale+padding)
+
+    # Same processing as detectSproket, but equalized using the whole strip's histogram
+    window = cv.GaussianBlur(gray[y1:y2, x1:x2], (3, 7), 0)
+    _, window = cv.threshold(cv.LUT(window, lut), lower_threshold, 255, cv.THRESH_BINARY)
+    window = openMask(window, 100)
+
+    fine=sproketFromMask(window)
+    if fine[6]==0:
+        # Lost it at full resolution, scale up the coarse result instead
+        tl=(coarse[0][0]*scale, coarse[0][1]*scale)
+        br=(coarse[1][0]*scale, coarse[1][1]*scale)
+        return tl, br, br[0]-tl[0], br[1]-tl[1], coarse[4], coarse[5]*scale*scale, number_of_contours
+
+    top_left_of_sproket_hole=(fine[0][0]+x1, fine[0][1]+y1)
+    bottom_right_of_sproket_hole=(fine[1][0]+x1, fine[1][1]+y1)
+    return top_left_of_sproket_hole, bottom_right_of_sproket_hole, fine[2], fine[3], fine[4], fine[5], number_of_contours
+
+def longestRun(values):
+    # Start and end (exclusive) of the longest run of True values
+    edges=np.diff(np.concatenate(([0], values.astype(np.int8), [0])))
+    starts=np.flatnonzero(edges==1)
+    ends=np.flatnonzero(edges==-1)
+    if len(starts)==0:
+        return 0, 0
+    longest=np.argmax(ends-starts)
+    return int(starts[longest]), int(ends[longest])
+
+def subPixelEdge(profile, index:int, rising:bool) -> float:
+    # Position where the profile crosses 0.5, interpolated between index-1 and index.
+    # For a clean step this is the boundary between the two pixels (index-0.5)
+    if index<=0 or index>=len(profile):
+        return index-0.5
+    a=profile[index-1]
+    b=profile[index]
+    if a==b:
+        return index-0.5
+    return index-1+(0.5-a)/(b-a)
+
+def detectSproketProfile(sproket_image, lower_threshold:int=210):
+    # Faster alternative to detectSproket.  Instead of a morphological open and a contour
+    # search, the hole edges are found from the row and column profiles (fraction of
+    # bright pixels) of the thresholded strip.  Returns the same tuple as detectSproket
+    sproket_image = thresholdSproketStrip(sproket_image, lower_threshold)
+
+    showPreview("sproket_image", sproket_image)
+
+    mask=sproket_image.astype(np.float32)*(1/255)
+    h, w =mask.shape[:2]
+
+    # Hole rows stand out above any bright picture area which is also in the strip
+    rows=mask.mean(axis=1)
+    baseline=float(np.median(rows))
+    peak=float(rows.max())
+    if peak-baseline<0.1:
+        #Return a fake reading (hard coded)
+        return (455, 646), (455, 646),1,1, 0, 1, 0
+
+    y1, y2=longestRun(rows>(baseline+peak)/2)
+    hole_h=y2-y1
+
+    # Columns which are bright in the hole rows, but dark in the rows just above and
+    # below the hole, belong to the hole.  Bright picture areas are bright in both
+    inside=mask[y1:y2].mean(axis=0)
+    outside=np.concatenate((mask[max(0,y1-hole_h):y1], mask[y2:y2+hole_h]))
+    if len(outside)>0:
+        columns=inside-outside.mean(axis=0)
+    else:
+        columns=inside
+    x1, x2=longestRun(columns>0.5)
+    if x2-x1==0:
+        return (455, 646), (455, 646),1,1, 0, 1, 0
+
+    # Now the columns are known, measure the rows again using just the hole
+    rows=mask[:, x1:x2].mean(axis=1)
+    y1, y2=longestRun(rows>0.5)
+
+    # Sub-pixel edges, then back to the pixel coordinates detectSproket uses
+    # (first and last pixel inside the hole)
+    left=subPixelEdge(columns, x1, True)+0.5
+    right=subPixelEdge(columns, x2, False)-0.5
+    top=subPixelEdge(rows, y1, True)+0.5
+    bottom=subPixelEdge(rows, y2, False)-0.5
+
+    top_left_of_sproket_hole=(int(round(left)),int(round(top)))
+    bottom_right_of_sproket_hole=(int(round(right)),int(round(bottom)))
+    width_of_sproket_hole=bottom_right_of_sproket_hole[0]-top_left_of_sproket_hole[0]
+    height_of_sproket_hole=bottom_right_of_sproket_hole[1]-top_left_of_sproket_hole[1]
+
+    # Rotation from the slope of the left hand edge (middle of the hole only, to avoid the rounded corners)
+    rotation=90.0
+    band=mask[y1+hole_h//4:y2-hole_h//4, max(0,x1-10):x1+(x2-x1)//2]
+    if band.shape[0]>2 and band.shape[1]>0:
+        edge=np.argmax(band>0.5, axis=1)
+        slope=np.polyfit(np.arange(len(edge)), edge, 1)[0]
+        rotation=float(90.0+np.degrees(np.arctan(slope)))
+
+    area=float(width_of_sproket_hole*height_of_sproket_hole)
+
+    return top_left_of_sproket_hole, bottom_right_of_sproket_hole,width_of_sproket_hole,height_of_sproket_hole, rotation, area, 1
+
+# Hole shaped templates by size and margin, built once
+_templates = {}
+
+def sproketTemplate(size, margin:int):
+    # White hole (size is w, h) surrounded by margin pixels of black film base
+    key=(size, margin)
+    template=_templates.get(key)
+    if template is None:
+        template=np.zeros((size[1]+2*margin, size[0]+2*margin), np.uint8)
+        template[margin:margin+size[1], margin:margin+size[0]]=255
+        _templates[key]=template
+    return template
+
+def detectSproketTemplate(sproket_image, lower_threshold:int=210):
+    # Normalised cross correlation of the thresholded strip with a hole of the calibrated
+    # size (template_size), at 1/TEMPLATE_SCALE scale first and then at full resolution
+    # in a small window around the best match.  The hole returned is always exactly
+    # template_size.  Returns the same tuple as detectSproket
+    mask = thresholdSproketStrip(sproket_image, lower_threshold)
+
+    showPreview("sproket_image", mask)
+
+    w, h =template_size
+    scale=TEMPLATE_SCALE
+    small=cv.resize(mask, (0,0), fx=1/scale, fy=1/scale, interpolation=cv.INTER_AREA)
+    small_template=sproketTemplate((w//scale, h//scale), TEMPLATE_MARGIN//scale)
+    if small.shape[0]<small_template.shape[0] or small.shape[1]<small_template.shape[1]:
+        #Return a fake reading (hard coded)
+        return (455, 646), (455, 646),1,1, 0, 1, 0
+
+    _, score, _, location = cv.minMaxLoc(cv.matchTemplate(small, small_template, cv.TM_CCOEFF_NORMED))
+    if score<TEMPLATE_MIN_SCORE:
+        return (455, 646), (455, 646),1,1, 0, 1, 0
+
+    # Refine at full resolution, the coarse match is within a couple of small pixels
+    template=sproketTemplate((w, h), TEMPLATE_MARGIN)
+    template_h, template_w =template.shape
+    mask_h, mask_w =mask.shape
+    x1=min(max(0, location[0]*scale-2*scale), max(0, mask_w-template_w))
+    y1=min(max(0, location[1]*scale-2*scale), max(0, mask_h-template_h))
+    x2=min(mask_w, x1+template_w+4*scale)
+    y2=min(mask_h, y1+template_h+4*scale)
+    if x2-x1<template_w or y2-y1<template_h:
+        return (455, 646), (455, 646),1,1, 0, 1, 0
+    _, score, _, location = cv.minMaxLoc(cv.matchTemplate(mask[y1:y2, x1:x2], template, cv.TM_CCOEFF_NORMED))
+
+    top_left_of_sproket_hole=(x1+location[0]+TEMPLATE_MARGIN, y1+location[1]+TEMPLATE_MARGIN)
+    bottom_right_of_sproket_hole=(top_left_of_sproket_hole[0]+w, top_left_of_sproket_hole[1]+h)
+    area=float(cv.countNonZero(mask[top_left_of_sproket_hole[1]:bottom_right_of_sproket_hole[1], top_left_of_sproket_hole[0]:bottom_right_of_sproket_hole[0]]))
+
+    return top_left_of_sproket_hole, bottom_right_of_sproket_hole, w, h, 90.0, area, 1
+
+# Sproket hole detection engines, selected with DETECTOR.  All return the same tuple
+SPROKET_DETECTORS = {
+    "contour": detectSproket,
+    "profile": detectSproketProfile,
+    "pyramid": detectSproketPyramid,
+    "template": detectSproketTemplate,
+}
+
+def findSproket(sproket_image, lower_threshold:int=210):
+    return SPROKET_DETECTORS[DETECTOR](sproket_image, lower_threshold)
+
 def cropOriginalImage(image):
-    return image.copy()
+    # Returns a view, nothing draws on the original image
+    return image
     #y1=140
     #y2=y1+2000
     #return image[y1:y2,150:2900].copy()
@@ -157,7 +550,7 @@ def scanImageForAverageCalculations(image):
     #Original image is 3556x2381
     y1=int(h*0.2)
     y2=int(h*0.8)
-    top_left_of_sproket_hole, bottom_right_of_sproket_hole,width_of_sproket_hole,height_of_sproket_hole, rotation, area, number_of_contours=detectSproket(image[y1:y2,0:int(w*0.20)],lower_threshold=205)
+    top_left_of_sproket_hole, bottom_right_of_sproket_hole,width_of_sproket_hole,height_of_sproket_hole, rotation, area, number_of_contours=findSproket(image[y1:y2,0:int(w*0.20)],lower_threshold=205)
 
     cv.waitKey(15)
 
@@ -165,8 +558,9 @@ def scanImageForAverageCalculations(image):
     if number_of_contours<10 and (rotation==0.0 or rotation==90.0 or (rotation>0 and rotation<1)):
         top_left_of_sproket_hole=(top_left_of_sproket_hole[0],y1+top_left_of_sproket_hole[1])
         bottom_right_of_sproket_hole=(bottom_right_of_sproket_hole[0],y1+bottom_right_of_sproket_hole[1])
-        cv.rectangle(image, top_left_of_sproket_hole, bottom_right_of_sproket_hole, (0,0,255), 2)
+        # image is a view of the original, so draw on the thumbnail
         thumbnail=cv.resize(image, (0,0), fx=0.4, fy=0.4)
+        cv.rectangle(thumbnail, (int(top_left_of_sproket_hole[0]*0.4),int(top_left_of_sproket_hole[1]*0.4)), (int(bottom_right_of_sproket_hole[0]*0.4),int(bottom_right_of_sproket_hole[1]*0.4)), (0,0,255), 2)
         return thumbnail, width_of_sproket_hole,height_of_sproket_hole, area
 
     return None, None,None,None
@@ -186,7 +580,7 @@ def scanImages(files:List, maximum_number_of_samples:int=32):
         if average_sample_count>maximum_number_of_samples:
             break
 
-        img = cv.imread(filename,cv.IMREAD_UNCHANGED)
+        img = FrameEncoders.readFrame(filename,cv.IMREAD_UNCHANGED)
         if img is None:
             print("Error reading",filename)
         else:
@@ -229,23 +623,373 @@ def scanImages(files:List, maximum_number_of_samples:int=32):
 
     return average_sample_count,average_width,average_height,average_area
 
-min_x=999999
-max_x=0
-min_y=999999
-max_y=0
-lower_t=225
-previous_frame_top_left_of_sproket_hole=None
-previous_frame_bottom_right_of_sproket_hole=None
+def loadSproketStrip(filename:str):
+    # The strip processImage searches for the hole, from the sidecar written by the
+    # scanner (see StripSidecar.py) if there is one, otherwise cut from the frame
+    strip=StripSidecar.loadStrip(filename)
+    if strip is not None:
+        return strip
+
+    img = FrameEncoders.readFrame(filename,cv.IMREAD_UNCHANGED)
+    if img is None:
+        print("Error reading",filename)
+        return None
+    h, w =img.shape[:2]
+    return img[0:h,0:int(w*0.205)]
+
+def measureSproket(filename:str):
+    # Unattended version of scanImageForAverageCalculations, used by autoCalibrate.
+    # Returns width, height and area of the hole, or None if the frame isn't suitable
+    sproket_strip=loadSproketStrip(filename)
+    if sproket_strip is None:
+        return None
+
+    h =sproket_strip.shape[0]
+    y1=int(h*0.2)
+    y2=int(h*0.8)
+    # The template engine can only find holes of the size it is given
+    measure=detectSproket if DETECTOR=="template" else findSproket
+    top_left_of_sproket_hole, bottom_right_of_sproket_hole,width_of_sproket_hole,height_of_sproket_hole, rotation, area, number_of_contours=measure(sproket_strip[y1:y2],lower_threshold=CALIBRATION_THRESHOLD)
+
+    # Same rules as scanImageForAverageCalculations, a single shape with no rotation
+    if number_of_contours==0 or number_of_contours>=10:
+        return None
+    if abs(((rotation+45)%90)-45)>=1:
+        return None
+
+    return width_of_sproket_hole, height_of_sproket_hole, area
+
+def measureSproketTilt(filename:str):
+    # Angle of the hole's outline (minAreaRect), taken from the thresholded image around
+    # the detected hole as the morphological open in detectSproket squares it off.
+    # Returns None if the frame isn't suitable
+    sproket_strip=loadSproketStrip(filename)
+    if sproket_strip is None:
+        return None
+
+    tl, br, _, _, _, _, number_of_contours=findSproket(sproket_strip, CALIBRATION_THRESHOLD)
+    if number_of_contours==0 or number_of_contours>=10:
+        return None
+
+    padding=10
+    window=sproket_strip[max(tl[1]-padding,0):br[1]+padding, max(tl[0]-padding,0):br[0]+padding]
+    contours, _ = cv.findContours(thresholdSproketStrip(window, CALIBRATION_THRESHOLD), cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+    if len(contours)==0:
+        return None
+    return cv.minAreaRect(max(contours, key=cv.contourArea))[2]
+
+def calibrationSamples(files:List, number_of_samples:int) -> List:
+    # Frames spread evenly across the whole reel
+    indexes=np.unique(np.linspace(0, len(files)-1, number_of_samples).astype(int))
+    return [files[i] for i in indexes]
+
+def estimateGeometry(files:List, number_of_samples:int=CALIBRATION_SAMPLES, processes:int=NUM_PROCESSES) -> dict:
+    # Starting settings for geometry.json, the deskew is measured from the hole outlines
+    # and the lens is assumed perfect (edit the file to add distortion and keystone)
+    sample_files=calibrationSamples(files, number_of_samples)
+
+    if processes>1:
+        with multiprocessing.Pool(processes, initializer=_initAlignmentWorker, initargs=(None,)) as pool:
+            tilts=pool.map(measureSproketTilt, sample_files)
+    else:
+        tilts=[measureSproketTilt(f) for f in sample_files]
+
+    settings=dict(Geometry.DEFAULT_SETTINGS)
+    settings["deskew"]=round(Geometry.estimateDeskew([t for t in tilts if t is not None]), 3)
+    return settings
+
+def autoCalibrate(files:List, number_of_samples:int=CALIBRATION_SAMPLES, processes:int=NUM_PROCESSES) -> dict:
+    # Replaces scanImages, no operator needed.  Measures the hole on frames spread across
+    # the whole reel, rejects outliers (more than 3 MADs from the median) and averages the rest
+    sample_files=calibrationSamples(files, number_of_samples)
+
+    if processes>1:
+        with multiprocessing.Pool(processes, initializer=_initAlignmentWorker, initargs=(None,)) as pool:
+            measurements=pool.map(measureSproket, sample_files)
+    else:
+        measurements=[measureSproket(f) for f in sample_files]
+
+    measurements=np.array([m for m in measurements if m is not None], dtype=np.float64)
+    if len(measurements)<10:
+        raise Exception("Unable to detect suitable sample size")
 
-def processImage(original_image, average_width, average_height, average_area):
-    global min_x,max_x,min_y,max_y, lower_t
-    global previous_frame_top_left_of_sproket_hole
-    global previous_frame_bottom_right_of_sproket_hole
+    # Median absolute deviation (scaled to match a standard deviation) of width, height and area
+    median=np.median(measurements, axis=0)
+    mad=1.4826*np.median(np.abs(measurements-median), axis=0)
+    good=np.all(np.abs(measurements-median)<=3*np.maximum(mad, 1), axis=1)
+    measurements=measurements[good]
+
+    if len(measurements)<10:
+        raise Exception("Unable to detect suitable sample size")
+
+    average=measurements.mean(axis=0)
+    return {
+        "average_sample_count":int(len(measurements)),
+        "average_width":int(average[0]),
+        "average_height":int(average[1]),
+        "average_area":int(average[2]),
+        "rejected":int(np.count_nonzero(good==False)),
+        "threshold":CALIBRATION_THRESHOLD,
+    }
+
+def saveCalibration(filename:str, calibration:dict):
+    with open(filename, "w") as f:
+        json.dump(calibration, f, indent=2)
+
+def loadCalibration(filename:str) -> dict:
+    with open(filename, "r") as f:
+        return json.load(f)
+
+def newSessionState(lower_threshold:int=225) -> dict:
+    # Everything processImage learns whilst working through a reel.  Kept as a plain
+    # dictionary of numbers so it can be saved to disk or passed to another process
+    return {
+        "min_x":999999,
+        "max_x":0,
+        "min_y":999999,
+        "max_y":0,
+        "lower_t":lower_threshold,
+        "previous_frame_top_left_of_sproket_hole":None,
+        "previous_frame_bottom_right_of_sproket_hole":None,
+        # Predicted position of the hole for the tracking mode
+        "track":None,
+    }
+
+def saveSessionState(filename:str, state:dict):
+    with open(filename, "w") as f:
+        json.dump(state, f, indent=2)
+
+def loadSessionState(filename:str) -> dict:
+    state=newSessionState()
+    with open(filename, "r") as f:
+        state.update(json.load(f))
+
+    # JSON has no tuples, OpenCV wants them for points
+    for key in ["previous_frame_top_left_of_sproket_hole","previous_frame_bottom_right_of_sproket_hole"]:
+        if state[key] is not None:
+            state[key]=tuple(state[key])
+
+    return state
+
+def mergeSessionStates(states:List) -> dict:
+    # Combine the states returned from frame ranges aligned in parallel.
+    # The learned bounding box grows to cover all of them, everything else comes
+    # from the last range (the end of the reel)
+    merged=dict(states[-1])
+    merged["min_x"]=min(s["min_x"] for s in states)
+    merged["max_x"]=max(s["max_x"] for s in states)
+    merged["min_y"]=min(s["min_y"] for s in states)
+    merged["max_y"]=max(s["max_y"] for s in states)
+    return merged
+
+# State used when processImage is called without one
+session=newSessionState()
+
+def annotateFrame(thumbnail, scale:float, state:dict, tl, br, frame_tl, frame_br):
+    # Draw the detected hole, learned box and output frame onto a downscaled copy of the image
+    def point(p):
+        return (int(p[0]*scale), int(p[1]*scale))
+
+    def thickness(t):
+        return max(1, int(t*scale))
+
+    # draw actual detected sproket hole in grey
+    cv.rectangle(thumbnail, point(tl), point(br), (100,100,100), thickness(3))
+
+    # Draw the box of recorded allowable TOP RIGHT positions (just for fun)
+    if state["max_x"]>0:
+        cv.rectangle(thumbnail, point((state["min_x"],state["min_y"])), point((state["max_x"],state["max_y"])), (100,100,100), thickness(3))
+
+    draw_border(thumbnail,point(tl),point(br),(0,0,255),thickness(6),int(50*scale),int(40*scale))
+
+    cv.rectangle(thumbnail, point(frame_tl), point(frame_br), (0,200,200), thickness(8))
+
+    # Highlight top right
+    cv.circle(thumbnail, point(tl), thickness(8), (0, 0, 100), -1)
+    return thumbnail
+
+def sizeConfidence(width_of_sproket_hole, height_of_sproket_hole, average_width, average_height) -> float:
+    # 1.0 when the hole is exactly the calibrated size, falling to zero as it gets further away
+    error=abs(width_of_sproket_hole-average_width)/average_width + abs(height_of_sproket_hole-average_height)/average_height
+    return float(max(0.0, 1.0-error))
+
+def insideLearnedBox(tl, state:dict, margin:int=0) -> bool:
+    return tl[0]>=state["min_x"]-margin and tl[0]<=state["max_x"]+margin and tl[1]>=state["min_y"]-margin and tl[1]<=state["max_y"]+margin
+
+def fallbackSproketPosition(sproket_image, state:dict, average_width, average_height):
+    # Used in headless mode when a frame would normally need the operator.
+    # First try detecting again at other thresholds, then fall back to the previous frame.
+    # Returns top left, bottom right, method used and a confidence score (0 to 1)
+    for step in FALLBACK_THRESHOLD_STEPS:
+        tl, br, width_of_sproket_hole, height_of_sproket_hole, rotation, area, number_of_contours=findSproket(sproket_image, state["lower_t"]+step)
+        confidence=sizeConfidence(width_of_sproket_hole, height_of_sproket_hole, average_width, average_height)
+        if number_of_contours>0 and confidence>0.8 and insideLearnedBox(tl, state, HEADLESS_BOX_MARGIN):
+            # Penalise thresholds further away from the one which normally works
+            return tl, br, "threshold {0}".format(state["lower_t"]+step), round(confidence*(0.9-abs(step)/100),3)
+
+    if state["previous_frame_top_left_of_sproket_hole"] is not None:
+        return state["previous_frame_top_left_of_sproket_hole"], state["previous_frame_bottom_right_of_sproket_hole"], "previous", 0.3
+
+    # Nothing better, use the detection as it is
+    tl, br, width_of_sproket_hole, height_of_sproket_hole, rotation, area, number_of_contours=findSproket(sproket_image, state["lower_t"])
+    return tl, br, "detected", 0.0
+
+def histogramThresholds(sproket_image, average_area):
+    # Otsu and percentile thresholds for the strip, both expressed on the equalized
+    # scale that detectSproket thresholds.  Every 4th pixel is plenty for a histogram
+    gray=grayImage(np.ascontiguousarray(sproket_image[::4, ::4]))
+    lut=equalizeLut(gray)
+
+    # Otsu first splits the dark film base from everything else, then again amongst the
+    # brighter pixels to split the hole from bright picture content
+    blurred=cv.GaussianBlur(gray, (3, 3), 0)
+    otsu, _ = cv.threshold(blurred, 0, 255, cv.THRESH_BINARY+cv.THRESH_OTSU)
+    brighter=blurred[blurred>otsu]
+    if len(brighter)>0 and brighter.min()<brighter.max():
+        otsu, _ = cv.threshold(brighter.reshape(-1, 1), 0, 255, cv.THRESH_BINARY+cv.THRESH_OTSU)
+
+    # The hole should be (roughly) the brightest average_area pixels of the strip
+    h, w =sproket_image.shape[:2]
+    hole_fraction=min(0.9, THRESHOLD_AREA_SCALE*average_area/(h*w))
+    percentile=np.percentile(cv.LUT(gray, lut), 100*(1-hole_fraction))
+
+    return int(lut[int(otsu)]), int(percentile)
+
+def autoThreshold(sproket_image, state:dict, average_width, average_height, average_area) -> int:
+    # Choose lower_t for this frame according to THRESHOLD_MODE
+    otsu, percentile=histogramThresholds(sproket_image, average_area)
+    if THRESHOLD_MODE=="otsu":
+        return int(np.clip(otsu, 100, 250))
+    if THRESHOLD_MODE=="percentile":
+        return int(np.clip(percentile, 100, 250))
+
+    # "search", keep the threshold whose hole is closest to the calibrated size,
+    # preferring the current value (listed first) if several are equally good
+    candidates=[state["lower_t"]+step for step in THRESHOLD_SEARCH_STEPS]+[otsu, percentile]
+    best_threshold=state["lower_t"]
+    best_score=-1
+    for threshold in candidates:
+        threshold=int(np.clip(threshold, 100, 250))
+        tl, br, width_of_sproket_hole, height_of_sproket_hole, rotation, area, number_of_contours=findSproket(sproket_image, threshold)
+        if number_of_contours==0:
+            continue
+        score=sizeConfidence(width_of_sproket_hole, height_of_sproket_hole, average_width, average_height)*(1-min(1,abs(area-average_area)/average_area))
+        if score>best_score+0.01:
+            best_score=score
+            best_threshold=threshold
+        if best_score>0.95:
+            break
+    return best_threshold
+
+def predictSproket(state:dict):
+    # Where the top left of the next hole should be, or None if not tracking yet
+    track=state["track"]
+    if track is None:
+        return None
+    return track["x"]+track["vx"], track["y"]+track["vy"]
+
+def updateTrack(state:dict, tl):
+    prediction=predictSproket(state)
+    if prediction is None:
+        state["track"]={"x":float(tl[0]),"y":float(tl[1]),"vx":0.0,"vy":0.0}
+        return
+
+    # Alpha-beta filter, moves the estimate part of the way towards the measurement
+    track=state["track"]
+    residual_x=tl[0]-prediction[0]
+    residual_y=tl[1]-prediction[1]
+    track["x"]=float(prediction[0]+TRACKING_ALPHA*residual_x)
+    track["y"]=float(prediction[1]+TRACKING_ALPHA*residual_y)
+    track["vx"]=float(track["vx"]+TRACKING_BETA*residual_x)
+    track["vy"]=float(track["vy"]+TRACKING_BETA*residual_y)
+
+def trackSproket(sproket_image, state:dict, average_width, average_height):
+    # Detect the hole in a window around its predicted position.  Returns the same tuple
+    # as detectSproket, or None if there is no prediction or the result isn't trusted
+    prediction=predictSproket(state)
+    if prediction is None:
+        return None
+    return detectSproketNear(sproket_image, prediction, state["lower_t"], average_width, average_height)
+
+def detectSproketNear(sproket_image, prediction, lower_threshold:int, average_width, average_height, padding:int=TRACKING_PADDING):
+    # Detect the hole in a window around where its top left is expected to be.  Returns
+    # the same tuple as detectSproket, or None if the result isn't trusted
+    h, w =sproket_image.shape[:2]
+    x1=max(0, int(prediction[0])-padding)
+    y1=max(0, int(prediction[1])-padding)
+    x2=min(w, int(prediction[0])+average_width+padding)
+    y2=min(h, int(prediction[1])+average_height+padding)
+    if x2-x1<average_width or y2-y1<average_height:
+        return None
+
+    # Equalize the window with the histogram of the whole strip (every 4th pixel is plenty),
+    # otherwise the threshold would mean something different to the full search
+    lut=equalizeLut(grayImage(np.ascontiguousarray(sproket_image[::4, ::4])))
+
+    window = cv.GaussianBlur(sproket_image[y1:y2, x1:x2], (3, 7), 0)
+    window = cv.LUT(grayImage(window), lut)
+    _, window = cv.threshold(window, lower_threshold, 255, cv.THRESH_BINARY)
+    window = cv.morphologyEx(window, cv.MORPH_OPEN, structuringElement(100))
+
+    tl, br, width_of_sproket_hole, height_of_sproket_hole, rotation, area, number_of_contours=sproketFromMask(window)
+
+    # Only trust a hole of the right size which isn't cut off by the edge of the window
+    if number_of_contours==0:
+        return None
+    if tl[0]<=0 or tl[1]<=0 or br[0]>=x2-x1-1 or br[1]>=y2-y1-1:
+        return None
+    if sizeConfidence(width_of_sproket_hole, height_of_sproket_hole, average_width, average_height)<0.8:
+        return None
+
+    return (tl[0]+x1, tl[1]+y1), (br[0]+x1, br[1]+y1), width_of_sproket_hole, height_of_sproket_hole, rotation, area, number_of_contours
+
+def frameRectangle(tl, br, size):
+    # Output frame (top left, bottom right) for a sproket hole, size is the (w, h) of the captured image
+
+    # right hand corner of sproket hole seems to be always best aligned (manual observation) so use that as datum for the whole frame capture
+    # calculate everything based on the ratio of the sproket holes
+    #frame_tl=(int(tr[0]-average_width*0.165) ,int(tr[1] - average_height*1.31))
+    #frame_tl=(int(tr[0] + FRAME_DIMS[0]) ,int(tr[1] + FRAME_DIMS[1]))
+    frame_origin=tl
+    if geometry is not None:
+        # The frame is cropped from the corrected image, so move the hole there too.
+        # The centre is moved rather than the corner, the corner of a tilted hole's
+        # bounding box isn't a point on the film
+        centre=geometry.correctPoint(((tl[0]+br[0])/2, (tl[1]+br[1])/2), size)
+        frame_origin=(centre[0]-(br[0]-tl[0])/2, centre[1]-(br[1]-tl[1])/2)
+    frame_tl=(int(frame_origin[0] + FRAME_DIMS[0]) ,int(frame_origin[1] + FRAME_DIMS[1]))
+
+    # Height must be divisble by 2
+    #frame_br=(int(frame_tl[0]+ average_width*6.85),int(frame_tl[1]+ average_height*3.55))
+    frame_br=(int(frame_tl[0]+ FRAME_DIMS[2]),int(frame_tl[1]+ FRAME_DIMS[3]))
+    return frame_tl, frame_br
+
+def processImage(original_image, average_width, average_height, average_area, state:dict=None, interactive:bool=True, triage:List=None, sproket_hole=None, result:dict=None):
+    # When interactive is False doubtful frames never wait for a key press, a fallback
+    # position is used instead and a record is appended to the triage list (if supplied)
+    # sproket_hole is a previously accepted (top left, bottom right) position, typically
+    # from the detection cache, the frame is cropped there without detecting or checking.
+    # If result is supplied it is filled in with the hole position and detection details
+    if state is None:
+        state=session
 
     Detect=True
     manual_adjustment=False
-    #lower_t=210
-    while True:        
+    locked=False
+    fallback_used=False
+    source=SOURCE_DETECTED
+    threshold=state["lower_t"]
+    rotation=0
+    area=0
+    number_of_contours=0
+    # Where the engine first put the hole, before any operator correction
+    detected_hole=None
+
+    if sproket_hole is not None:
+        top_left_of_sproket_hole, bottom_right_of_sproket_hole=sproket_hole
+        Detect=False
+        fallback_used=True
+    while True:
         # Do inital crop of the input image
         # this assumes hardcoded image sizes and will need tweaks depending on input resolution
         image=cropOriginalImage(original_image)
@@ -253,16 +997,23 @@ def processImage(original_image, average_width, average_height, average_area):
 
         if Detect:
             #Take a vertical strip where the sproket should be (left hand side)
-            top_left_of_sproket_hole, bottom_right_of_sproket_hole, width_of_sproket_hole, height_of_sproket_hole, rotation, area, number_of_contours=detectSproket(image[0:h,0:int(w*0.205)], lower_t)
-
-        untouched_image=image.copy()
-
-        # draw actual detected sproket hole in grey
-        cv.rectangle(image, top_left_of_sproket_hole, bottom_right_of_sproket_hole, (100,100,100), 3)
-
-        # Draw the box of recorded allowable TOP RIGHT positions (just for fun)
-        if max_x>0:
-            cv.rectangle(image, (min_x,min_y), (max_x,max_y), (100,100,100), 3)
+            sproket_strip=image[0:h,0:int(w*0.205)]
+            if THRESHOLD_MODE!="manual" and manual_adjustment==False:
+                # Operator changes to the threshold (in the adjustment window) are kept
+                state["lower_t"]=autoThreshold(sproket_strip, state, average_width, average_height, average_area)
+            detection=None
+            if TRACKING:
+                # Look near where the hole should be first, full strip if that fails
+                detection=trackSproket(sproket_strip, state, average_width, average_height)
+            if detection is None:
+                detection=findSproket(sproket_strip, state["lower_t"])
+            top_left_of_sproket_hole, bottom_right_of_sproket_hole, width_of_sproket_hole, height_of_sproket_hole, rotation, area, number_of_contours=detection
+            threshold=state["lower_t"]
+            if detected_hole is None:
+                detected_hole=(top_left_of_sproket_hole, bottom_right_of_sproket_hole)
+
+        # The original pixels, drawing only happens on downscaled copies
+        untouched_image=image
 
         #Draw "average" size rectangle in red, based on detected hole
         #tl=(bottom_right_of_sproket_hole[0]-average_width,top_left_of_sproket_hole[1])
@@ -273,48 +1024,37 @@ def processImage(original_image, average_width, average_height, average_area):
         tr=(br[0],tl[1])
         #cv.rectangle(image, tl, br, (0,0,255), 3)
 
-        draw_border(image,tl,br,(0,0,255),6,50,40)
-
         #print(top_left_of_sproket_hole, bottom_right_of_sproket_hole,width_of_sproket_hole,height_of_sproket_hole, rotation, area, number_of_contours)
 
         # Allowable tolerance around the "average"
 
-        # Frame dimensions - this will need to be altered on every scan
-        # perhaps enhance the GUI to use mouse coordinates?
-        # Negative offset X,Y and then W,H
-        # W and H even!
-        frame_dims=(220, -440, 1650, 1200)
-
-        # right hand corner of sproket hole seems to be always best aligned (manual observation) so use that as datum for the whole frame capture
-        # calculate everything based on the ratio of the sproket holes
-        #frame_tl=(int(tr[0]-average_width*0.165) ,int(tr[1] - average_height*1.31))
-        #frame_tl=(int(tr[0] + frame_dims[0]) ,int(tr[1] + frame_dims[1]))
-        frame_tl=(int(tl[0] + frame_dims[0]) ,int(tl[1] + frame_dims[1]))
-
-        # Height must be divisble by 2
-        #frame_br=(int(frame_tl[0]+ average_width*6.85),int(frame_tl[1]+ average_height*3.55))
-        frame_br=(int(frame_tl[0]+ frame_dims[2]),int(frame_tl[1]+ frame_dims[3]))
-        
-        cv.rectangle(image, frame_tl, frame_br, (0,200,200), 8)
+        frame_tl, frame_br=frameRectangle(tl, br, (w, h))
 
         output_w= frame_br[0]-frame_tl[0]
         output_h= frame_br[1]-frame_tl[1]
 
         #print(output_w,output_h)
 
-        # Highlight top right
-        cv.circle(image, (int(tl[0]), int(tl[1])), 8, (0, 0, 100), -1)
         #padding=20
 
-        if frame_tl[1]<0 or frame_tl[0]<0:
+        if fallback_used:
+            # Already picked a fallback (or cached) position, don't check it again,
+            # cropFrame pads the frame out if it runs off the image
+            pass
+        elif frame_tl[1]<0 or frame_tl[0]<0:
             print("frame_tl",frame_tl)
             manual_adjustment=True
+            reason="frame_tl"
         #elif number_of_contours>40:
         #    print("Contours",number_of_contours)
         #    manual_adjustment=True
-        elif tl[0]<min_x or tl[0]>max_x or tl[1]<min_y or tl[1]>max_y:
+        elif interactive==False and (state["max_x"]==0 or insideLearnedBox(tl, state, HEADLESS_BOX_MARGIN)) and sizeConfidence(width_of_sproket_hole, height_of_sproket_hole, average_width, average_height)>0.8:
+            # Close enough to the learned box (or the first frame) and the right size, accept without asking
+            pass
+        elif insideLearnedBox(tl, state)==False:
             print("Outside learned bounding box")
             manual_adjustment=True
+            reason="outside"
         #elif height_of_sproket_hole<(average_height-padding) or height_of_sproket_hole>(average_height+padding):
         #    print("Sproket Height wrong!!",height_of_sproket_hole)
         #    manual_adjustment=True
@@ -331,12 +1071,35 @@ def processImage(original_image, average_width, average_height, average_area):
         SMALL_STEP=2
         LARGE_STEP=10*SMALL_STEP
 
+        if manual_adjustment==True and interactive==False:
+            # Nobody is watching, so use a fallback and log the frame for review later
+            top_left_of_sproket_hole, bottom_right_of_sproket_hole, method, confidence=fallbackSproketPosition(original_image[0:h,0:int(w*0.205)], state, average_width, average_height)
+            print("Fallback",method,"confidence",confidence)
+            if triage is not None:
+                triage.append({"reason":reason,"method":method,"confidence":confidence,
+                    "tl_x":int(top_left_of_sproket_hole[0]),"tl_y":int(top_left_of_sproket_hole[1]),
+                    "br_x":int(bottom_right_of_sproket_hole[0]),"br_y":int(bottom_right_of_sproket_hole[1]),
+                    "lower_t":state["lower_t"]})
+            Detect=False
+            fallback_used=True
+            source=SOURCE_FALLBACK
+            manual_adjustment=False
+            continue
+
         if manual_adjustment==True:
-            thumbnail=cv.resize(image, (0,0), fx=0.4, fy=0.4)
+            source=SOURCE_OPERATOR
+
+            # Worker processes take turns to use the adjustment window
+            if prompt_lock is not None and locked==False:
+                prompt_lock.acquire()
+                locked=True
+
+            thumbnail=annotateFrame(cv.resize(image, (0,0), fx=0.4, fy=0.4), 0.4, state, tl, br, frame_tl, frame_br)
             cv.putText(thumbnail, "Cursor keys adjust frame capture, SPACE to confirm", (0, 30), cv.FONT_HERSHEY_SIMPLEX, 1, (200, 200, 200), 2, cv.LINE_AA)
-            cv.putText(thumbnail, "[ and ] adjust threshold, current value={0}".format(lower_t), (0, 60), cv.FONT_HERSHEY_SIMPLEX, 1, (200, 200, 200), 2, cv.LINE_AA)
-            cv.imshow("Adjustment",thumbnail)
-            k = cv.waitKeyEx(0) 
+            cv.putText(thumbnail, "[ and ] adjust threshold, current value={0}".format(state["lower_t"]), (0, 60), cv.FONT_HERSHEY_SIMPLEX, 1, (200, 200, 200), 2, cv.LINE_AA)
+            with gui_lock:
+                cv.imshow("Adjustment",thumbnail)
+                k = cv.waitKeyEx(0)
             #print("key",k)
 
             print("key=", int(k))
@@ -402,158 +1165,617 @@ def processImage(original_image, average_width, average_height, average_area):
 
             if k == ord('r'):
                 #Use previous frames locations
-                top_left_of_sproket_hole=previous_frame_top_left_of_sproket_hole
-                bottom_right_of_sproket_hole=previous_frame_bottom_right_of_sproket_hole
+                top_left_of_sproket_hole=state["previous_frame_top_left_of_sproket_hole"]
+                bottom_right_of_sproket_hole=state["previous_frame_bottom_right_of_sproket_hole"]
                 Detect=False
 
             if k == 27:
+                if locked:
+                    prompt_lock.release()
                 raise Exception("Abort!")
 
             if k == 46:
-                lower_t-=1
+                state["lower_t"]-=1
                 Detect=True
 
             if k == 44:
-                lower_t+=1
+                state["lower_t"]+=1
                 Detect=True
 
             if k == ord(' '):
                 #Accept
-                cv.destroyWindow("Adjustment")
+                with gui_lock:
+                    cv.destroyWindow("Adjustment")
                 manual_adjustment=False
+                if locked:
+                    prompt_lock.release()
+                    locked=False
 
         if manual_adjustment==False:
 
+            if preview is not None and preview.due("Detection"):
+                preview.submit("Detection", annotateFrame(cv.resize(image, (0,0), fx=0.4, fy=0.4, interpolation=cv.INTER_NEAREST), 0.4, state, tl, br, frame_tl, frame_br))
+
+            if result is not None:
+                result.update({"tl_x":int(tl[0]),"tl_y":int(tl[1]),"br_x":int(br[0]),"br_y":int(br[1]),
+                    "rotation":float(rotation),"area":float(area),"contours":int(number_of_contours),
+                    "threshold":int(threshold),"source":source})
+                if detected_hole is not None:
+                    result.update({"detected_tl_x":int(detected_hole[0][0]),"detected_tl_y":int(detected_hole[0][1]),
+                        "detected_br_x":int(detected_hole[1][0]),"detected_br_y":int(detected_hole[1][1]),"detector":DETECTOR})
+
+            if source!=SOURCE_FALLBACK:
+                updateTrack(state, tl)
+
             #Black out the sproket hole
             #cv.rectangle(untouched_image,(tr[0]+1,tr[1]-1),(tr[0]-2-average_width,tr[1]+2+average_height),color=(0,0,0),thickness=cv.FILLED)
 
-            if frame_tl[1]<0:
+            if frame_tl[1]<0 and geometry is None:
                 #Original image is smaller than the crop size/frame size, so pad out
-                #Need to pad out the image at the TOP...
-                offset_y=abs(frame_tl[1])
-                cropped=untouched_image[0:frame_br[1],frame_tl[0]:frame_br[0]].copy()
-                h, w =cropped.shape[:2]
-                # Full sized image
-                output_image = np.zeros((output_h,output_w,3), np.uint8)
-                # Place cropped into bottom right corner
-                output_image[offset_y:offset_y+h,0:w]=cropped
-                return output_image            
+                #at the TOP (cropFrame does this), fine registration still applies
+                return cropFrame(untouched_image, frame_tl, frame_br)
+
+            if fallback_used:
+                # Doubtful position, don't let it grow the learned box
+                return cropFrame(untouched_image, frame_tl, frame_br)
 
             # Update our acceptable min/max ranges
-            min_x= min(min_x,tl[0])
-            max_x= max(max_x,tl[0])
+            state["min_x"]= int(min(state["min_x"],tl[0]))
+            state["max_x"]= int(max(state["max_x"],tl[0]))
 
-            min_y= min(min_y,tl[1])
-            max_y= max(max_y,tl[1])
+            state["min_y"]= int(min(state["min_y"],tl[1]))
+            state["max_y"]= int(max(state["max_y"],tl[1]))
 
             #print(min_x,min_y,max_x,max_y)
-            previous_frame_top_left_of_sproket_hole=top_left_of_sproket_hole
-            previous_frame_bottom_right_of_sproket_hole=bottom_right_of_sproket_hole
-
-            return untouched_image[frame_tl[1]:frame_br[1],frame_tl[0]:frame_br[0]]
-
-    
+            state["previous_frame_top_left_of_sproket_hole"]=(int(top_left_of_sproket_hole[0]),int(top_left_of_sproket_hole[1]))
+            state["previous_frame_bottom_right_of_sproket_hole"]=(int(bottom_right_of_sproket_hole[0]),int(bottom_right_of_sproket_hole[1]))
 
-input_path=ImageFolder()
-output_path=OutputFolder()
+            return cropFrame(untouched_image, frame_tl, frame_br)
 
-files=Filelist(input_path,"png")
-
-#files=files[469:]
-
-try:
-    average_sample_count=21
-    average_width=250
-    average_height=313
-    average_area=75335
-
-    # Skip this for now, we have already run it!
-    #average_sample_count,average_width,average_height,average_area=scanImages(files[:300])
-
-    print("samples=",average_sample_count,"w=",average_width,"h=", average_height,"area=", average_area)
-    
-    previous_output_image_filename=None 
-    #overlay_frame = cv.imread("overlay_frame.png",cv.IMREAD_UNCHANGED)
-
-    for i in range(NUM_THREADS):
-        worker = Thread(target=ServiceImageWriteQueue, args=(q,))
-        worker.setDaemon(True)
-        worker.start()
+def padForCrop(image, frame_tl, frame_br, margin:int=0):
+    # When the frame runs off the image, the part of the image it (plus margin) covers
+    # on a black background and the frame moved to match, otherwise unchanged
+    h, w =image.shape[:2]
+    if frame_tl[0]>=0 and frame_tl[1]>=0 and frame_br[0]<=w and frame_br[1]<=h:
+        return image, frame_tl, frame_br
+    x1, y1=frame_tl[0]-margin, frame_tl[1]-margin
+    x2, y2=frame_br[0]+margin, frame_br[1]+margin
+    padded=np.zeros((y2-y1, x2-x1)+image.shape[2:], image.dtype)
+    cx1, cy1=max(x1, 0), max(y1, 0)
+    cx2, cy2=min(x2, w), min(y2, h)
+    if cx2>cx1 and cy2>cy1:
+        padded[cy1-y1:cy2-y1, cx1-x1:cx2-x1]=image[cy1:cy2, cx1:cx2]
+    return padded, (margin, margin), (margin+frame_br[0]-frame_tl[0], margin+frame_br[1]-frame_tl[1])
+
+def cropFrame(image, frame_tl, frame_br):
+    # With geometry correction the crop and the correction are a single remap of
+    # just the output pixels, the frame is black where it runs off the image
+    # Fine registration moves the crop by the sub-pixel offset it finds, in the same resample
+    if geometry is not None:
+        frame=geometry.crop(image, frame_tl, frame_br)
+        if fine_registration is not None:
+            frame=fine_registration.apply(frame)
+        return frame
+    # Without it, black where the frame runs off the image too (a cached or fallback
+    # position isn't checked, so can be anywhere), with room for the fine registration shift
+    image, frame_tl, frame_br=padForCrop(image, frame_tl, frame_br, 0 if fine_registration is None else int(np.ceil(fine_registration.max_shift))+1)
+    if fine_registration is not None:
+        return fine_registration.crop(image, frame_tl, frame_br)
+    return image[frame_tl[1]:frame_br[1],frame_tl[0]:frame_br[0]]
+
+def appendTriage(filename:str, entries:List):
+    # Add doubtful frames to the triage file, creating it if needed (not for none,
+    # a reel with no doubtful frames has no triage file)
+    if len(entries)==0:
+        return
+    new_file=not os.path.exists(filename)
+    with open(filename, "a", newline="") as f:
+        writer=csv.DictWriter(f, fieldnames=TRIAGE_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(entries)
+
+def loadTriage(filename:str) -> List:
+    if not os.path.exists(filename):
+        return []
+    with open(filename, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+def saveTriage(filename:str, entries:List):
+    if os.path.exists(filename):
+        os.remove(filename)
+    appendTriage(filename, entries)
+
+def _initAlignmentWorker(lock, correction=None, hole_size=None):
+    # Runs once inside each worker process
+    global show_windows, prompt_lock, geometry, fine_registration, template_size, preview, gui_lock
+    show_windows=False
+    # A forked worker inherits the parent's preview, but not its thread, and the GUI
+    # lock in whatever state the thread had it.  Only the adjustment window is used here
+    preview=None
+    gui_lock=Lock()
+    prompt_lock=lock
+    geometry=correction
+    if hole_size is not None:
+        template_size=hole_size
+    if FINE_REGISTRATION:
+        fine_registration=FineRegistration()
+
+def alignFrameRange(job):
+    # Align a contiguous range of frames, writing each output file as it goes.
+    # Returns the updated state, the output files which could not be created
+    # because the input was unreadable - these are filled in (in order) afterwards,
+    # the triage records for doubtful frames and the new detection results
+    # (cached holes are passed in as a dictionary of filename to position)
+    files, output_path, averages, state, interactive, cached = job
+    average_width, average_height, average_area = averages
+    missing=[]
+    triage=[]
+    results=[]
+
+    # The range doesn't follow on from whatever this process aligned last
+    if fine_registration is not None:
+        fine_registration.reset()
 
     for filename in files:
-        new_filename = os.path.join(output_path, os.path.basename(filename))
-
-        #Skip images which already exist
-        if os.path.exists(new_filename):
-            continue 
+        new_filename = outputFilename(output_path, filename)
 
-        img = cv.imread(filename,cv.IMREAD_UNCHANGED)
+        img = FrameEncoders.readFrame(filename,cv.IMREAD_UNCHANGED)
         if img is None:
-            print("Error opening file",filename,"replacing bad frame")
-            #Clone frame to cover up corrupt/missing file
-            shutil.copy2(previous_output_image_filename, new_filename)
-        else:
-            print(filename)
-
-            new_image=processImage(img,  average_width, average_height, average_area)
-            h, w =new_image.shape[:2]
-
-
-            # Resize image and put into 16:9 frame?
-            if True==False:
-                #Output a slightly higher resolution - use post editing to resize
-                #this outputs at 16:9 scale
-                #output_h=1558
-                #output_w=int(output_h*(1920/1080))
-
-                output_w=1920
-                output_h=1080
-
-                #Scale new_image to keep correct aspect ratio
-                scale = output_w/w
-                if h*scale > output_h:
-                    scale = output_h/h
-
-                scale_w=int(w*scale)
-                scale_h=int(h*scale)
-
-                print("Scaled image w=",scale_w,"h=",scale_h, "original w=",w,"h=",h)
-                #Horizontal centre frame
-                scale_x_offset=int(output_w/2 - scale_w/2)
-                scaled_image=cv.resize(new_image, (scale_w,scale_h), interpolation=cv.INTER_AREA)
-                
-                new_image = np.zeros((output_h,output_w,3), np.uint8)
-                new_image[0:scale_h,scale_x_offset:scale_x_offset+scale_w]=scaled_image
+            print("Error opening file",filename)
+            missing.append(new_filename)
+            continue
+
+        frame_triage=[]
+        result={}
+        sproket_hole=cached.get(filename)
+        new_image=processImage(img, average_width, average_height, average_area, state=state, interactive=interactive, triage=frame_triage, sproket_hole=sproket_hole, result=result)
+        for entry in frame_triage:
+            entry["filename"]=filename
+        triage.extend(frame_triage)
+        if sproket_hole is None:
+            results.append((filename, result))
+
+        FrameEncoders.writeFrame(new_filename, new_image, OUTPUT_FORMAT)
+
+    return state, missing, triage, results
+
+def cachedSproketHoles(cache:DetectionCache, files:List, stabilized:dict=None) -> dict:
+    # Hole positions already known for these files, smoothed positions take priority
+    holes={}
+    for filename in files:
+        sproket_hole=None
+        if stabilized is not None:
+            sproket_hole=stabilized.get(os.path.abspath(filename))
+        if sproket_hole is None and cache is not None:
+            sproket_hole=cache.sproketHole(filename)
+        if sproket_hole is not None:
+            holes[filename]=sproket_hole
+    return holes
+
+def stabilizeReel(input_path:str, files:List, cache:DetectionCache):
+    # Offline pass over the cached hole positions, writes the smoothed trajectory
+    positions=Trajectory.loadPositions(cache, files)
+    missing=np.count_nonzero(np.isnan(positions[:,0]))
+    if missing>0:
+        print("Warning",missing,"frames have no cached position, these are interpolated")
+
+    x, y, width, height, outliers, splices=Trajectory.correctTrajectory(positions)
+
+    for i in splices:
+        print("Splice at",os.path.basename(files[i]))
+    for i in np.flatnonzero(outliers):
+        print("Outlier",os.path.basename(files[i]),"detected",positions[i,0:2],"corrected",(round(x[i],1),round(y[i],1)))
+
+    moved=np.hypot(x-positions[:,0], y-positions[:,1])
+    print("Frames",len(files),"splices",len(splices),"outliers",np.count_nonzero(outliers),"mean correction {:.2f} pixels".format(np.nanmean(moved)))
+
+    Trajectory.saveTrajectory(os.path.join(input_path, Trajectory.TRAJECTORY_FILENAME), files, positions, x, y, width, height, outliers, splices)
+
+def detectFrameRange(job):
+    # Detection only, from the capture sidecars, no frame is decoded.  The search starts
+    # where the scanner found the hole, falling back to the whole strip.  Only results
+    # as trustworthy as headless mode's are returned, anything else is left for
+    # alignment to detect (and triage) from the full frame
+    files, averages, lower_threshold, captures = job
+    average_width, average_height, average_area = averages
+    state=newSessionState(lower_threshold)
+    results=[]
 
+    for filename in files:
+        sproket_strip=StripSidecar.loadStrip(filename)
+        if sproket_strip is None:
+            continue
+
+        if THRESHOLD_MODE!="manual":
+            state["lower_t"]=autoThreshold(sproket_strip, state, average_width, average_height, average_area)
+
+        detection=None
+        capture=captures.get(FrameFiles.frameNumber(filename))
+        if capture is not None:
+            prediction=(capture["centre_x"]-average_width/2, capture["centre_y"]-average_height/2)
+            detection=detectSproketNear(sproket_strip, prediction, state["lower_t"], average_width, average_height, CAPTURE_SEED_PADDING)
+        if detection is None:
+            detection=findSproket(sproket_strip, state["lower_t"])
+        tl, br, width_of_sproket_hole, height_of_sproket_hole, rotation, area, number_of_contours=detection
+
+        if number_of_contours==0 or number_of_contours>=10:
+            continue
+        if sizeConfidence(width_of_sproket_hole, height_of_sproket_hole, average_width, average_height)<0.8:
+            continue
+
+        results.append((filename, {"tl_x":int(tl[0]),"tl_y":int(tl[1]),"br_x":int(br[0]),"br_y":int(br[1]),
+            "rotation":float(rotation),"area":float(area),"contours":int(number_of_contours),
+            "threshold":int(state["lower_t"]),"source":SOURCE_DETECTED}))
+
+    return results
+
+def detectReel(input_path:str, files:List, cache:DetectionCache, averages, lower_threshold:int, processes:int=NUM_PROCESSES):
+    # Fills the detection cache for frames with a strip sidecar, so a later "stabilize"
+    # and "align" don't have to detect from the full frames
+    files=[f for f in files if cache.sproketHole(f) is None]
+    captures=StripSidecar.loadCaptureRecords(input_path)
+    print("Frames to detect",len(files),"capture records",len(captures))
+
+    jobs=[(frame_range, averages, lower_threshold, captures) for frame_range in splitFrameRanges(files, max(1, processes)*4)]
+    if processes>1:
+        with multiprocessing.Pool(processes, initializer=_initAlignmentWorker, initargs=(None, None, template_size)) as pool:
+            ranges=pool.map(detectFrameRange, jobs)
+    else:
+        ranges=[detectFrameRange(job) for job in jobs]
+
+    detected=0
+    for results in ranges:
+        for filename, result in results:
+            cache.store(filename, result)
+            detected+=1
+    cache.save()
+    print("Detected",detected,"left for alignment",len(files)-detected)
+
+def splitFrameRanges(files:List, number_of_ranges:int) -> List:
+    size=max(1, int(np.ceil(len(files)/number_of_ranges)))
+    return [files[i:i+size] for i in range(0, len(files), size)]
+
+def alignReelParallel(files:List, output_path:str, average_width, average_height, average_area, state:dict, processes:int=NUM_PROCESSES, interactive:bool=True, cache:DetectionCache=None, stabilized:dict=None, ground_truth:GroundTruth=None) -> dict:
+    triage_filename=os.path.join(output_path, TRIAGE_FILENAME)
+    cached=cachedSproketHoles(cache, files, stabilized)
+
+    # Seed the learned bounding box from the start of the reel, one frame at a time
+    if state["max_x"]==0:
+        state, missing, triage, results=alignFrameRange((files[:SEED_FRAMES], output_path, (average_width, average_height, average_area), state, interactive, cached))
+        appendTriage(triage_filename, triage)
+        if cache is not None:
+            for filename, result in results:
+                cache.store(filename, result)
+        if ground_truth is not None:
+            for filename, result in results:
+                ground_truth.add(filename, result)
+            ground_truth.save()
+        files=files[SEED_FRAMES:]
+    else:
+        missing=[]
+
+    # More ranges than processes, so a slow range (lots of manual adjustment) doesn't hold up the others
+    ranges=splitFrameRanges(files, processes*4)
+    jobs=[(r, output_path, (average_width, average_height, average_area), dict(state), interactive, {f:cached[f] for f in r if f in cached}) for r in ranges]
+
+    # A reel store can only be grown by one process, make room for the whole reel first
+    FrameEncoders.reserve(output_path, OUTPUT_FORMAT, max((FrameFiles.frameNumber(f) for f in files), default=-1)+1, (FRAME_DIMS[3], FRAME_DIMS[2], 3))
+
+    if geometry is not None and len(files)>0:
+        # Build (or load) the correction tables once here, rather than every worker
+        # building them at the same time
+        image=FrameEncoders.readFrame(files[0],cv.IMREAD_UNCHANGED)
+        if image is not None:
+            geometry.loadMaps((image.shape[1], image.shape[0]))
+
+    states=[state]
+    lock=multiprocessing.Lock()
+    with multiprocessing.Pool(processes, initializer=_initAlignmentWorker, initargs=(lock, geometry, template_size)) as pool:
+        # imap returns results in frame order, even though ranges finish in any order
+        for range_state, range_missing, range_triage, range_results in pool.imap(alignFrameRange, jobs):
+            states.append(range_state)
+            missing.extend(range_missing)
+            appendTriage(triage_filename, range_triage)
+            if cache is not None:
+                for filename, result in range_results:
+                    cache.store(filename, result)
+                cache.save()
+            if ground_truth is not None:
+                for filename, result in range_results:
+                    ground_truth.add(filename, result)
+                ground_truth.save()
+
+    # Clone the previous frame to cover up corrupt/missing files, in frame order
+    for new_filename in sorted(missing):
+        previous_output_image_filename=FrameFiles.framePath(output_path, FrameFiles.frameNumber(new_filename)-1, ext=FrameEncoders.extension(OUTPUT_FORMAT))
+        if FrameFiles.frameExists(previous_output_image_filename):
+            print("Replacing bad frame",new_filename)
+            FrameEncoders.copyFrame(previous_output_image_filename, new_filename, OUTPUT_FORMAT)
+        else:
+            print("Unable to replace bad frame",new_filename)
+
+    return mergeSessionStates(states)
+
+def reviewTriage(output_path:str, average_width, average_height, average_area, state:dict, cache:DetectionCache=None, ground_truth:GroundTruth=None):
+    # Second pass over the doubtful frames from a headless run.  Each frame is shown in
+    # the adjustment window, press r to get back the fallback position used by the
+    # headless run.  Accepted frames are cropped again and removed from the triage file
+    triage_filename=os.path.join(output_path, TRIAGE_FILENAME)
+    entries=loadTriage(triage_filename)
+    print("Frames to review",len(entries))
+
+    remaining=list(entries)
+    try:
+        for entry in entries:
+            img = FrameEncoders.readFrame(entry["filename"],cv.IMREAD_UNCHANGED)
+            if img is None:
+                print("Error opening file",entry["filename"])
+                continue
+
+            print(entry["filename"],entry["reason"],entry["method"],"confidence",entry["confidence"])
+
+            # Empty learned box forces the adjustment window, r recalls the fallback position
+            review_state=newSessionState(int(entry["lower_t"]))
+            review_state["previous_frame_top_left_of_sproket_hole"]=(int(entry["tl_x"]),int(entry["tl_y"]))
+            review_state["previous_frame_bottom_right_of_sproket_hole"]=(int(entry["br_x"]),int(entry["br_y"]))
+
+            result={}
+            new_image=processImage(img, average_width, average_height, average_area, state=review_state, result=result)
+            if cache is not None:
+                cache.store(entry["filename"], result)
+            if ground_truth is not None:
+                ground_truth.add(entry["filename"], result)
+
+            new_filename = outputFilename(output_path, entry["filename"])
+            FrameEncoders.writeFrame(new_filename, new_image, OUTPUT_FORMAT)
+
+            # Corrected frames also teach the reel's learned box
+            state["min_x"]=min(state["min_x"],review_state["min_x"])
+            state["max_x"]=max(state["max_x"],review_state["max_x"])
+            state["min_y"]=min(state["min_y"],review_state["min_y"])
+            state["max_y"]=max(state["max_y"],review_state["max_y"])
+            remaining.remove(entry)
+    finally:
+        # Whatever wasn't reviewed stays in the file for next time
+        saveTriage(triage_filename, remaining)
+        if cache is not None:
+            cache.save()
+        if ground_truth is not None:
+            ground_truth.save()
+
+def main():
+    input_path=ImageFolder()
+    output_path=OutputFolder()
+
+    input_ext=FrameEncoders.findExtension(input_path)
+    files=Filelist(input_path,input_ext)
+
+    #files=files[469:]
+
+    # Sproket hole positions found on previous runs, delete the cache file to detect again
+    cache=DetectionCache(input_path)
+    # Positions confirmed as the reel is aligned, for Benchmark_GroundTruth.py
+    ground_truth=GroundTruth(input_path)
+
+    # Learned bounding box and threshold from the last run over this reel
+    session_filename=os.path.join(output_path, "session.json")
+    state=session
+    if os.path.exists(session_filename):
+        state=loadSessionState(session_filename)
+        print("Loaded session state",session_filename)
+
+    global show_windows, preview, geometry, fine_registration, template_size
+    video=None
+    if HEADLESS:
+        show_windows=False
+    if show_windows:
+        preview=PreviewThread(PREVIEW_FPS)
+
+    try:
+        average_sample_count=21
+        average_width=250
+        average_height=313
+        average_area=75335
+
+        # Skip this for now, we have already run it!
+        #average_sample_count,average_width,average_height,average_area=scanImages(files[:300])
+
+        calibration_filename=os.path.join(input_path, CALIBRATION_FILENAME)
+        if os.path.exists(calibration_filename):
+            calibration=loadCalibration(calibration_filename)
+            print("Loaded calibration",calibration_filename)
+        elif AUTO_CALIBRATE:
+            if MODE=="watch":
+                # Capture may only just have started, wait for enough frames to measure
+                while len(files)<CALIBRATION_SAMPLES and not FrameFiles.isEndOfReel(input_path):
+                    print("Waiting for frames to calibrate with, found",len(files))
+                    time.sleep(10)
+                    input_ext=FrameEncoders.findExtension(input_path)
+                    files=Filelist(input_path,input_ext)
+            print("Calibrating...")
+            calibration=autoCalibrate(files, CALIBRATION_SAMPLES, max(NUM_PROCESSES, os.cpu_count() or 1))
+            saveCalibration(calibration_filename, calibration)
+        else:
+            calibration=None
+
+        if calibration is not None:
+            average_sample_count=calibration["average_sample_count"]
+            average_width=calibration["average_width"]
+            average_height=calibration["average_height"]
+            average_area=calibration["average_area"]
+
+        print("samples=",average_sample_count,"w=",average_width,"h=", average_height,"area=", average_area)
+        template_size=(average_width, average_height)
+
+        if GEOMETRY_CORRECTION:
+            geometry_filename=os.path.join(input_path, Geometry.GEOMETRY_FILENAME)
+            if not os.path.exists(geometry_filename):
+                print("Estimating geometry...")
+                Geometry.saveSettings(geometry_filename, estimateGeometry(files, CALIBRATION_SAMPLES, max(NUM_PROCESSES, os.cpu_count() or 1)))
+            geometry=Geometry.GeometricCorrection(Geometry.loadSettings(geometry_filename), os.path.join(input_path, Geometry.MAPS_FILENAME))
+            print("Geometry correction",geometry.settings)
+
+        if MODE=="review":
+            reviewTriage(output_path, average_width, average_height, average_area, state, cache, ground_truth)
+            return
+
+        if MODE=="stabilize":
+            stabilizeReel(input_path, files, cache)
+            return
+
+        if MODE=="detect":
+            detectReel(input_path, files, cache, (average_width, average_height, average_area), state["lower_t"], max(NUM_PROCESSES, os.cpu_count() or 1))
+            return
+
+        if FINE_REGISTRATION:
+            fine_registration=FineRegistration()
+
+        stabilized=None
+        trajectory_filename=os.path.join(input_path, Trajectory.TRAJECTORY_FILENAME)
+        if STABILIZE and os.path.exists(trajectory_filename):
+            stabilized=Trajectory.loadSproketHoles(trajectory_filename)
+            print("Using stabilized positions",trajectory_filename)
+
+        # The video needs every frame, those aligned on an earlier run are read back
+        # rather than aligned again
+        aligned=set()
+        if VIDEO_FILENAME is not None:
+            video=VideoSink(os.path.join(output_path, VIDEO_FILENAME))
+            aligned=FrameFiles.frameNumbers(output_path, FrameEncoders.extension(OUTPUT_FORMAT))
+            if NUM_PROCESSES>1:
+                print("Frames are aligned one at a time when making a video, they must reach ffmpeg in order")
+
+        if MODE=="watch":
+            # Align each frame as soon as the scanner has finished writing it,
+            # skipping images which already exist
+            files=FrameWatcher(input_path, input_ext, skip=None if video is not None else FrameFiles.frameNumbers(output_path, FrameEncoders.extension(OUTPUT_FORMAT))).frames()
+        elif video is None:
+            #Skip images which already exist
+            files=unalignedFiles(files, output_path)
+
+        if NUM_PROCESSES>1 and MODE!="watch" and video is None:
+            state=alignReelParallel(files, output_path, average_width, average_height, average_area, state, NUM_PROCESSES, interactive=not HEADLESS, cache=cache, stabilized=stabilized, ground_truth=ground_truth)
+            return
+
+        triage_filename=os.path.join(output_path, TRIAGE_FILENAME)
+
+        previous_output_image_filename=None
+        previous_image=None
+        #overlay_frame = cv.imread("overlay_frame.png",cv.IMREAD_UNCHANGED)
+
+        for i in range(NUM_THREADS):
+            worker = Thread(target=ServiceImageWriteQueue, args=(q,))
+            worker.setDaemon(True)
+            worker.start()
+
+        for filename in files:
+            new_filename = outputFilename(output_path, filename)
+
+            if FrameFiles.frameNumber(filename) in aligned:
+                new_image=FrameEncoders.readFrame(new_filename,cv.IMREAD_COLOR)
+                if new_image is not None:
+                    video.write(new_image)
+                    previous_output_image_filename=new_filename
+                    previous_image=new_image
+                    continue
+
+            img = FrameEncoders.readFrame(filename,cv.IMREAD_UNCHANGED)
+            if img is None:
+                print("Error opening file",filename,"replacing bad frame")
+                #Clone frame to cover up corrupt/missing file
+                if SAVE_FRAMES:
+                    FrameEncoders.copyFrame(previous_output_image_filename, new_filename, OUTPUT_FORMAT)
+                if video is not None and previous_image is not None:
+                    video.write(previous_image)
+            else:
+                print(filename)
+
+                triage=[]
+                result={}
+                sproket_hole=cachedSproketHoles(cache, [filename], stabilized).get(filename)
+                new_image=processImage(img,  average_width, average_height, average_area, state=state, interactive=not HEADLESS, triage=triage, sproket_hole=sproket_hole, result=result)
+                h, w =new_image.shape[:2]
+
+                if sproket_hole is None:
+                    cache.store(filename, result)
+                    ground_truth.add(filename, result)
+
+                if len(triage)>0:
+                    for entry in triage:
+                        entry["filename"]=filename
+                    appendTriage(triage_filename, triage)
+
+
+                # Resize image and put into 16:9 frame?
+                if True==False:
+                    #Output a slightly higher resolution - use post editing to resize
+                    #this outputs at 16:9 scale
+                    #output_h=1558
+                    #output_w=int(output_h*(1920/1080))
+
+                    output_w=1920
+                    output_h=1080
+
+                    #Scale new_image to keep correct aspect ratio
+                    scale = output_w/w
+                    if h*scale > output_h:
+                        scale = output_h/h
+
+                    scale_w=int(w*scale)
+                    scale_h=int(h*scale)
+
+                    print("Scaled image w=",scale_w,"h=",scale_h, "original w=",w,"h=",h)
+                    #Horizontal centre frame
+                    scale_x_offset=int(output_w/2 - scale_w/2)
+                    scaled_image=cv.resize(new_image, (scale_w,scale_h), interpolation=cv.INTER_AREA)
+
+                    new_image = np.zeros((output_h,output_w,3), np.uint8)
+                    new_image[0:scale_h,scale_x_offset:scale_x_offset+scale_w]=scaled_image
 
-            # Place cropped into bottom right corner
-            #output_image[offset_y:offset_y+h,0:w]=cropped
 
-            previous_output_image_filename=new_filename
+                # Place cropped into bottom right corner
+                #output_image[offset_y:offset_y+h,0:w]=cropped
 
-            # Finally apply the mask over the top of the resized final video frame
-            #new_image = cv.bitwise_and(new_image, new_image, mask=overlay_frame)
+                previous_output_image_filename=new_filename
+                previous_image=new_image
 
-            q.put( {"filename":new_filename, "image":new_image} )
+                # Finally apply the mask over the top of the resized final video frame
+                #new_image = cv.bitwise_and(new_image, new_image, mask=overlay_frame)
 
+                if SAVE_FRAMES:
+                    q.put( {"filename":new_filename, "image":new_image} )
+                if video is not None:
+                    video.write(new_image)
 
-            #Show thumbnail at 50% of original
-            thumbnail=cv.resize(new_image, (0,0), fx=0.4, fy=0.4)
-            cv.imshow("Final",thumbnail)
+                #Show thumbnail at 40% of original
+                showPreview("Final", new_image)
 
-            k = cv.waitKey(1) & 0xFF
+                if preview is not None and preview.key == 27:
+                    return_value = False
+                    break
 
-            if k == 27:
-                return_value = False
-                break
-
-except BaseException as err:
-    print(f"Unexpected {err=}")
-    traceback.print_exc()
-    print("Press any key to shut down")
-    cv.waitKey()
-
-finally:
-    print("Waiting for image write queue to empty... length=",q.qsize())
-    q.join()
-    cv.destroyAllWindows()
+    except BaseException as err:
+        print(f"Unexpected {err=}")
+        traceback.print_exc()
+        if preview is not None:
+            preview.stop()
+            preview=None
+            print("Press any key to shut down")
+            cv.waitKey()
+
+    finally:
+        print("Waiting for image write queue to empty... length=",q.qsize())
+        q.join()
+        saveSessionState(session_filename, state)
+        cache.save()
+        ground_truth.save()
+        if video is not None:
+            print("Waiting for ffmpeg to finish the video...")
+            video.close()
+        if preview is not None:
+            preview.stop()
+        cv.destroyAllWindows()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# Preview.py
+#
+# Shows preview windows from a separate thread, at a capped frame rate, so that
+# drawing and displaying images never slows down the processing loop.
+#
+# The processing loop calls show() for every frame, which returns immediately
+# unless a new preview is due, in which case it keeps a downscaled copy for the
+# preview thread to display.
+
+import cv2 as cv
+import time
+from threading import Lock, Thread
+
+# OpenCV windows are not thread safe, anything else using cv.imshow/cv.waitKey
+# whilst the preview thread is running must hold this lock
+gui_lock = Lock()
+
+
+class PreviewThread:
+    def __init__(self, fps: float = 5):
+        self.interval = 1.0/fps
+        self.frames = {}
+        self.last_shown = {}
+        self.lock = Lock()
+        # Last key pressed in any preview window (-1 for none)
+        self.key = -1
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def due(self, name: str) -> bool:
+        # True if the window hasn't been updated for at least the preview interval
+        return time.perf_counter()-self.last_shown.get(name, 0) >= self.interval
+
+    def show(self, name: str, image, scale: float = 0.4):
+        if not self.due(name):
+            return
+        self.submit(name, cv.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv.INTER_NEAREST))
+
+    def submit(self, name: str, small_image):
+        # Image is already downscaled (and annotated), replaces anything not yet displayed
+        self.last_shown[name] = time.perf_counter()
+        with self.lock:
+            self.frames[name] = small_image
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                frames = self.frames
+                self.frames = {}
+
+            with gui_lock:
+                for name, image in frames.items():
+                    cv.imshow(name, image)
+                k = cv.waitKey(1)
+
+            if k != -1:
+                self.key = k & 0xFF
+
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
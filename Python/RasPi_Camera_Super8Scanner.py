@@ -26,8 +26,10 @@ from threading import Thread
 from fractions import Fraction
 import numpy as np
 import cv2 as cv
-import glob
 import os
+import FrameFiles
+import FrameEncoders
+import StripSidecar
 #import serial
 import math
 #from serial.serialwin32 import Serial
@@ -44,6 +46,9 @@ shutter_speed = 1000
 iso = 50
 
 NUM_THREADS = 3
+# File format of the captured frames, see FrameEncoders.py (run Benchmark_Encoders.py
+# to see which is quickest on this Pi)
+OUTPUT_FORMAT = "png:2"
 
 q = queue.Queue(maxsize=10)
 
@@ -378,13 +383,8 @@ def StartupAlignment(motor: RpiMotorLib, centre_box):
 
 
 def determineStartingFrameNumber(path: str, ext: str) -> int:
-    existing_files = sorted(glob.glob(os.path.join(
-        path, "frame_????????."+ext)), reverse=True)
-
-    if len(existing_files) > 0:
-        return 1+int(os.path.basename(existing_files[0]).split('.')[0][6:])
-
-    return 0
+    # One past the highest frame already captured (0 for an empty folder)
+    return 1+FrameFiles.lastFrameNumber(path, ext)
 
 
 def calculateAngleForSpoolTakeUp(inner_diameter_spool: float, frame_height: float, film_thickness: float, frames_on_spool: int, new_frames_to_spool: int) -> float:
@@ -461,15 +461,19 @@ def ServiceImageWriteQueue(q):
     while True:
         data=q.get(block=True, timeout=None)
         
-        filename = os.path.join(path+"{0}".format(data["exposure"]), "frame_{:08d}.png".format(data["number"]))
+        folder = path+"{0}".format(data["exposure"])
+        filename = FrameFiles.framePath(folder, data["number"], ext=FrameEncoders.extension(OUTPUT_FORMAT), create=True)
         # Save frame to disk.
-        # PNG output, with NO compression - which is quicker (less CPU time) on Rasp PI
-        # at expense of disk I/O
-        # PNG is always lossless
+        # Low (or no) compression is quicker (less CPU time) on Rasp PI
+        # at expense of disk I/O, all the formats are lossless
         #start_time = time.perf_counter()
-        #if cv.imwrite(filename, data["image"]) == False:
-        if cv.imwrite(filename, data["image"], [cv.IMWRITE_PNG_COMPRESSION, 2])==False:
-            raise IOError("Failed to save image")
+        FrameEncoders.writeFrame(filename, data["image"], OUTPUT_FORMAT)
+
+        # Small grey copy of the sproket strip and where the hole was found, so alignment
+        # can detect the hole without reading the whole frame
+        StripSidecar.saveStrip(filename, data["image"])
+        if data["capture"] is not None:
+            StripSidecar.appendCaptureRecord(folder, data["capture"])
         #print("Save image took {0:.2f} seconds".format(time.perf_counter() - start_time))
         q.task_done()
 
@@ -499,7 +503,9 @@ def main():
     #VERTICAL_OUTPUT_OFFSET = 50
 
     path = OutputFolder(CAMERA_EXPOSURE)
-    starting_frame_number = determineStartingFrameNumber(path+"-8.0", "png")
+    starting_frame_number = determineStartingFrameNumber(path+"-8.0", FrameEncoders.extension(OUTPUT_FORMAT))
+    for my_exposure in CAMERA_EXPOSURE:
+        FrameFiles.clearEndOfReel(path+"{0}".format(my_exposure))
     # starting_frame_number=465bb
     print("Starting at frame number ", starting_frame_number)
 
@@ -659,7 +665,7 @@ def main():
             #    print("Regrab image, no centre")
 
             last_exposure = CAMERA_EXPOSURE[0]
-            preview_image, centre, _ = ProcessImage(
+            preview_image, centre, sproket_box = ProcessImage(
                 freeze_frame, centre_box, True, CAMERA_EXPOSURE[0], lower_threshold=lower_threshold)
 
             if frame_number > 0:
@@ -753,8 +759,13 @@ def main():
                     thumnail_height, thumnail_width = thumbnail.shape[:2]
                     #cv.imshow("Exposure", thumbnail)
 
+                    # Where the hole was found, in the saved image's pixels (not known for a manual grab)
+                    capture = None
+                    if centre is not None and sproket_box is not None:
+                        capture = StripSidecar.captureRecord(frame_number, (highres_image_width, highres_image_height), (image_width, image_height), centre, sproket_box, centre_box[0])
+
                     # Save the image to the queue
-                    q.put( {"number":frame_number,"exposure":my_exposure, "image":freeze_frame} )
+                    q.put( {"number":frame_number,"exposure":my_exposure, "image":freeze_frame, "capture":capture} )
                     print("Image put onto queue, q length=",q.qsize())
 
                 # Move frame number on
@@ -778,6 +789,9 @@ def main():
     # Finished/Quit....
     print("Waiting for image write queue to empty... length=",q.qsize())
     q.join()
+    # Let ImageRegistrationCropping.py (in watch mode) know there are no more frames
+    for my_exposure in CAMERA_EXPOSURE:
+        FrameFiles.markEndOfReel(path+"{0}".format(my_exposure))
     print("Destroy windows")
     cv.destroyAllWindows()
     print("Disconnect Marlin")
@@ -0,0 +1,218 @@
+# ReelStore.py
+#
+# A whole reel of frames kept in one file, rather than a file per frame, for passing
+# frames between stages without encoding and decoding them every time.
+#
+#   frames.reel         the pixels, uncompressed, in a fixed size slot per frame
+#                       number (frame n starts at n * slot size)
+#   frames.reel.index   a row per slot: frame number, height, width, channels,
+#                       offset, status and the time it was written
+#   frames.reel.json    slot size and pixel type
+#
+# Both files are memory mapped.  Reading a frame returns a numpy view of the mapped
+# file, there is no decode and no copy, and any frame can be found without
+# searching.  The files grow GROW_FRAMES slots at a time (on Linux the unused
+# space isn't allocated on disk).
+#
+# Any number of processes can read a store while one process writes to it, for
+# example alignment watching the capture.  Several processes can write different
+# frames of the same store as long as it was made big enough first (see reserve).
+#
+# Frames are named frame_????????.reel (see FrameFiles.py) and read and written like
+# any other format (see FrameEncoders.py), so every stage can use a store.
+
+import json
+import numpy as np
+import os
+import time
+from threading import Lock
+
+STORE_FILENAME = "frames.reel"
+INDEX_FILENAME = "frames.reel.index"
+META_FILENAME = "frames.reel.json"
+
+# Slots added each time the store grows
+GROW_FRAMES = 1000
+
+STATUS_EMPTY = 0
+STATUS_DONE = 1
+
+INDEX_DTYPE = np.dtype([
+    ("number", "<i8"),
+    ("height", "<i4"),
+    ("width", "<i4"),
+    ("channels", "<i4"),
+    ("offset", "<i8"),
+    ("status", "<i1"),
+    ("mtime", "<f8"),
+])
+
+
+class ReelStore:
+    def __init__(self, folder: str, writable: bool = False):
+        self.folder = folder
+        self.writable = writable
+        self.lock = Lock()
+        with open(os.path.join(folder, META_FILENAME), "r") as f:
+            meta = json.load(f)
+        self.slot_bytes = meta["slot_bytes"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.capacity = 0
+        self.index = None
+        self.data = None
+        self.map()
+
+    @staticmethod
+    def create(folder: str, frame_shape, dtype=np.uint8, capacity: int = GROW_FRAMES):
+        # New empty store, with slots big enough for frames of frame_shape
+        dtype = np.dtype(dtype)
+        slot_bytes = int(np.prod(frame_shape))*dtype.itemsize
+        for filename in (STORE_FILENAME, INDEX_FILENAME):
+            open(os.path.join(folder, filename), "wb").close()
+        # Written last, a store only exists once this file does
+        with open(os.path.join(folder, META_FILENAME), "w") as f:
+            json.dump({"slot_bytes": slot_bytes, "dtype": dtype.str, "frame_shape": list(frame_shape)}, f, indent=2)
+
+        store = ReelStore(folder, writable=True)
+        store.grow(capacity)
+        return store
+
+    def map(self):
+        # (Re)maps the files at their current size, after this or another process grew them
+        capacity = os.path.getsize(os.path.join(self.folder, INDEX_FILENAME))//INDEX_DTYPE.itemsize
+        if capacity == self.capacity or capacity == 0:
+            return
+        mode = "r+" if self.writable else "r"
+        # The pixels are always grown first, so are at least this big
+        self.data = np.memmap(os.path.join(self.folder, STORE_FILENAME), np.uint8, mode, shape=(capacity*self.slot_bytes,))
+        self.index = np.memmap(os.path.join(self.folder, INDEX_FILENAME), INDEX_DTYPE, mode, shape=(capacity,))
+        self.capacity = capacity
+
+    def grow(self, capacity: int):
+        # Makes sure there are at least capacity slots.  Files are only ever extended,
+        # in place, so maps held by readers stay valid
+        if capacity <= self.capacity:
+            return
+        with self.lock:
+            self.map()
+            if capacity <= self.capacity:
+                return
+            capacity = GROW_FRAMES*int(np.ceil(capacity/GROW_FRAMES))
+            for filename, size in ((STORE_FILENAME, capacity*self.slot_bytes), (INDEX_FILENAME, capacity*INDEX_DTYPE.itemsize)):
+                with open(os.path.join(self.folder, filename), "r+b") as f:
+                    if os.fstat(f.fileno()).st_size < size:
+                        f.truncate(size)
+            self.map()
+
+    def status(self, number: int) -> int:
+        if number >= self.capacity:
+            self.map()
+        if number < 0 or number >= self.capacity:
+            return STATUS_EMPTY
+        return int(self.index["status"][number])
+
+    def read(self, number: int):
+        # The frame as a read only view of the mapped file, or None if it hasn't been written
+        if self.status(number) != STATUS_DONE:
+            return None
+        row = self.index[number]
+        h, w, channels = int(row["height"]), int(row["width"]), int(row["channels"])
+        shape = (h, w) if channels == 1 else (h, w, channels)
+        image = np.ndarray(shape, self.dtype, buffer=self.data, offset=int(row["offset"]))
+        image.flags.writeable = False
+        return image
+
+    def write(self, number: int, image):
+        if not self.writable:
+            raise IOError("Reel store opened read only "+self.folder)
+        image = np.ascontiguousarray(image)
+        if image.dtype != self.dtype or image.nbytes > self.slot_bytes:
+            raise ValueError("Frame {0} {1} doesn't fit the reel store's {2} byte {3} slots".format(image.shape, image.dtype, self.slot_bytes, self.dtype))
+        self.grow(number+1)
+
+        offset = number*self.slot_bytes
+        # Not readable whilst it is being overwritten, the status is set last
+        self.index["status"][number] = STATUS_EMPTY
+        self.data[offset:offset+image.nbytes] = image.reshape(-1).view(np.uint8)
+        self.index["number"][number] = number
+        self.index["height"][number] = image.shape[0]
+        self.index["width"][number] = image.shape[1]
+        self.index["channels"][number] = 1 if image.ndim == 2 else image.shape[2]
+        self.index["offset"][number] = offset
+        self.index["mtime"][number] = time.time()
+        self.index["status"][number] = STATUS_DONE
+
+    def info(self, number: int):
+        # Size in bytes and time written, the same as os.stat gives for a frame file
+        if self.status(number) != STATUS_DONE:
+            return None
+        row = self.index[number]
+        return int(row["height"])*int(row["width"])*int(row["channels"])*self.dtype.itemsize, float(row["mtime"])
+
+    def numbers(self) -> list:
+        # Frame numbers which have been written, in order
+        self.map()
+        if self.capacity == 0:
+            return []
+        return np.flatnonzero(self.index["status"] == STATUS_DONE).tolist()
+
+    def flush(self):
+        if self.writable and self.capacity > 0:
+            self.data.flush()
+            self.index.flush()
+
+    def close(self):
+        # Flushes and unmaps the files, frames already read stay valid
+        self.flush()
+        self.data = None
+        self.index = None
+        self.capacity = 0
+
+
+# Stores already opened by this process, by folder
+_stores = {}
+_stores_lock = Lock()
+
+
+def exists(folder: str) -> bool:
+    return os.path.exists(os.path.join(folder, META_FILENAME))
+
+
+def openStore(folder: str, writable: bool = False, frame_shape=None, dtype=np.uint8):
+    # The store in a folder, or None if there isn't one.  When writable a new store is
+    # made (with slots for frame_shape) if the folder doesn't have one
+    key = os.path.abspath(folder)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is not None and (store.writable or not writable):
+            return store
+        if not exists(folder):
+            if not writable:
+                return None
+            if frame_shape is None:
+                raise ValueError("Frame size is needed to make a reel store")
+            store = ReelStore.create(folder, frame_shape, dtype)
+        else:
+            store = ReelStore(folder, writable)
+        _stores[key] = store
+        return store
+
+
+def reserve(folder: str, capacity: int, frame_shape, dtype=np.uint8):
+    # Makes the store (if needed) with slots up to capacity, before several processes write to it
+    openStore(folder, True, frame_shape, dtype).grow(capacity)
+
+
+def closeStore(folder: str):
+    # Writes a store out and forgets it, the next openStore maps it again
+    with _stores_lock:
+        store = _stores.pop(os.path.abspath(folder), None)
+    if store is not None:
+        store.close()
+
+
+def storedFrames(folder: str) -> list:
+    store = openStore(folder) if exists(folder) else None
+    if store is None:
+        return []
+    return store.numbers()
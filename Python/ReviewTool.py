@@ -0,0 +1,312 @@
+# ReviewTool.py
+#
+# Fast review of the doubtful frames logged to Aligned/triage.csv by a headless run
+# of ImageRegistrationCropping.py (an alternative to MODE = "review").
+#
+# Frames are shown from small proxy images (saved in the Proxies folder of the input
+# folder, made in the background a few frames ahead) which are kept in a memory
+# limited cache, so moving between frames and nudging the sproket hole position is
+# instant.  Adjustments are kept as an offset from the logged position.  Accepting a
+# frame queues the full resolution crop, which is done by a background thread.
+#
+# Keys:
+#   cursor keys     move the sproket hole 2 pixels     8 2 4 6  move 20 pixels
+#   SPACE           accept the frame and move to the next one
+#   n / b           next / back without accepting
+#   r               back to the logged position (clears the offset)
+#   ESC             quit (waits for the crops in progress)
+#
+# Run it from the capture folder, the same as ImageRegistrationCropping.py.
+
+import cv2 as cv
+import json
+import numpy as np
+import os
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+
+import ImageRegistrationCropping as registration
+import Geometry
+import FrameEncoders
+import FrameFiles
+from DetectionCache import DetectionCache, SOURCE_OPERATOR
+from GroundTruth import GroundTruth
+
+PROXY_FOLDER = "Proxies"
+PROXY_SCALE = 0.25
+# Memory allowed for decoded proxies
+CACHE_BYTES = 256*1024*1024
+# Proxies made ahead of the current frame
+PREFETCH = 8
+# Offsets not yet accepted are kept here (in the output folder) between sessions
+EDITS_FILENAME = "review_edits.json"
+
+SMALL_STEP = 2
+LARGE_STEP = 10*SMALL_STEP
+
+KEY_UP = 65362
+KEY_DOWN = 65364
+KEY_LEFT = 65361
+KEY_RIGHT = 65363
+
+
+class FrameCache:
+    # Least recently used images, limited by memory used rather than count
+    def __init__(self, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.images = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        with self.lock:
+            if key in self.images:
+                self.bytes -= self.images.pop(key).nbytes
+            self.images[key] = image
+            self.bytes += image.nbytes
+            while self.bytes > self.max_bytes and len(self.images) > 1:
+                _, oldest = self.images.popitem(last=False)
+                self.bytes -= oldest.nbytes
+
+
+class ProxyLoader:
+    def __init__(self, input_path: str, cache: FrameCache):
+        self.folder = os.path.join(input_path, PROXY_FOLDER)
+        os.makedirs(self.folder, exist_ok=True)
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=2)
+        self.pending = {}
+        self.lock = Lock()
+
+    def proxyFilename(self, filename: str) -> str:
+        return os.path.join(self.folder, os.path.splitext(os.path.basename(filename))[0]+".jpg")
+
+    def load(self, filename: str):
+        image = self.cache.get(filename)
+        if image is not None:
+            return image
+
+        proxy_filename = self.proxyFilename(filename)
+        image = None
+        if os.path.exists(proxy_filename) and os.path.getmtime(proxy_filename) >= FrameFiles.frameStat(filename)[1]:
+            image = cv.imread(proxy_filename, cv.IMREAD_COLOR)
+
+        if image is None:
+            original = FrameEncoders.readFrame(filename, cv.IMREAD_COLOR)
+            if original is None:
+                raise IOError("Error opening file "+filename)
+            image = cv.resize(original, (0, 0), fx=PROXY_SCALE, fy=PROXY_SCALE, interpolation=cv.INTER_AREA)
+            cv.imwrite(proxy_filename, image, [cv.IMWRITE_JPEG_QUALITY, 90])
+
+        self.cache.put(filename, image)
+        return image
+
+    def get(self, filename: str):
+        # Wait for a prefetch already in progress rather than decoding twice.  None if
+        # the frame (or its proxy) can't be read, so one bad file doesn't end the review
+        with self.lock:
+            future = self.pending.pop(filename, None)
+        try:
+            if future is not None:
+                return future.result()
+            return self.load(filename)
+        except Exception as err:
+            print("Failed to load", filename, err)
+            return None
+
+    def prefetch(self, filenames):
+        with self.lock:
+            for filename in filenames:
+                if filename not in self.pending and self.cache.get(filename) is None:
+                    self.pending[filename] = self.pool.submit(self.load, filename)
+
+
+class Recropper(Thread):
+    # Full resolution crop of accepted frames, one at a time in the background
+    def __init__(self, output_path: str, averages, detection_cache: DetectionCache, ground_truth: GroundTruth):
+        super().__init__(daemon=True)
+        self.output_path = output_path
+        self.averages = averages
+        self.detection_cache = detection_cache
+        self.ground_truth = ground_truth
+        self.jobs = queue.Queue()
+        self.done = []
+        self.lock = Lock()
+        self.start()
+
+    def run(self):
+        while True:
+            entry, tl, br = self.jobs.get()
+            try:
+                self.crop(entry, tl, br)
+                with self.lock:
+                    self.done.append(entry)
+            except Exception as err:
+                print("Failed to crop", entry["filename"], err)
+            self.jobs.task_done()
+
+    def crop(self, entry, tl, br):
+        img = FrameEncoders.readFrame(entry["filename"], cv.IMREAD_UNCHANGED)
+        if img is None:
+            raise IOError("Error opening file "+entry["filename"])
+
+        result = {}
+        state = registration.newSessionState(int(entry["lower_t"]))
+        new_image = registration.processImage(img, *self.averages, state=state, interactive=False, sproket_hole=(tl, br), result=result)
+        result["source"] = SOURCE_OPERATOR
+        self.detection_cache.store(entry["filename"], result)
+        self.ground_truth.add(entry["filename"], result)
+
+        new_filename = registration.outputFilename(self.output_path, entry["filename"])
+        FrameEncoders.writeFrame(new_filename, new_image, registration.OUTPUT_FORMAT)
+        print("Saved", new_filename)
+
+
+def loadEdits(filename: str) -> dict:
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as f:
+        return {k: tuple(v) for k, v in json.load(f).items()}
+
+
+def saveEdits(filename: str, edits: dict):
+    with open(filename, "w") as f:
+        json.dump(edits, f, indent=2)
+
+
+def holePosition(entry, offset):
+    tl = (int(entry["tl_x"])+offset[0], int(entry["tl_y"])+offset[1])
+    br = (int(entry["br_x"])+offset[0], int(entry["br_y"])+offset[1])
+    return tl, br
+
+
+def render(proxy, entry, offset, size, index: int, total: int, accepted: bool):
+    # Annotated proxy and a preview of the output frame, both from the proxy image
+    tl, br = holePosition(entry, offset)
+    frame_tl, frame_br = registration.frameRectangle(tl, br, size)
+    state = registration.newSessionState()
+
+    view = registration.annotateFrame(proxy.copy(), PROXY_SCALE, state, tl, br, frame_tl, frame_br)
+    text = "{0}/{1} {2} {3} offset {4},{5}{6}".format(index+1, total, os.path.basename(entry["filename"]), entry["reason"], offset[0], offset[1], " ACCEPTED" if accepted else "")
+    cv.putText(view, text, (5, 20), cv.FONT_HERSHEY_SIMPLEX, 0.5, (200, 200, 200), 1, cv.LINE_AA)
+
+    ph, pw = proxy.shape[:2]
+    x1, y1 = int(frame_tl[0]*PROXY_SCALE), int(frame_tl[1]*PROXY_SCALE)
+    x2, y2 = int(frame_br[0]*PROXY_SCALE), int(frame_br[1]*PROXY_SCALE)
+    output = np.zeros((y2-y1, x2-x1, 3), np.uint8)
+    sx1, sy1, sx2, sy2 = max(x1, 0), max(y1, 0), min(x2, pw), min(y2, ph)
+    if sx2 > sx1 and sy2 > sy1:
+        output[sy1-y1:sy2-y1, sx1-x1:sx2-x1] = proxy[sy1:sy2, sx1:sx2]
+    return view, output
+
+
+def main():
+    input_path = registration.ImageFolder()
+    output_path = registration.OutputFolder()
+
+    triage_filename = os.path.join(output_path, registration.TRIAGE_FILENAME)
+    entries = registration.loadTriage(triage_filename)
+    if len(entries) == 0:
+        print("Nothing to review")
+        return
+    print("Frames to review", len(entries))
+
+    averages = (250, 313, 75335)
+    calibration_filename = os.path.join(input_path, registration.CALIBRATION_FILENAME)
+    if os.path.exists(calibration_filename):
+        calibration = registration.loadCalibration(calibration_filename)
+        averages = (calibration["average_width"], calibration["average_height"], calibration["average_area"])
+
+    geometry_filename = os.path.join(input_path, Geometry.GEOMETRY_FILENAME)
+    if registration.GEOMETRY_CORRECTION and os.path.exists(geometry_filename):
+        registration.geometry = Geometry.GeometricCorrection(Geometry.loadSettings(geometry_filename), os.path.join(input_path, Geometry.MAPS_FILENAME))
+
+    # Only the proxies are shown, but the crop rectangle is worked out at full resolution
+    first = FrameEncoders.readFrame(entries[0]["filename"], cv.IMREAD_UNCHANGED)
+    if first is None:
+        raise IOError("Error opening file "+entries[0]["filename"])
+    size = (first.shape[1], first.shape[0])
+    first = None
+
+    edits_filename = os.path.join(output_path, EDITS_FILENAME)
+    edits = loadEdits(edits_filename)
+    detection_cache = DetectionCache(input_path)
+    ground_truth = GroundTruth(input_path)
+    proxies = ProxyLoader(input_path, FrameCache())
+    recropper = Recropper(output_path, averages, detection_cache, ground_truth)
+    accepted = set()
+
+    index = 0
+    try:
+        while True:
+            entry = entries[index]
+            filename = entry["filename"]
+            proxies.prefetch([e["filename"] for e in entries[index+1:index+1+PREFETCH]]+[e["filename"] for e in entries[max(index-2, 0):index]])
+
+            offset = edits.get(filename, (0, 0))
+            proxy = proxies.get(filename)
+            if proxy is None:
+                # Blank in place of a frame which can't be read, the others can still be reviewed
+                proxy = np.zeros((int(size[1]*PROXY_SCALE), int(size[0]*PROXY_SCALE), 3), np.uint8)
+            view, output = render(proxy, entry, offset, size, index, len(entries), filename in accepted)
+            cv.imshow("Review", view)
+            cv.imshow("Output", output)
+            k = cv.waitKeyEx(0)
+
+            step = None
+            if k == KEY_UP:
+                step = (0, -SMALL_STEP)
+            elif k == KEY_DOWN:
+                step = (0, SMALL_STEP)
+            elif k == KEY_LEFT:
+                step = (-SMALL_STEP, 0)
+            elif k == KEY_RIGHT:
+                step = (SMALL_STEP, 0)
+            elif k == ord('8'):
+                step = (0, -LARGE_STEP)
+            elif k == ord('2'):
+                step = (0, LARGE_STEP)
+            elif k == ord('4'):
+                step = (-LARGE_STEP, 0)
+            elif k == ord('6'):
+                step = (LARGE_STEP, 0)
+
+            if step is not None:
+                edits[filename] = (offset[0]+step[0], offset[1]+step[1])
+            elif k == ord('r'):
+                edits.pop(filename, None)
+            elif k == ord(' '):
+                tl, br = holePosition(entry, offset)
+                recropper.jobs.put((entry, tl, br))
+                accepted.add(filename)
+                index = min(index+1, len(entries)-1)
+            elif k == ord('n'):
+                index = min(index+1, len(entries)-1)
+            elif k == ord('b'):
+                index = max(index-1, 0)
+            elif k == 27:
+                break
+    finally:
+        print("Waiting for crops to finish... length=", recropper.jobs.qsize())
+        recropper.jobs.join()
+        cv.destroyAllWindows()
+
+        # Whatever wasn't accepted stays in the triage file (and keeps its offset) for next time
+        done = set(e["filename"] for e in recropper.done)
+        registration.saveTriage(triage_filename, [e for e in entries if e["filename"] not in done])
+        saveEdits(edits_filename, {k: v for k, v in edits.items() if k not in done})
+        detection_cache.save()
+        ground_truth.save()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,18 +8,25 @@ import glob
 import shutil
 import traceback
 
+import FrameEncoders
+import FrameFiles
+
 # Copied from
 # https://stackoverflow.com/questions/11541154/checking-images-for-similarity-with-opencv
 
+# Frames can be in any format, including a reel store
+input_ext = FrameEncoders.findExtension("Capture")
+frames = dict(FrameFiles.scanFrames("Capture", input_ext))
+
 for frame_number in range(0,200):
 
-    filename = os.path.join("Capture", "frame_{:08d}.png".format(frame_number))
-    picture1 = cv.imread(filename,cv.IMREAD_UNCHANGED)
+    filename = frames.get(frame_number, FrameFiles.framePath("Capture", frame_number, ext=input_ext))
+    picture1 = FrameEncoders.readFrame(filename,cv.IMREAD_UNCHANGED)
     if picture1 is None:
         raise Exception("Error reading "+filename)
 
-    filename = os.path.join("Capture", "frame_{:08d}.png".format(frame_number+1))
-    picture2 = cv.imread(filename,cv.IMREAD_UNCHANGED)
+    filename = frames.get(frame_number+1, FrameFiles.framePath("Capture", frame_number+1, ext=input_ext))
+    picture2 = FrameEncoders.readFrame(filename,cv.IMREAD_UNCHANGED)
     if picture2 is None:
         raise Exception("Error reading "+filename)
     
@@ -0,0 +1,94 @@
+# StripSidecar.py
+#
+# Small files written next to each captured frame, so sproket hole detection doesn't
+# need to decode the whole (2-12 MP) frame:
+#
+#   frame_00001234.strip.png   grey copy of the left hand strip (where the sproket
+#                              holes are), the same strip processImage searches
+#   capture_log.csv            where the scanner found the hole when it took the
+#                              frame, in full resolution pixels
+#
+# The strip is a fifth of the width and a third of the channels of the frame, so
+# reading it is well over 10x less work than reading the frame.
+
+import csv
+import cv2 as cv
+import os
+from threading import Lock
+
+import FrameFiles
+
+# Same strip as processImage (fraction of the frame width)
+STRIP_FRACTION = 0.205
+STRIP_SUFFIX = ".strip.png"
+
+CAPTURE_LOG_FILENAME = "capture_log.csv"
+CAPTURE_LOG_FIELDS = ["number", "width", "height", "centre_x", "centre_y", "tl_x", "tl_y", "br_x", "br_y"]
+
+# Several image writer threads can append to the capture log
+_log_lock = Lock()
+
+
+def stripFilename(frame_filename: str) -> str:
+    return os.path.splitext(frame_filename)[0]+STRIP_SUFFIX
+
+
+def saveStrip(frame_filename: str, image):
+    h, w = image.shape[:2]
+    strip = image[0:h, 0:int(w*STRIP_FRACTION)]
+    if strip.ndim == 3:
+        strip = cv.cvtColor(strip, cv.COLOR_BGR2GRAY)
+    # Fastest compression, the file is small anyway
+    if cv.imwrite(stripFilename(frame_filename), strip, [cv.IMWRITE_PNG_COMPRESSION, 1]) == False:
+        raise IOError("Failed to save strip")
+
+
+def loadStrip(frame_filename: str):
+    # Grey strip for the frame, or None if there isn't one (or the frame has been
+    # captured again since it was written)
+    strip_filename = stripFilename(frame_filename)
+    try:
+        if os.path.getmtime(strip_filename) < FrameFiles.frameStat(frame_filename)[1]-1:
+            return None
+    except OSError:
+        return None
+    return cv.imread(strip_filename, cv.IMREAD_GRAYSCALE)
+
+
+def captureRecord(number: int, frame_size, preview_size, centre, box, x_offset: int = 0) -> dict:
+    # Converts the scanner's detection (on the preview image, box relative to the
+    # strip starting at x_offset) into full resolution pixels of the saved frame
+    w, h = frame_size
+    scale_x = w/preview_size[0]
+    scale_y = h/preview_size[1]
+    xs = [p[0]+x_offset for p in box]
+    ys = [p[1] for p in box]
+    return {"number": number, "width": w, "height": h,
+            "centre_x": round(centre[0]*scale_x, 1), "centre_y": round(centre[1]*scale_y, 1),
+            "tl_x": int(min(xs)*scale_x), "tl_y": int(min(ys)*scale_y),
+            "br_x": int(max(xs)*scale_x), "br_y": int(max(ys)*scale_y)}
+
+
+def appendCaptureRecord(folder: str, record: dict):
+    filename = os.path.join(folder, CAPTURE_LOG_FILENAME)
+    with _log_lock:
+        new_file = not os.path.exists(filename)
+        with open(filename, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=CAPTURE_LOG_FIELDS)
+            if new_file:
+                writer.writeheader()
+            writer.writerow(record)
+
+
+def loadCaptureRecords(folder: str) -> dict:
+    # Frame number to capture record, the latest record wins if a frame was captured twice
+    filename = os.path.join(folder, CAPTURE_LOG_FILENAME)
+    records = {}
+    if not os.path.exists(filename):
+        return records
+    with open(filename, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            record = {k: float(v) for k, v in row.items()}
+            record["number"] = int(record["number"])
+            records[record["number"]] = record
+    return records
@@ -0,0 +1,147 @@
+# Trajectory.py
+#
+# Offline pass over the sproket hole positions of a whole reel (from the detection
+# cache), no images are loaded.
+#
+# Detection noise on single frames shows up as weave in the aligned output.  The
+# positions are loaded into one numpy array, outliers are replaced and the path is
+# smoothed, without smoothing across splices (where the position jumps and stays
+# there).  The cropping stage then uses the corrected positions.
+#
+# Everything works on a few kilobytes of numbers, so different settings can be
+# tried in seconds.
+
+import numpy as np
+import os
+from numpy.lib.stride_tricks import sliding_window_view
+
+TRAJECTORY_FILENAME = "trajectory.npz"
+
+# Frames in the running median (odd), 1 turns smoothing off
+SMOOTHING_WINDOW = 5
+# Frames either side compared when looking for splices
+SPLICE_WINDOW = 8
+# A lasting jump in position larger than this (pixels) is a splice
+SPLICE_PIXELS = 12
+# Frames further than this (pixels) from the smoothed path are outliers
+OUTLIER_PIXELS = 6
+
+
+def loadPositions(cache, files: list):
+    # Top left corner and size of every hole, NaN where a frame isn't in the cache (or
+    # only has a fallback guess)
+    positions = np.full((len(files), 4), np.nan)
+    for i, filename in enumerate(files):
+        hole = cache.sproketHole(filename)
+        if hole is not None:
+            (tl_x, tl_y), (br_x, br_y) = hole
+            positions[i] = (tl_x, tl_y, br_x-tl_x, br_y-tl_y)
+    return positions
+
+
+def fillMissing(values):
+    # Linear interpolation over NaN values
+    missing = np.isnan(values)
+    if missing.all():
+        raise Exception("No positions to work with")
+    values = values.copy()
+    if missing.any():
+        index = np.arange(len(values))
+        values[missing] = np.interp(index[missing], index[~missing], values[~missing])
+    return values
+
+
+def runningMedian(values, window: int):
+    if window <= 1 or len(values) == 0:
+        return values.copy()
+    pad = window//2
+    padded = np.pad(values, (pad, window-1-pad), mode="edge")
+    return np.median(sliding_window_view(padded, window), axis=1)
+
+
+def runningMax(values, window: int):
+    pad = window//2
+    padded = np.pad(values, (pad, window-1-pad), mode="edge")
+    return sliding_window_view(padded, window).max(axis=1)
+
+
+def findSplices(x, y, window: int = SPLICE_WINDOW, threshold: float = SPLICE_PIXELS):
+    # Index of the first frame after each splice.  Compares the median position of the
+    # frames before each frame with the frames from it onwards, a splice is where that
+    # difference peaks above the threshold
+    n = len(x)
+    if n < 2*window:
+        return np.array([], dtype=int)
+
+    steps = np.zeros(n)
+    for values in (x, y):
+        padded = np.pad(values, (window, window), mode="edge")
+        windows = sliding_window_view(padded, window)
+        before = np.median(windows[0:n], axis=1)
+        after = np.median(windows[window:window+n], axis=1)
+        steps = np.hypot(steps, after-before)
+
+    peaks = (steps > threshold) & (steps == runningMax(steps, 2*window+1))
+    splices = np.flatnonzero(peaks)
+
+    # Flat peaks give several neighbouring frames, keep the first of each
+    if len(splices) > 0:
+        splices = splices[np.concatenate(([True], np.diff(splices) > window))]
+    return splices
+
+
+def smoothSegments(values, splices, window: int):
+    # Running median followed by a short mean, never crossing a splice
+    smoothed = np.empty_like(values)
+    bounds = np.concatenate(([0], splices, [len(values)]))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        segment = runningMedian(values[start:end], window)
+        if window > 1 and end-start >= 3:
+            padded = np.pad(segment, 1, mode="edge")
+            segment = (padded[:-2]+padded[1:-1]+padded[2:])/3
+        smoothed[start:end] = segment
+    return smoothed
+
+
+def correctTrajectory(positions, smoothing_window: int = SMOOTHING_WINDOW, outlier_pixels: float = OUTLIER_PIXELS):
+    # Returns corrected top left x/y, hole width/height used for every frame,
+    # outlier flags and the splice indexes
+    x = fillMissing(positions[:, 0])
+    y = fillMissing(positions[:, 1])
+
+    splices = findSplices(x, y)
+
+    smooth_x = smoothSegments(x, splices, smoothing_window)
+    smooth_y = smoothSegments(y, splices, smoothing_window)
+
+    outliers = (np.abs(x-smooth_x) > outlier_pixels) | (np.abs(y-smooth_y) > outlier_pixels) | np.isnan(positions[:, 0])
+
+    # Smooth again without the outliers, so they don't pull the path towards them
+    if outliers.any() and not outliers.all():
+        x[outliers] = np.nan
+        y[outliers] = np.nan
+        smooth_x = smoothSegments(fillMissing(x), splices, smoothing_window)
+        smooth_y = smoothSegments(fillMissing(y), splices, smoothing_window)
+
+    # The hole size doesn't change through a reel, use the median rather than each frame's
+    width = np.nanmedian(positions[:, 2])
+    height = np.nanmedian(positions[:, 3])
+
+    return smooth_x, smooth_y, width, height, outliers, splices
+
+
+def saveTrajectory(filename: str, files: list, positions, smooth_x, smooth_y, width, height, outliers, splices):
+    np.savez_compressed(filename, path=np.array([os.path.abspath(f) for f in files]), raw=positions,
+                        x=smooth_x, y=smooth_y, width=width, height=height, outliers=outliers, splices=splices)
+
+
+def loadSproketHoles(filename: str) -> dict:
+    # Corrected (top left, bottom right) hole position for each file, as used by processImage
+    holes = {}
+    with np.load(filename) as data:
+        width = int(round(float(data["width"])))
+        height = int(round(float(data["height"])))
+        for path, x, y in zip(data["path"], data["x"], data["y"]):
+            tl = (int(round(x)), int(round(y)))
+            holes[str(path)] = (tl, (tl[0]+width, tl[1]+height))
+    return holes
@@ -0,0 +1,107 @@
+# VideoSink.py
+#
+# Sends frames straight into an ffmpeg process (as raw BGR pixels on its standard
+# input) to make the video, rather than saving every frame as an image and having
+# ffmpeg read them all back in afterwards.  That saves an encode and a decode of
+# every frame when only the video is wanted.
+#
+# Frames are passed to ffmpeg by a background thread through a short queue, so the
+# caller only waits if ffmpeg falls behind, and memory use stays at QUEUE_SIZE
+# frames.  ffmpeg is started when the first frame arrives (its size sets the video
+# size), every frame must be the same size.  close() must be called, it waits for
+# ffmpeg to finish writing the file.
+#
+# ffmpeg has to be installed and on the PATH (or set FFMPEG to where it is).
+
+import queue
+import subprocess
+from threading import Thread
+
+FFMPEG = "ffmpeg"
+# Super 8 is normally 18 frames per second
+FRAME_RATE = 18
+# Same settings as the ffmpeg command in the README
+OUTPUT_ARGUMENTS = ["-vcodec", "h264", "-preset", "slower", "-tune", "grain", "-crf", "15", "-pix_fmt", "yuv420p"]
+# Frames waiting for ffmpeg
+QUEUE_SIZE = 8
+
+
+class VideoSink:
+    def __init__(self, filename: str, frame_rate: float = FRAME_RATE, output_arguments=None, queue_size: int = QUEUE_SIZE):
+        self.filename = filename
+        self.frame_rate = frame_rate
+        self.output_arguments = OUTPUT_ARGUMENTS if output_arguments is None else output_arguments
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.process = None
+        self.thread = None
+        self.size = None
+        self.error = None
+        self.count = 0
+        # ffmpeg's exit code once closed
+        self.return_code = None
+
+    def command(self, size):
+        w, h = size
+        return [FFMPEG, "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", "{0}x{1}".format(w, h), "-framerate", str(self.frame_rate), "-i", "-"] + \
+            self.output_arguments + [self.filename]
+
+    def start(self, size):
+        self.size = size
+        self.process = subprocess.Popen(self.command(size), stdin=subprocess.PIPE)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            image = self.frames.get()
+            if image is None:
+                break
+            if self.error is not None:
+                # ffmpeg has gone, keep emptying the queue so write() doesn't block
+                continue
+            try:
+                self.process.stdin.write(memoryview(image).cast("B"))
+            except (BrokenPipeError, OSError) as err:
+                self.error = err
+
+    def write(self, image):
+        h, w = image.shape[:2]
+        if self.process is None:
+            self.start((w, h))
+        if (w, h) != self.size:
+            raise ValueError("Frame is {0}x{1}, the video is {2}x{3}".format(w, h, self.size[0], self.size[1]))
+        if image.ndim != 3 or image.shape[2] != 3:
+            raise ValueError("Only 3 channel (BGR) frames can be sent to ffmpeg")
+        if self.error is not None:
+            raise IOError("ffmpeg stopped "+str(self.error))
+        if not image.flags["C_CONTIGUOUS"]:
+            image = image.copy()
+        self.frames.put(image)
+        self.count += 1
+
+    def close(self) -> bool:
+        # Waits for the queued frames and for ffmpeg to finish the file.  Called from
+        # finally blocks, so a failure is printed (and False returned) rather than
+        # raised over whatever went wrong first
+        if self.process is None:
+            return self.return_code == 0
+        self.frames.put(None)
+        self.thread.join()
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        self.return_code = self.process.wait()
+        self.process = None
+        if self.return_code != 0:
+            print("ffmpeg failed with exit code {0}, {1}".format(self.return_code, self.filename))
+            return False
+        print("Video", self.filename, "frames", self.count)
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()